@@ -0,0 +1,252 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import main as vehicalc
+
+# Load test and benchmark suite for the record/view pipeline.
+#
+# Every dataset size runs in a fresh process inside its own directory, so the CSV
+# files, trip log and caches of one size never leak into the next. Results are
+# written as JSON (stdout or --output); a readable summary goes to stderr.
+#
+#   python benchmark.py                                   # 1k and 10k trips, CSV storage
+#   python benchmark.py --sizes 1000,1000000,10000000 --storage sqlite:bench.db
+#   python benchmark.py --sessions 16 --output results.json
+
+PASSWORD = "benchmark1"
+YEARS = (2024, 2025, 2026)
+USERS_PER_TRIP = 0.1  # users generated per trip of dataset size, at least MIN_USERS
+MIN_USERS = 10
+PRELOAD_CHUNK = 10000  # users per bulk signup while building a dataset
+
+def percentile(ordered, p):
+    # Nearest rank on an already sorted list
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+def summarize(latencies, elapsed):
+    ordered = sorted(latencies)
+    if not ordered:
+        return {"ops": 0}
+    return {
+        "ops": len(ordered),
+        "seconds": round(elapsed, 6),
+        "throughput_per_s": round(len(ordered) / elapsed, 1) if elapsed else None,
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 4),
+        "p50_ms": round(percentile(ordered, 50) * 1000, 4),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 4),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 4),
+        "max_ms": round(ordered[-1] * 1000, 4),
+    }
+
+def measure(function, calls):
+    # Times each call of function(*args) separately
+    latencies = []
+    started = time.perf_counter()
+    for args in calls:
+        begin = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - begin)
+    return summarize(latencies, time.perf_counter() - started)
+
+def synthetic_users(count, prefix="bench"):
+    return [f"{prefix}{i:07d}" for i in range(count)]
+
+def synthetic_trip(rng, username):
+    vehicle_type = rng.choice(("CAR", "CAR", "CAR", "MOTORCYCLE", "VAN"))
+    fuel_based = rng.random() < 0.6
+    return {
+        "username": username,
+        "vehicle_type": vehicle_type,
+        "fuel_type": rng.choice(("GASOLINE", "DIESEL")) if fuel_based else "",
+        "fuel_efficiency": round(rng.uniform(6.0, 30.0), 1) if fuel_based else "",
+        "distance": round(rng.uniform(1.0, 200.0), 1),
+        "month": rng.choice(vehicalc.VALID_MONTHS),
+        "year": rng.choice(YEARS),
+        "urban": "y" if not fuel_based and rng.random() < 0.3 else "n",
+    }
+
+def user_input(trip):
+    return vehicalc.UserInput(trip["username"], trip["vehicle_type"], trip["fuel_type"],
+                              trip["fuel_efficiency"] or None, trip["distance"], trip["month"], trip["year"])
+
+def write_trip_file(path, users, count, seed):
+    # Streams count synthetic trips to a CSV in the bulk import format
+    rng = random.Random(seed)
+    fieldnames = ["username", "vehicle_type", "fuel_type", "fuel_efficiency", "distance", "month", "year", "urban"]
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        for _ in range(count):
+            writer.writerow(synthetic_trip(rng, rng.choice(users)))
+
+def open_benchmark_storage(directory, storage_spec, fsync_spec):
+    os.chdir(directory)
+    vehicalc.set_fsync_policy(fsync_spec)
+    return vehicalc.set_storage(vehicalc.open_storage(storage_spec))
+
+def run_session(directory, storage_spec, fsync_spec, username, operations, seed):
+    # One simulated user: log in, record trips, look at the history; returns per-step latencies
+    open_benchmark_storage(directory, storage_spec, fsync_spec)
+    rng = random.Random(seed)
+    latencies = {"login": [], "store_emission": [], "history": []}
+    begin = time.perf_counter()
+    if not vehicalc.User.validate_user(username, PASSWORD):
+        raise ValueError(f"Session login failed for {username}")
+    latencies["login"].append(time.perf_counter() - begin)
+    for _ in range(operations):
+        trip = synthetic_trip(rng, username)
+        begin = time.perf_counter()
+        entry = user_input(trip)
+        urban = trip["urban"] == "y"
+        vehicalc.EmissionHistory(entry, vehicalc.calculate_emission(entry, urban), urban).store_emission()
+        latencies["store_emission"].append(time.perf_counter() - begin)
+    begin = time.perf_counter()
+    vehicalc.EmissionHistoryViewer.get_history(username)
+    latencies["history"].append(time.perf_counter() - begin)
+    vehicalc.get_storage().close()
+    return latencies
+
+def run_sessions(directory, options, users):
+    # N concurrent sessions, each in its own process like separate CLI users
+    context = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=options.sessions, mp_context=context) as executor:
+        futures = [executor.submit(run_session, directory, options.storage, options.fsync, users[i % len(users)],
+                                   options.session_ops, options.seed + i) for i in range(options.sessions)]
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    report = {"sessions": options.sessions, "seconds": round(elapsed, 6),
+              "sessions_per_s": round(options.sessions / elapsed, 2)}
+    for step in ("login", "store_emission", "history"):
+        report[step] = summarize([latency for result in results for latency in result[step]], elapsed)
+    return report
+
+def run_size(size, options, directory):
+    # Builds a dataset of `size` trips in directory and benchmarks every path against it
+    storage = open_benchmark_storage(directory, options.storage, options.fsync)
+    rng = random.Random(options.seed)
+    user_count = max(MIN_USERS, int(size * USERS_PER_TRIP))
+    users = synthetic_users(user_count)
+    results = {}
+
+    # Dataset: users through the storage API's bulk signup with one shared hash, trips through bulk import
+    password_hash = vehicalc.get_authenticator().hash(PASSWORD)
+    started = time.perf_counter()
+    for first in range(0, user_count, PRELOAD_CHUNK):
+        storage.add_users([(username, password_hash) for username in users[first:first + PRELOAD_CHUNK]])
+    elapsed = time.perf_counter() - started
+    results["preload_users"] = {"users": user_count, "seconds": round(elapsed, 6),
+                                "throughput_per_s": round(user_count / elapsed, 1) if elapsed else None}
+    trip_file = os.path.join(directory, "trips.csv")
+    write_trip_file(trip_file, users, size, options.seed)
+    started = time.perf_counter()
+    report = vehicalc.import_trips(trip_file, workers=options.import_workers)
+    elapsed = time.perf_counter() - started
+    results["import"] = {"trips": report.imported, "rejected": report.rejected, "seconds": round(elapsed, 6),
+                         "throughput_per_s": round(report.imported / elapsed, 1) if elapsed else None}
+    os.remove(trip_file)
+
+    samples = options.samples
+    trips = [synthetic_trip(rng, rng.choice(users)) for _ in range(samples)]
+    inputs = [(user_input(trip), trip["urban"] == "y") for trip in trips]
+    results["calculate_calculator"] = measure(
+        lambda entry, urban: vehicalc.get_calculator(entry, urban).calculate_carbon_emission(entry), inputs)
+    results["calculate_lookup"] = measure(vehicalc.calculate_emission, inputs)
+    results["signup"] = measure(lambda username: vehicalc.User(username, PASSWORD).save_user(),
+                                [(username,) for username in synthetic_users(samples, "signup")])
+    results["login"] = measure(vehicalc.User.validate_user,
+                               [(rng.choice(users), PASSWORD) for _ in range(samples)])
+    results["store_emission"] = measure(
+        lambda entry, urban: vehicalc.EmissionHistory(entry, vehicalc.calculate_emission(entry, urban),
+                                                      urban).store_emission(), inputs)
+    results["history"] = measure(vehicalc.EmissionHistoryViewer.get_history,
+                                 [(rng.choice(users),) for _ in range(samples)])
+    results["history_range"] = measure(vehicalc.get_storage().get_emission_range,
+                                       [(rng.choice(users), (YEARS[-1], "Jan"), (YEARS[-1], "Dec"))
+                                        for _ in range(samples)])
+    vehicalc.get_storage().close()
+
+    if options.sessions:
+        results["sessions"] = run_sessions(directory, options, users)
+    return {"size": size, "users": user_count, "trips": size, "results": results}
+
+def print_summary(run):
+    print(f"\n== {run['trips']} trips, {run['users']} users ==", file=sys.stderr)
+    for name, result in run["results"].items():
+        if name == "sessions":
+            print(f"{'sessions':<22}{result['sessions']} concurrent, {result['sessions_per_s']} sessions/s",
+                  file=sys.stderr)
+            for step in ("login", "store_emission", "history"):
+                print_line(f"  {step}", result[step])
+        else:
+            print_line(name, result)
+
+def print_line(name, result):
+    if "p50_ms" in result:
+        print(f"{name:<22}{result['ops']:>9} ops {result['throughput_per_s']:>12} /s   p50 {result['p50_ms']:.3f} ms"
+              f"   p95 {result['p95_ms']:.3f} ms   p99 {result['p99_ms']:.3f} ms", file=sys.stderr)
+    elif "trips" in result:
+        print(f"{name:<22}{result['trips']:>9} trips {result['throughput_per_s']:>10} /s", file=sys.stderr)
+    elif "users" in result:
+        print(f"{name:<22}{result['users']:>9} users {result['throughput_per_s']:>10} /s", file=sys.stderr)
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="VehiCalc load test and benchmark suite")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma-separated dataset sizes in trips, e.g. 1000,1000000,10000000")
+    parser.add_argument("--samples", type=int, default=1000, help="operations timed per path")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent simulated sessions (0 to skip)")
+    parser.add_argument("--session-ops", type=int, default=20, help="trips recorded per session")
+    parser.add_argument("--storage", default="csv", help="'csv', 'sqlite:PATH', 'binary[:PATH]' or 'sharded[:BUCKETS]'")
+    parser.add_argument("--fsync", default="always", help="fsync policy, as for main.py")
+    parser.add_argument("--import-workers", type=int, default=1, help="worker processes for the bulk import")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="directory for the datasets (default: a temporary one)")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    return parser
+
+def main(argv=None):
+    options = build_arg_parser().parse_args(argv)
+    try:
+        sizes = [int(size) for size in options.sizes.split(",")]
+    except ValueError:
+        raise ValueError("Sizes must be comma-separated whole numbers")
+    if any(size <= 0 for size in sizes) or options.samples <= 0:
+        raise ValueError("Sizes and samples must be positive")
+    workdir = os.path.abspath(options.workdir or tempfile.mkdtemp(prefix="vehicalc_bench_"))
+
+    results = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "storage": options.storage, "fsync": options.fsync,
+                 "samples": options.samples, "seed": options.seed, "workdir": workdir,
+                 "started": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "runs": [],
+    }
+    context = multiprocessing.get_context("spawn")
+    for size in sizes:
+        directory = os.path.join(workdir, f"size_{size}")
+        os.makedirs(directory, exist_ok=True)
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            run = executor.submit(run_size, size, options, directory).result()
+        print_summary(run)
+        results["runs"].append(run)
+
+    output = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
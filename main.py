@@ -1,14 +1,92 @@
+import argparse
+import asyncio
+import atexit
 import csv
+import gzip
 import hashlib
+import hmac
+import io
+import json
+import math
+import mmap
 import os
+import pickle
+import queue
+import secrets
+import shutil
+import socket
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
 from enum import Enum, auto
+from itertools import compress, islice
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # Constants
 USER_FILE = "users.csv"
 EMISSION_FILE = "emission_history.csv"
+EMISSION_LEDGER_FILE = "emission_ledger.csv"
+EMISSION_MATRIX_FILE = "emission_matrix.bin"
+ANALYTICS_FILE = "fleet_analytics.json"
+EMISSION_FACTOR_FILE = "emission_factors.json"
+TRIP_LOG_DIR = "trip_log"
+VEHICLE_PROFILE_FILE = "vehicle_profiles.csv"
+RECURRING_TRIP_FILE = "recurring_trips.json"
+SHARD_DIR = "shards"
+SHARD_MANIFEST_FILE = "layout.json"
+DEFAULT_SHARD_COUNT = 16  # buckets of a new sharded layout
+MAX_SHARD_COUNT = 4096
+LEDGER_COMPACT_THRESHOLD = 1024 * 1024  # bytes of pending deltas before compaction
+IMPORT_CHUNK_SIZE = 10000  # trips scored per batch during bulk import
+IMPORT_MAX_REJECTS = 100  # rejected rows listed in the import summary
+EXPORT_CHUNK_ROWS = 4096  # report rows per buffered write (and per columnar row group) during export
+EXPORT_BUFFER_SIZE = 1024 * 1024  # bytes of write buffer for export files
+READ_CACHE_MAX_BYTES = 64 * 1024 * 1024  # parsed files kept in memory, by file size
+ANALYTICS_SNAPSHOT_THRESHOLD = 1024 * 1024  # journal bytes before the analytics snapshot is rewritten
+FACTOR_RECHECK_INTERVAL = 1.0  # seconds between checks for emission factor changes by other processes
+PASSWORD_HASH_SCHEME = "pbkdf2_sha256"
+PASSWORD_KDF_ITERATIONS = 200000
+AUTH_WORKERS = 4  # threads running the password KDF
+AUTH_CACHE_TTL = 300.0  # seconds a verified username/password pair skips the KDF
+METRICS_FILE = "vehicalc_metrics.prom"
+METRICS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)  # span histogram bounds, seconds
+INGEST_SPOOL_DIR = "ingest_spool"
+INGEST_BATCH_SIZE = 500  # events per micro-batch
+INGEST_BATCH_WAIT = 0.05  # seconds a micro-batch waits to fill up after its first event
+INGEST_QUEUE_LIMIT = 10000  # queued events before the sources stop reading
+INGEST_POLL_INTERVAL = 0.5  # seconds between scans of an empty spool directory
+INGEST_REPORT_INTERVAL = 10.0  # seconds between status lines and metrics file updates
+INGEST_RETRY_MAX = 5.0  # longest wait, in seconds, between attempts to store a failed batch
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_MAX_BODY = 1024 * 1024  # bytes per request body
+SERVICE_MAX_BATCH = 1000  # requests per /batch call
+SERVICE_LATENCY_WINDOW = 1024  # recent requests per endpoint behind the latency percentiles
+SERVICE_SESSION_TTL = 900.0  # seconds a service login token stays valid after its last use
+SERVICE_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found",
+                   405: "Method Not Allowed", 413: "Payload Too Large", 431: "Request Header Fields Too Large",
+                   500: "Internal Server Error"}
 VALID_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", 
                "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+VALID_MONTH_SET = frozenset(VALID_MONTHS)
+MONTH_INDEX = {month: index for index, month in enumerate(VALID_MONTHS)}
+MIN_YEAR = 1900
 
 class VehicleType(Enum):
     CAR = auto()
@@ -55,7 +133,7 @@ def validate_fuel_efficiency(efficiency):
         return None
     try:
         eff = float(efficiency)
-        if eff <= 0:
+        if eff <= 0 or not math.isfinite(eff):
             raise ValueError("Fuel efficiency must be positive")
         return eff
     except (ValueError, TypeError):
@@ -64,73 +142,1003 @@ def validate_fuel_efficiency(efficiency):
 def validate_distance(distance):
     try:
         dist = float(distance)
-        if dist <= 0:
+        if dist <= 0 or not math.isfinite(dist):
             raise ValueError("Distance must be positive")
         return dist
     except (ValueError, TypeError):
         raise ValueError("Distance must be a positive number")
 
 def validate_month(month):
-    if month not in VALID_MONTHS:
+    if not isinstance(month, str) or month not in VALID_MONTH_SET:
         raise ValueError(f"Invalid month. Must be one of: {VALID_MONTHS}")
     return month
 
-# Utility function to hash passwords
-def hash_password(password):
+def validate_year(year):
+    if year is None or str(year).strip() == "":  # Default to the current year
+        return datetime.now().year
+    try:
+        year = int(str(year).strip())
+    except ValueError:
+        raise ValueError("Year must be a whole number")
+    if not MIN_YEAR <= year <= datetime.now().year:
+        raise ValueError(f"Year must be between {MIN_YEAR} and {datetime.now().year}")
+    return year
+
+# Batch validation: the validate_* checks over whole columns. Each row gets an error code
+# (VALIDATION_OK when valid) instead of an exception, checked in UserInput's order so the
+# first failing field decides the code, and the parsed values come back as columns.
+VALIDATION_OK = 0
+INVALID_USERNAME_EMPTY = 1
+INVALID_USERNAME_LENGTH = 2
+INVALID_USERNAME_CHARS = 3
+INVALID_VEHICLE_TYPE = 4
+INVALID_FUEL_TYPE = 5
+INVALID_FUEL_EFFICIENCY = 6
+INVALID_DISTANCE = 7
+INVALID_MONTH = 8
+INVALID_YEAR = 9
+INVALID_YEAR_RANGE = 10
+
+VALIDATION_MESSAGES = {
+    INVALID_USERNAME_EMPTY: "Username must be a non-empty string",
+    INVALID_USERNAME_LENGTH: "Username must be between 4 and 20 characters",
+    INVALID_USERNAME_CHARS: "Username can only contain letters and numbers",
+    INVALID_VEHICLE_TYPE: f"Invalid vehicle type. Must be one of: {[v.name for v in VehicleType]}",
+    INVALID_FUEL_TYPE: f"Invalid fuel type. Must be one of: {[f.name for f in FuelType]} or empty",
+    INVALID_FUEL_EFFICIENCY: "Fuel efficiency must be a positive number",
+    INVALID_DISTANCE: "Distance must be a positive number",
+    INVALID_MONTH: f"Invalid month. Must be one of: {VALID_MONTHS}",
+    INVALID_YEAR: "Year must be a whole number",
+}
+
+def validation_message(code):
+    # The message the scalar validator raises for the same input
+    if code == INVALID_YEAR_RANGE:
+        return f"Year must be between {MIN_YEAR} and {datetime.now().year}"
+    return VALIDATION_MESSAGES[code]
+
+def parse_positive_number(value):
+    # float(value) if it is a positive finite number, else None; only malformed strings pay for an exception
+    if type(value) is not float:
+        if isinstance(value, (int, float)):
+            value = float(value)
+        elif isinstance(value, (str, bytes)):
+            try:
+                value = float(value)
+            except ValueError:
+                return None
+        else:
+            return None
+    return value if value > 0 and math.isfinite(value) else None
+
+def check_username(username):
+    if not username or not isinstance(username, str):
+        return None, INVALID_USERNAME_EMPTY
+    if not 4 <= len(username) <= 20:
+        return None, INVALID_USERNAME_LENGTH
+    if not username.isalnum():
+        return None, INVALID_USERNAME_CHARS
+    return username, VALIDATION_OK
+
+def check_vehicle_type(vehicle_type):
+    parsed = VehicleType.__members__.get(vehicle_type.upper()) if isinstance(vehicle_type, str) else None
+    return parsed, VALIDATION_OK if parsed is not None else INVALID_VEHICLE_TYPE
+
+def check_fuel_type(fuel_type):
+    if not fuel_type:
+        return None, VALIDATION_OK
+    parsed = FuelType.__members__.get(fuel_type.upper()) if isinstance(fuel_type, str) else None
+    return parsed, VALIDATION_OK if parsed is not None else INVALID_FUEL_TYPE
+
+def check_month(month):
+    if isinstance(month, str) and month in VALID_MONTH_SET:
+        return month, VALIDATION_OK
+    return None, INVALID_MONTH
+
+def check_year(year, current_year=None):
+    current_year = current_year or datetime.now().year
+    if type(year) is not int:
+        text = "" if year is None else str(year).strip()
+        if not text:
+            return current_year, VALIDATION_OK
+        if text.isdecimal():
+            year = int(text)
+        else:
+            try:  # Signs and digit separators, as int() accepts them
+                year = int(text)
+            except ValueError:
+                return 0, INVALID_YEAR
+    if MIN_YEAR <= year <= current_year:
+        return year, VALIDATION_OK
+    return 0, INVALID_YEAR_RANGE
+
+# Checks are run once per distinct value for columns whose values can be safely deduplicated:
+# bools and floats compare equal to ints (True == 1 == 1.0) but do not always validate alike
+DISTINCT_TYPES = frozenset((str, int, type(None)))
+
+def check_column(column, check, errors):
+    # Parsed values of a column; failing rows get the check's code unless an earlier field
+    # already failed. Only failing rows are visited one by one.
+    if set(map(type, column)) <= DISTINCT_TYPES:
+        outcomes = {value: check(value) for value in set(column)}
+        parsed = list(map({value: outcome[0] for value, outcome in outcomes.items()}.__getitem__, column))
+        failing = {value: outcome[1] for value, outcome in outcomes.items() if outcome[1]}
+        if failing:
+            for row in compress(range(len(column)), map(failing.__contains__, column)):
+                errors[row] = errors[row] or failing[column[row]]
+        return parsed
+    outcomes = list(map(check, column))
+    for row, (_, code) in enumerate(outcomes):
+        if code:
+            errors[row] = errors[row] or code
+    return [value for value, _ in outcomes]
+
+def check_positive_column(column, code, errors, optional=False):
+    # Numbers are converted a whole column at a time; a column with malformed entries falls
+    # back to a row by row pass. With optional, None stays None.
+    try:
+        if optional:
+            values = [None if value is None else float(value) for value in column]
+        else:
+            values = array("d", map(float, column))
+    except (TypeError, ValueError):
+        values = [None if optional and value is None else parse_positive_number(value) for value in column]
+        for row in compress(range(len(column)), [value is None and (not optional or raw is not None)
+                                                 for value, raw in zip(values, column)]):
+            errors[row] = errors[row] or code
+        return values if optional else array("d", (value or 0.0 for value in values))
+    if optional:
+        failing = [value is not None and (value <= 0 or not math.isfinite(value)) for value in values]
+    else:
+        failing = [value <= 0 or not math.isfinite(value) for value in values]
+    for row in compress(range(len(column)), failing):
+        errors[row] = errors[row] or code
+        if optional:
+            values[row] = None
+    return values
+
+class BatchValidation:
+    FIELDS = ("usernames", "vehicle_types", "fuel_types", "fuel_efficiencies", "distances", "months", "years")
+
+    def __init__(self, errors, usernames, vehicle_types, fuel_types, fuel_efficiencies, distances, months, years):
+        self.size = len(errors)
+        self.errors = errors  # error code per row, VALIDATION_OK for valid rows
+        self.usernames = usernames
+        self.vehicle_types = vehicle_types
+        self.fuel_types = fuel_types
+        self.fuel_efficiencies = fuel_efficiencies
+        self.distances = distances
+        self.months = months
+        self.years = years
+
+    @property
+    def mask(self):
+        # 1 for valid rows, usable with itertools.compress
+        return bytes(map(VALIDATION_OK.__eq__, self.errors))
+
+    def valid_rows(self):
+        return compress(range(self.size), self.mask)
+
+    def message(self, row):
+        return validation_message(self.errors[row])
+
+    def user_input(self, row):
+        return UserInput.from_validated(*(getattr(self, field)[row] for field in self.FIELDS))
+
+    def user_inputs(self):
+        # (row, UserInput) for every valid row
+        from_validated = UserInput.from_validated
+        rows = zip(range(self.size), *(getattr(self, field) for field in self.FIELDS))
+        for row, username, vehicle, fuel, efficiency, distance, month, year in compress(rows, self.mask):
+            yield row, from_validated(username, vehicle, fuel, efficiency, distance, month, year)
+
+def validate_columns(usernames, vehicle_types, fuel_types, fuel_efficiencies, distances, months, years=None):
+    # Columns hold raw values as UserInput would receive them (years may be omitted for the current year)
+    size = len(usernames)
+    errors = array("B", bytes(size))
+    current_year = datetime.now().year
+    return BatchValidation(
+        errors,
+        check_column(usernames, check_username, errors),
+        check_column(vehicle_types, check_vehicle_type, errors),
+        check_column(fuel_types, check_fuel_type, errors),
+        check_positive_column(fuel_efficiencies, INVALID_FUEL_EFFICIENCY, errors, optional=True),
+        check_positive_column(distances, INVALID_DISTANCE, errors),
+        check_column(months, check_month, errors),
+        check_column(years if years is not None else [None] * size,
+                     lambda year: check_year(year, current_year), errors))
+
+# History is keyed by (year, month); a period is a (year, month) pair
+def parse_period(text):
+    # Accepts "Mar 2025" or "2025-03"
+    value = str(text or "").strip()
+    try:
+        if "-" in value:
+            year, month = value.split("-", 1)
+            month = VALID_MONTHS[int(month) - 1] if month.isdigit() and 1 <= int(month) <= 12 else ""
+        else:
+            month, year = value.split()
+        return validate_year(year), validate_month(month.capitalize())
+    except ValueError:
+        raise ValueError(f"Invalid period '{value}'. Use 'Mon YYYY' (e.g. Mar 2025) or 'YYYY-MM'")
+
+def period_index(year, month):
+    # Months since year 0, so periods compare and subtract like numbers
+    return year * 12 + MONTH_INDEX[month]
+
+def partition_path(path, year):
+    # emission_history.csv -> emission_history_2025.csv
+    root, extension = os.path.splitext(path)
+    return f"{root}_{year}{extension}"
+
+def partition_years(path, suffixes=("",)):
+    # Years that have a partition of path on disk (any of the given suffixes), oldest first
+    root, extension = os.path.splitext(path)
+    directory = os.path.dirname(root) or "."
+    prefix = os.path.basename(root) + "_"
+    years = set()
+    if not os.path.isdir(directory):
+        return []
+    for name in os.listdir(directory):
+        if not name.startswith(prefix):
+            continue
+        year, _, rest = name[len(prefix):].partition(".")
+        if year.isdigit() and "." + rest in [extension + suffix for suffix in suffixes]:
+            years.add(int(year))
+    return sorted(years)
+
+# Utility functions to hash and check passwords. New hashes are salted PBKDF2-SHA256,
+# stored as "pbkdf2_sha256$iterations$salt$hash"; older accounts have a bare SHA-256 hex digest.
+def hash_password(password, salt=None, iterations=PASSWORD_KDF_ITERATIONS):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{PASSWORD_HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+def legacy_hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
+def verify_password(password, stored_hash):
+    # (matches, needs_rehash); runs the KDF at most once
+    scheme, _, rest = stored_hash.partition("$")
+    if scheme != PASSWORD_HASH_SCHEME:
+        return hmac.compare_digest(stored_hash, legacy_hash_password(password)), True
+    try:
+        iterations, salt, digest = rest.split("$")
+        iterations, salt = int(iterations), bytes.fromhex(salt)
+    except ValueError:
+        return False, False
+    computed = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations).hex()
+    return hmac.compare_digest(computed, digest), iterations < PASSWORD_KDF_ITERATIONS
+
+# Advisory lock on a sidecar .lock file, shared by threads and processes
+class InterProcessLock:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()  # Makes the lock re-entrant within a thread
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open(self.path, "a+b")
+                self._acquire_os_lock(self._file)
+            except Exception:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                self._release_os_lock(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+        self._lock.release()
+        return False
+
+    @staticmethod
+    def _acquire_os_lock(file):
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            return
+        while True:
+            try:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                continue  # LK_LOCK gives up after ~10 s; keep waiting
+
+    @staticmethod
+    def _release_os_lock(file):
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+_file_locks = {}
+_file_locks_guard = threading.Lock()
+
+def file_lock(path):
+    # One lock object per data file so nested use in a thread does not deadlock
+    lock_path = os.path.abspath(path) + ".lock"
+    with _file_locks_guard:
+        lock = _file_locks.get(lock_path)
+        if lock is None:
+            lock = _file_locks[lock_path] = InterProcessLock(lock_path)
+        return lock
+
+# Queues concurrent writes so a single flusher applies them in one batch
+class GroupCommitter:
+    def __init__(self, flush):
+        self._flush = flush  # Called with a list of items, in submission order
+        self._condition = threading.Condition()
+        self._pending = []
+        self._flushing = False
+        self._next_ticket = 0
+        self._completed = 0
+        self._errors = {}
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, item):
+        # Returns once item has been flushed, by this thread or another one
+        with self._condition:
+            self._next_ticket += 1
+            ticket = self._next_ticket
+            self._pending.append(item)
+            while self._completed < ticket and self._flushing:
+                self._condition.wait()
+            if self._completed >= ticket:
+                error = self._errors.pop(ticket, None)
+                if error is not None:
+                    raise error
+                return
+            # This thread becomes the flusher for everything queued so far
+            batch, self._pending = self._pending, []
+            last_ticket = self._next_ticket
+            self._flushing = True
+
+        error = None
+        try:
+            self._flush(batch)
+        except Exception as e:
+            error = e
+        with self._condition:
+            if error is not None:
+                for waiting in range(self._completed + 1, last_ticket + 1):
+                    if waiting != ticket:
+                        self._errors[waiting] = error
+            self._completed = last_ticket
+            self._flushing = False
+            self.batches += 1
+            self.items += len(batch)
+            self._condition.notify_all()
+        if error is not None:
+            raise error
+
+# Durability helpers: temp-file + rename rewrites and a configurable fsync policy for appends
+class FsyncPolicy:
+    # "always", "every:N" (every N appends to a file), "interval:MS", or "never"
+    def __init__(self, spec="always"):
+        self.spec = spec
+        mode, _, value = spec.partition(":")
+        try:
+            self.mode = mode
+            self.every = int(value) if mode == "every" else 1
+            self.interval = float(value) / 1000 if mode == "interval" else 0.0
+        except ValueError:
+            raise ValueError(f"Invalid fsync policy '{spec}'")
+        if mode not in ("always", "every", "interval", "never") or self.every <= 0 or self.interval < 0:
+            raise ValueError(f"Invalid fsync policy '{spec}'. Use always, every:N, interval:MS or never")
+        self.syncs = 0
+        self._unsynced = {}  # path -> appends since its last fsync
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def should_sync(self, path):
+        # Counts one write to path; True when the policy wants it on disk now
+        if self.mode == "never":
+            return False
+        path = os.path.abspath(path)
+        with self._lock:
+            count = self._unsynced.get(path, 0) + 1
+            if self.mode == "every" and count < self.every:
+                self._unsynced[path] = count
+                return False
+            if self.mode == "interval" and time.monotonic() - self._last_sync < self.interval:
+                self._unsynced[path] = count
+                self._start_flusher()
+                return False
+            if self.mode == "interval":
+                self._last_sync = time.monotonic()  # The next interval starts with this sync
+            self._unsynced.pop(path, None)
+        self.syncs += 1
+        return True
+
+    def after_append(self, file):
+        # Call with the appended file still open
+        file.flush()
+        if self.should_sync(file.name):
+            os.fsync(file.fileno())
+
+    def sync_pending(self):
+        # fsync every file that still has appends not yet on disk
+        with self._lock:
+            paths, self._unsynced = list(self._unsynced), {}
+            self._last_sync = time.monotonic()
+        for path in paths:
+            try:
+                with open(path, "rb") as file:  # "ab" would recreate a file compacted away
+                    os.fsync(file.fileno())
+                self.syncs += 1
+            except FileNotFoundError:
+                pass  # Renamed or compacted away since the append
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(self.interval)
+                self.sync_pending()
+
+        self._flusher = threading.Thread(target=run, name="fsync-flusher", daemon=True)
+        self._flusher.start()
+
+FSYNC_POLICY = FsyncPolicy(os.environ.get("VEHICALC_FSYNC", "always"))
+atexit.register(lambda: FSYNC_POLICY.sync_pending())
+
+def set_fsync_policy(spec):
+    global FSYNC_POLICY
+    FSYNC_POLICY.sync_pending()
+    FSYNC_POLICY = FsyncPolicy(spec)
+    return FSYNC_POLICY
+
+def fsync_directory(path):
+    # Makes a rename durable; not supported (or needed) on Windows
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except (OSError, AttributeError):
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_temp_file(path, write):
+    # Writes path + ".tmp" through write(file) and fsyncs it; the caller renames it into place
+    temp_file = path + ".tmp"
+    with open(temp_file, "w", newline="") as file:
+        write(file)
+        file.flush()
+        os.fsync(file.fileno())
+    return temp_file
+
+def atomic_write(path, write):
+    # Readers and crashes see either the old file or the complete new one
+    temp_file = write_temp_file(path, write)
+    if METRICS.enabled:
+        METRICS.count("bytes_written", os.path.getsize(temp_file), file=os.path.basename(path))
+    os.replace(temp_file, path)
+    fsync_directory(path)
+
+def trim_partial_line(file):
+    # Drops a partial last line left by a crash mid-append from a file opened "rb+"/"ab+";
+    # returns the number of bytes removed
+    size = file.seek(0, os.SEEK_END)
+    if size == 0:
+        return 0
+    file.seek(size - 1)
+    if file.read(1) == b"\n":
+        return 0
+    keep = 0
+    end = size
+    while end > 0:
+        start = max(0, end - 65536)
+        file.seek(start)
+        newline = file.read(end - start).rfind(b"\n")
+        if newline != -1:
+            keep = start + newline + 1
+            break
+        end = start
+    file.truncate(keep)
+    file.flush()
+    os.fsync(file.fileno())
+    return size - keep
+
+def truncate_torn_tail(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as file:
+        return trim_partial_line(file)
+
+# Process-level cache of parsed files, invalidated when a file's mtime, size or inode changes
+class FileCache:
+    def __init__(self, max_bytes=READ_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0  # files too large to cache
+        self.evictions = 0
+        self._entries = OrderedDict()  # (path, loader) -> (signature, size, value)
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def get(self, path, loader, large=None):
+        # Parsed contents of path via loader(path). A file over max_bytes is read straight through
+        # with large(path) (or loader) and not cached; a missing file raises FileNotFoundError.
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        key = (os.path.abspath(path), loader)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if stat.st_size > self.max_bytes:
+                self.skipped += 1
+                return (large or loader)(path)
+            self.misses += 1
+            value = loader(path)
+            if entry is not None:
+                self._size -= entry[1]
+            self._entries[key] = (signature, stat.st_size, value)
+            self._entries.move_to_end(key)
+            self._size += stat.st_size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, (_, size, _) = self._entries.popitem(last=False)
+                self._size -= size
+                self.evictions += 1
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "skipped": self.skipped,
+                    "evictions": self.evictions, "entries": len(self._entries), "bytes": self._size}
+
+FILE_CACHE = FileCache()
+
+# Timing spans and counters for the hot paths, dumped in the Prometheus text format.
+# Disabled by default: span() then hands back one shared no-op context and count()
+# returns straight away, so instrumented code pays a single attribute check.
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.spans = {}  # name -> [count, total seconds, per-bucket counts]
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> last value
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def enable(self, path=METRICS_FILE):
+        self.enabled = True
+        self.path = path
+        if not self._registered:
+            atexit.register(self.dump)
+            self._registered = True
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return MetricsSpan(self, name)
+
+    def observe(self, name, seconds):
+        with self._lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = [0, 0.0, [0] * len(METRICS_BUCKETS)]
+            stats[0] += 1
+            stats[1] += seconds
+            buckets = stats[2]
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+                    break
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @staticmethod
+    def format_labels(labels):
+        return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}" if labels else ""
+
+    def render(self):
+        lines = []
+        with self._lock:
+            if self.spans:
+                lines += ["# HELP vehicalc_span_seconds Time spent in each instrumented stage",
+                          "# TYPE vehicalc_span_seconds histogram"]
+            for name, (count, total, buckets) in sorted(self.spans.items()):
+                cumulative = 0
+                for bound, hits in zip(METRICS_BUCKETS, buckets):
+                    cumulative += hits
+                    lines.append(f'vehicalc_span_seconds_bucket{{span="{name}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'vehicalc_span_seconds_bucket{{span="{name}",le="+Inf"}} {count}')
+                lines.append(f'vehicalc_span_seconds_sum{{span="{name}"}} {total!r}')
+                lines.append(f'vehicalc_span_seconds_count{{span="{name}"}} {count}')
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                counters.setdefault(name, []).append((labels, value))
+            gauges = {}
+            for (name, labels), value in self.gauges.items():
+                gauges.setdefault(name, []).append((labels, value))
+        # The read cache keeps its own tallies; exported here so lookups stay uninstrumented
+        cache = FILE_CACHE.stats()
+        for name in ("hits", "misses", "evictions"):
+            counters[f"file_cache_{name}"] = [((), cache[name])]
+        for name, samples in sorted(counters.items()):
+            lines.append(f"# TYPE vehicalc_{name}_total counter")
+            lines += [f"vehicalc_{name}_total{self.format_labels(labels)} {value}" for labels, value in sorted(samples)]
+        for name, samples in sorted(gauges.items()):
+            lines.append(f"# TYPE vehicalc_{name} gauge")
+            lines += [f"vehicalc_{name}{self.format_labels(labels)} {value!r}" for labels, value in sorted(samples)]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=None):
+        path = path or self.path
+        if path:
+            text = self.render()
+            atomic_write(path, lambda file: file.write(text))
+
+class MetricsSpan:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+        return False
+
+NULL_SPAN = nullcontext()
+METRICS = Metrics()
+
+@contextmanager
+def profile_capture(profile_path=None, tracemalloc_top=0):
+    # Opt-in cProfile and tracemalloc capture around a block; the profile is written to
+    # profile_path (readable with pstats) and the top allocation sites are printed
+    profiler = None
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+    if tracemalloc_top:
+        import tracemalloc
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            print(f"Profile written to {profile_path}")
+        if tracemalloc_top:
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "*/cProfile.py")])
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"\nMemory: {current / 1024:.1f} KiB current, {peak / 1024:.1f} KiB peak")
+            for stat in snapshot.statistics("lineno")[:tracemalloc_top]:
+                print(stat)
+
+# Persistent username -> byte offset index kept next to a users file
+class UserIndex:
+    HEADER_FORMAT = "VIDX1 {size:020d} {mtime:020d}\n"
+    HEADER_SIZE = len(HEADER_FORMAT.format(size=0, mtime=0))
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, user_file=USER_FILE):
+        self.user_file = user_file
+        self._offsets = {}
+        self._signature = None
+
+    @classmethod
+    def for_file(cls, user_file=USER_FILE):
+        # One shared index per users file, so every storage over it sees the same offsets. Keyed
+        # and opened by absolute path: a relative one would follow later working-directory changes.
+        user_file = os.path.abspath(user_file)
+        with cls._instances_lock:
+            index = cls._instances.get(user_file)
+            if index is None:
+                index = cls._instances[user_file] = cls(user_file)
+            return index
+
+    def index_file(self):
+        return self.user_file + ".idx"
+
+    def _csv_signature(self):
+        stat = os.stat(self.user_file)
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def _parse_row(line):
+        return next(csv.reader([line.decode("utf-8").rstrip("\r\n")]), [])
+
+    def _load(self):
+        # Returns the offset map for the current users file, rebuilding it if stale
+        signature = self._csv_signature()
+        if self._signature == signature:
+            return self._offsets
+
+        index_file = self.index_file()
+        if os.path.exists(index_file):
+            with open(index_file, "r", newline="") as file:
+                header = file.readline().split()
+                if len(header) == 3 and header[0] == "VIDX1" and (int(header[1]), int(header[2])) == signature:
+                    offsets = {}
+                    for line in file:
+                        username, _, offset = line.rstrip("\n").rpartition(",")
+                        offsets.setdefault(username, int(offset))
+                    self._offsets, self._signature = offsets, signature
+                    return offsets
+        return self.rebuild()
+
+    def rebuild(self):
+        with file_lock(self.user_file):
+            offsets = {}
+            with open(self.user_file, "rb") as file:
+                file.readline()  # Skip the header row
+                offset = file.tell()
+                for line in iter(file.readline, b""):
+                    row = self._parse_row(line)
+                    if row:
+                        offsets.setdefault(row[0], offset)
+                    offset = file.tell()
+            METRICS.count("rows_scanned", len(offsets), file=self.user_file)
+            signature = self._csv_signature()
+
+            def write(file):
+                file.write(self.HEADER_FORMAT.format(size=signature[0], mtime=signature[1]))
+                file.writelines(f"{username},{offset}\n" for username, offset in offsets.items())
+
+            atomic_write(self.index_file(), write)
+            self._offsets, self._signature = offsets, signature
+            return offsets
+
+    def lookup(self, username):
+        # Stored row for username, or None; reads a single line of the users file
+        with file_lock(self.user_file):
+            if not os.path.exists(self.user_file):
+                return None
+            for attempt in range(2):
+                offset = self._load().get(username)
+                if offset is None:
+                    return None
+                with open(self.user_file, "rb") as file:
+                    file.seek(offset)
+                    row = self._parse_row(file.readline())
+                if row and row[0] == username:
+                    return row
+                # Offset points at the wrong row, so the index is stale
+                self.rebuild()
+            return None
+
+    def add(self, username, password_hash):
+        self.add_many([(username, password_hash)])
+
+    def add_many(self, users):
+        # Appends every (username, password hash) row in one write
+        with file_lock(self.user_file):
+            # Only keep the index up to date if it is already loaded; otherwise
+            # the size change marks it stale and the next lookup rebuilds it
+            is_current = os.path.exists(self.user_file) and self._signature == self._csv_signature()
+            lines = []
+            for username, password_hash in users:
+                line = io.StringIO()
+                csv.writer(line).writerow([username, password_hash])
+                lines.append((username, line.getvalue().encode("utf-8")))
+            with open(self.user_file, "ab+") as file:
+                trim_partial_line(file)  # Never extend another writer's torn row
+                offset = file.seek(0, os.SEEK_END)
+                offsets = []
+                for username, line in lines:
+                    offsets.append((username, offset))
+                    offset += len(line)
+                file.write(b"".join(line for _, line in lines))
+                FSYNC_POLICY.after_append(file)
+            if not is_current:
+                return
+            for username, offset in offsets:
+                self._offsets.setdefault(username, offset)
+
+            index_file = self.index_file()
+            with open(index_file, "a", newline="") as file:
+                file.writelines(f"{username},{offset}\n" for username, offset in offsets)
+            # The header is updated last so an interrupted add forces a rebuild
+            signature = self._csv_signature()
+            with open(index_file, "r+", newline="") as file:
+                file.write(self.HEADER_FORMAT.format(size=signature[0], mtime=signature[1]))
+            self._signature = signature
+
 # User authentication class with enhanced validation
 class User:
-    def __init__(self, username, password):
+    def __init__(self, username, password, password_hash=None):
+        # password_hash: already computed off the caller's thread, e.g. by Authenticator.hash_async
         self.username = validate_username(username)
-        self.password = hash_password(validate_password(password))
+        password = validate_password(password)
+        self.password = password_hash if password_hash is not None else get_authenticator().hash(password)
 
     def save_user(self):
         try:
-            if not os.path.exists(USER_FILE):
-                with open(USER_FILE, "w", newline="") as file:
-                    writer = csv.writer(file)
-                    writer.writerow(["username", "password"])
-            
-            # Check if username already exists
-            if os.path.exists(USER_FILE):
-                with open(USER_FILE, "r") as file:
-                    reader = csv.DictReader(file)
-                    for row in reader:
-                        if row["username"] == self.username:
-                            raise ValueError("Username already exists")
-
-            with open(USER_FILE, "a", newline="") as file:
-                writer = csv.writer(file)
-                writer.writerow([self.username, self.password])
-                
+            get_storage().add_user(self.username, self.password)
         except IOError as e:
             raise IOError(f"Failed to save user: {str(e)}")
 
     @staticmethod
     def validate_user(username, password):
         try:
-            if not os.path.exists(USER_FILE):
-                return False
-            
-            with open(USER_FILE, "r") as file:
-                reader = csv.DictReader(file)
-                for row in reader:
-                    if row["username"] == username and row["password"] == hash_password(password):
-                        return True
-            return False
+            return get_authenticator().verify(username, password)
         except IOError as e:
             raise IOError(f"Failed to validate user: {str(e)}")
 
+# Password checks for User.validate_user and the service. The KDF runs at most once per
+# attempt, on its own thread pool so one login never holds up another; a username/password
+# pair verified within the last AUTH_CACHE_TTL seconds skips it, and a legacy SHA-256 hash
+# is replaced by a PBKDF2 one after a successful login.
+class Authenticator:
+    def __init__(self, ttl=AUTH_CACHE_TTL, workers=AUTH_WORKERS):
+        self.ttl = ttl
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vehicalc-auth")
+        self._secret = os.urandom(32)  # Cache entries are keyed with it and die with the process
+        self._verified = {}  # username -> (expires at, fingerprint of stored hash and password)
+        self._lock = threading.Lock()
+
+    def fingerprint(self, stored_hash, password):
+        return hmac.new(self._secret, f"{stored_hash}\0{password}".encode(), hashlib.sha256).digest()
+
+    def cached(self, username, stored_hash, password):
+        # The stored hash is part of the fingerprint, so a changed hash never matches
+        with self._lock:
+            entry = self._verified.get(username)
+        if entry is None or entry[0] < time.monotonic():
+            return False
+        if hmac.compare_digest(entry[1], self.fingerprint(stored_hash, password)):
+            METRICS.count("auth_cache_hits")
+            return True
+        return False
+
+    def remember(self, username, stored_hash, password):
+        fingerprint = self.fingerprint(stored_hash, password)
+        with self._lock:
+            now = time.monotonic()
+            if len(self._verified) > 10000:
+                self._verified = {name: entry for name, entry in self._verified.items() if entry[0] >= now}
+            self._verified[username] = (now + self.ttl, fingerprint)
+
+    def forget(self, username=None):
+        with self._lock:
+            if username is None:
+                self._verified.clear()
+            else:
+                self._verified.pop(username, None)
+
+    @staticmethod
+    def check(password, stored_hash):
+        # The blocking part, run on the pool: (matches, replacement hash or None)
+        with METRICS.span("login.hash"):
+            METRICS.count("password_kdf_runs")
+            matches, needs_rehash = verify_password(password, stored_hash)
+            if matches and needs_rehash:
+                # A legacy hash is checked with plain SHA-256, so this is still the one KDF run
+                return True, hash_password(password)
+            return matches, None
+
+    def hash(self, password):
+        # New hashes run on the same pool as checks, so signups never run the KDF on the caller's thread
+        return self.pool.submit(hash_password, password).result()
+
+    async def hash_async(self, password):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, hash_password, password)
+
+    def finish(self, username, password, stored_hash, matches, new_hash, storage):
+        if not matches:
+            return False
+        if new_hash is not None:
+            try:
+                storage.update_password_hash(username, new_hash)
+                stored_hash = new_hash
+                METRICS.count("password_hash_upgrades")
+            except Exception as e:
+                print(f"Warning: password hash for {username} not upgraded: {str(e)}", file=sys.stderr)
+        self.remember(username, stored_hash, password)
+        return True
+
+    def verify(self, username, password):
+        storage = get_storage()
+        with METRICS.span("login.lookup"):
+            stored_hash = storage.get_password_hash(username)
+        if stored_hash is None:
+            return False
+        if self.cached(username, stored_hash, password):
+            return True
+        matches, new_hash = self.pool.submit(self.check, password, stored_hash).result()
+        return self.finish(username, password, stored_hash, matches, new_hash, storage)
+
+    async def verify_async(self, username, password, run_storage):
+        # Same as verify for the event loop: storage calls go through run_storage, the KDF to the pool
+        storage = get_storage()
+        stored_hash = await run_storage(storage.get_password_hash, username)
+        if stored_hash is None:
+            return False
+        if self.cached(username, stored_hash, password):
+            return True
+        matches, new_hash = await asyncio.get_running_loop().run_in_executor(self.pool, self.check, password,
+                                                                             stored_hash)
+        if matches and new_hash is not None:
+            return await run_storage(self.finish, username, password, stored_hash, matches, new_hash, storage)
+        return self.finish(username, password, stored_hash, matches, None, storage)
+
+_authenticator = None
+
+def get_authenticator():
+    global _authenticator
+    if _authenticator is None:
+        _authenticator = Authenticator()
+    return _authenticator
+
 # Enhanced UserInput class with validation
 class UserInput:
-    def __init__(self, username, vehicle_type, fuel_type, fuel_efficiency, distance_travelled, emission_month):
+    def __init__(self, username, vehicle_type, fuel_type, fuel_efficiency, distance_travelled, emission_month,
+                 emission_year=None):
         self.username = validate_username(username)
         self.vehicle_type = validate_vehicle_type(vehicle_type)
         self.fuel_type = validate_fuel_type(fuel_type)
         self.fuel_efficiency = validate_fuel_efficiency(fuel_efficiency)
         self.distance_travelled = validate_distance(distance_travelled)
         self.emission_month = validate_month(emission_month)
+        self.emission_year = validate_year(emission_year)
+
+    @classmethod
+    def from_validated(cls, username, vehicle_type, fuel_type, fuel_efficiency, distance_travelled, emission_month,
+                       emission_year):
+        # For values that already passed validation (e.g. a BatchValidation row): no checks are re-run
+        user_input = cls.__new__(cls)
+        user_input.username = username
+        user_input.vehicle_type = vehicle_type
+        user_input.fuel_type = fuel_type
+        user_input.fuel_efficiency = fuel_efficiency
+        user_input.distance_travelled = distance_travelled
+        user_input.emission_month = emission_month
+        user_input.emission_year = emission_year
+        return user_input
 
     def validate(self):
         # Fuel-based calculation requires both fuel type and efficiency
@@ -139,15 +1147,18 @@ class UserInput:
         if self.fuel_efficiency and not self.fuel_type:
             raise ValueError("Fuel type required when fuel efficiency is specified")
 
-# Carbon Footprint Calculator classes with error handling
+# Carbon Footprint Calculator classes with error handling. A calculator holds no per-trip
+# state, so get_calculator shares one instance per vehicle type and calculation mode.
 class CarbonFootprintCalculator:
-    def __init__(self, user_input):
+    def __init__(self, vehicle_type):
+        self.vehicle_type = vehicle_type
+
+    @staticmethod
+    def check_input(user_input):
         if not isinstance(user_input, UserInput):
             raise TypeError("user_input must be an instance of UserInput")
-        self.user_input = user_input
-        self.carbon_emission = 0
 
-    def calculate_carbon_emission(self):
+    def calculate_carbon_emission(self, user_input):
         raise NotImplementedError("Subclasses must implement this method")
 
 class FuelBasedCalculator(CarbonFootprintCalculator):
@@ -156,18 +1167,18 @@ class FuelBasedCalculator(CarbonFootprintCalculator):
         FuelType.DIESEL: 2.68
     }
     
-    def calculate_carbon_emission(self):
+    def calculate_carbon_emission(self, user_input):
         try:
-            if not self.user_input.fuel_type or not self.user_input.fuel_efficiency:
+            self.check_input(user_input)
+            if not user_input.fuel_type or not user_input.fuel_efficiency:
                 raise ValueError("Both fuel type and efficiency are required for fuel-based calculation")
             
-            fuel_used = self.user_input.distance_travelled / self.user_input.fuel_efficiency
-            emission_factor = self.EMISSION_FACTORS.get(self.user_input.fuel_type)
-            if emission_factor is None:
-                raise ValueError(f"No emission factor available for fuel type: {self.user_input.fuel_type}")
+            fuel_used = user_input.distance_travelled / user_input.fuel_efficiency
+            emission_factor = get_factor_table().lookup().factor(self.vehicle_type, user_input.fuel_type)
+            if emission_factor != emission_factor:  # NaN: no factor in the table
+                raise ValueError(f"No emission factor available for fuel type: {user_input.fuel_type}")
             
-            self.carbon_emission = fuel_used * emission_factor
-            return self.carbon_emission
+            return fuel_used * emission_factor
         except ZeroDivisionError:
             raise ValueError("Fuel efficiency cannot be zero")
         except Exception as e:
@@ -176,10 +1187,10 @@ class FuelBasedCalculator(CarbonFootprintCalculator):
 class DistanceBasedCalculator(CarbonFootprintCalculator):
     AVERAGE_EMISSION_FACTOR = 0.21  # kg CO₂ per km
     
-    def calculate_carbon_emission(self):
+    def calculate_carbon_emission(self, user_input):
         try:
-            self.carbon_emission = self.user_input.distance_travelled * self.AVERAGE_EMISSION_FACTOR
-            return self.carbon_emission
+            self.check_input(user_input)
+            return user_input.distance_travelled * get_factor_table().lookup().factor(self.vehicle_type)
         except Exception as e:
             raise ValueError(f"Error in distance-based calculation: {str(e)}")
 
@@ -187,14 +1198,226 @@ class UrbanAdjustmentCalculator(CarbonFootprintCalculator):
     ADJUSTMENT_FACTOR = 1.2
     EMISSION_FACTOR = 0.21  # kg CO₂ per km
     
-    def calculate_carbon_emission(self):
+    def calculate_carbon_emission(self, user_input):
         try:
-            adjusted_distance = self.user_input.distance_travelled * self.ADJUSTMENT_FACTOR
-            self.carbon_emission = adjusted_distance * self.EMISSION_FACTOR
-            return self.carbon_emission
+            self.check_input(user_input)
+            lookup = get_factor_table().lookup()
+            index = lookup.index(self.vehicle_type, None, True)
+            adjusted_distance = user_input.distance_travelled * lookup.adjustments[index]
+            return adjusted_distance * lookup.factors[index]
         except Exception as e:
             raise ValueError(f"Error in urban-adjusted calculation: {str(e)}")
 
+# One factor version flattened into arrays indexed by (vehicle type, fuel type or none for
+# per-km scoring, urban mode). The urban adjustment applies to the distance first, as in the
+# original calculator, so scoring is distance * adjustment * factor (the adjustment is 1.0
+# outside urban mode, which leaves those results unchanged).
+class EmissionFactorLookup:
+    FUEL_SLOTS = len(FuelType) + 1  # slot 0: distance-based
+    VEHICLE_STRIDE = FUEL_SLOTS * 2
+
+    def __init__(self, factors):
+        nan = float("nan")
+        self.factors = array("d", [nan]) * (len(VehicleType) * self.VEHICLE_STRIDE)
+        self.adjustments = array("d", [1.0]) * len(self.factors)
+        for vehicle_type in VehicleType:
+            resolved = EmissionFactorTable.vehicle_factors(factors, vehicle_type)
+            self.factors[self.index(vehicle_type, None, False)] = resolved["distance"]
+            self.factors[self.index(vehicle_type, None, True)] = resolved["urban"]
+            self.adjustments[self.index(vehicle_type, None, True)] = resolved["urban_adjustment"]
+            for fuel_type in FuelType:
+                # Urban mode does not change fuel-based results
+                value = resolved["fuel"].get(fuel_type.name, nan)
+                self.factors[self.index(vehicle_type, fuel_type, False)] = value
+                self.factors[self.index(vehicle_type, fuel_type, True)] = value
+
+    @classmethod
+    def index(cls, vehicle_type, fuel_type=None, urban_mode=False):
+        return ((vehicle_type.value - 1) * cls.VEHICLE_STRIDE + (fuel_type.value * 2 if fuel_type else 0)
+                + (1 if urban_mode else 0))
+
+    def factor(self, vehicle_type, fuel_type=None, urban_mode=False):
+        # kg CO₂ per litre with a fuel type, otherwise per km (urban adjustment included)
+        index = self.index(vehicle_type, fuel_type, urban_mode)
+        return self.adjustments[index] * self.factors[index]
+
+    def calculate(self, user_input, urban_mode=False):
+        # Same dispatch as get_calculator: fuel-based when both fuel type and efficiency are known
+        if user_input.fuel_type and user_input.fuel_efficiency:
+            return (user_input.distance_travelled / user_input.fuel_efficiency
+                    * self.factors[self.index(user_input.vehicle_type, user_input.fuel_type)])
+        index = self.index(user_input.vehicle_type, None, urban_mode)
+        return user_input.distance_travelled * self.adjustments[index] * self.factors[index]
+
+# Versioned emission factors. Version 1 is the calculators' built-in constants; later
+# versions, and which one new trips are scored with, live in EMISSION_FACTOR_FILE.
+# A version may override any factor per vehicle type under "vehicles".
+class EmissionFactorTable:
+    SCALARS = ("distance", "urban_adjustment", "urban")
+    _builtin = None
+
+    def __init__(self, path=EMISSION_FACTOR_FILE):
+        self.path = path
+        self._lookups = {}  # version -> (factors, EmissionFactorLookup)
+        self._cached_state = None
+        self._checked = 0.0
+
+    @classmethod
+    def builtin(cls):
+        if cls._builtin is None:
+            cls._builtin = {
+                "fuel": {fuel_type.name: factor for fuel_type, factor in FuelBasedCalculator.EMISSION_FACTORS.items()},
+                "distance": DistanceBasedCalculator.AVERAGE_EMISSION_FACTOR,
+                "urban_adjustment": UrbanAdjustmentCalculator.ADJUSTMENT_FACTOR,
+                "urban": UrbanAdjustmentCalculator.EMISSION_FACTOR,
+            }
+        return cls._builtin
+
+    @staticmethod
+    def vehicle_factors(factors, vehicle_type):
+        # The version's factors with the vehicle type's overrides applied
+        override = factors.get("vehicles", {}).get(vehicle_type.name, {})
+        resolved = {name: override.get(name, factors[name]) for name in EmissionFactorTable.SCALARS}
+        resolved["fuel"] = dict(factors["fuel"], **override.get("fuel", {}))
+        return resolved
+
+    @staticmethod
+    def load_file(path):
+        with open(path, "r") as file:
+            state = json.load(file)
+        return {"current": int(state["current"]),
+                "versions": {int(version): factors for version, factors in state["versions"].items()}}
+
+    def _state(self, fresh=False):
+        # Re-checks the file at most every FACTOR_RECHECK_INTERVAL so scoring a trip
+        # does not cost a stat call; writers always pass fresh=True
+        now = time.monotonic()
+        if fresh or self._cached_state is None or now - self._checked >= FACTOR_RECHECK_INTERVAL:
+            try:
+                self._cached_state = FILE_CACHE.get(self.path, self.load_file)
+            except FileNotFoundError:
+                self._cached_state = {"current": 1, "versions": {}}
+            self._checked = now
+        return self._cached_state
+
+    def versions(self):
+        versions = {1: self.builtin()}
+        versions.update(self._state()["versions"])
+        return versions
+
+    def current_version(self):
+        return self._state()["current"]
+
+    def get(self, version=None):
+        version = self.current_version() if version is None else version
+        factors = self.versions().get(version)
+        if factors is None:
+            raise ValueError(f"Unknown emission factor version: {version}")
+        return factors
+
+    def lookup(self, version=None):
+        # Precomputed lookup for a version (the current one by default), rebuilt only
+        # when the factor file changes
+        state = self._state()
+        version = state["current"] if version is None else version
+        factors = self.builtin() if version == 1 else state["versions"].get(version)
+        if factors is None:
+            raise ValueError(f"Unknown emission factor version: {version}")
+        cached = self._lookups.get(version)
+        if cached is None or cached[0] is not factors:
+            cached = self._lookups[version] = (factors, EmissionFactorLookup(factors))
+        return cached[1]
+
+    def _write(self, state):
+        state = {"current": state["current"],
+                 "versions": {str(version): factors for version, factors in state["versions"].items()}}
+        atomic_write(self.path, lambda file: json.dump(state, file, indent=2))
+        self._cached_state = None
+
+    def add(self, changes):
+        # New version = current factors with changes applied; it becomes the version new
+        # trips are scored with. Keys are a fuel type or scalar ("GASOLINE", "distance"),
+        # optionally for one vehicle type ("VAN.distance", "MOTORCYCLE.GASOLINE").
+        with file_lock(self.path):
+            state = self._state(fresh=True)
+            factors = json.loads(json.dumps(self.get(state["current"])))
+            for name, value in changes.items():
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    value = -1.0
+                if not 0 < value < float("inf"):
+                    raise ValueError(f"Emission factor {name} must be a positive number")
+                vehicle, _, key = name.rpartition(".")
+                target = factors
+                if vehicle:
+                    if vehicle.upper() not in VehicleType.__members__:
+                        raise ValueError(f"Invalid vehicle type in '{name}'. Must be one of: {[v.name for v in VehicleType]}")
+                    target = factors.setdefault("vehicles", {}).setdefault(vehicle.upper(), {})
+                if key.upper() in FuelType.__members__:
+                    target.setdefault("fuel", {})[key.upper()] = value
+                elif key in self.SCALARS:
+                    target[key] = value
+                else:
+                    raise ValueError(f"Unknown emission factor '{name}'. Use a fuel type or one of {list(self.SCALARS)}")
+            version = max(self.versions()) + 1
+            versions = dict(state["versions"])
+            versions[version] = factors
+            self._write({"current": version, "versions": versions})
+            return version
+
+    def load_csv(self, path):
+        # Adds a version from a vehicle x fuel x urban data file with the columns
+        # vehicle_type, fuel_type (blank for per-km), urban (y/n) and factor; rows left out
+        # keep the current values
+        changes = {}
+        with open(path, "r", newline="") as file:
+            for line_no, row in enumerate(csv.DictReader(file), 2):
+                try:
+                    vehicle = validate_vehicle_type(row.get("vehicle_type") or "").name
+                    fuel_type = validate_fuel_type((row.get("fuel_type") or "").strip())
+                    factor = row.get("factor")
+                    if fuel_type:
+                        changes[f"{vehicle}.{fuel_type.name}"] = factor
+                    elif parse_urban_flag(row.get("urban")):
+                        # The factor is the full urban per-km rate
+                        changes[f"{vehicle}.urban"] = factor
+                        changes[f"{vehicle}.urban_adjustment"] = 1.0
+                    else:
+                        changes[f"{vehicle}.distance"] = factor
+                except ValueError as e:
+                    raise ValueError(f"{path} line {line_no}: {str(e)}")
+        if not changes:
+            raise ValueError(f"{path} has no emission factor rows")
+        return self.add(changes)
+
+    def activate(self, version):
+        with file_lock(self.path):
+            state = self._state(fresh=True)
+            self.get(version)
+            if state["current"] == version:
+                return
+            self._write({"current": version, "versions": state["versions"]})
+
+_factor_table = None
+
+def get_factor_table():
+    global _factor_table
+    if _factor_table is None:
+        _factor_table = EmissionFactorTable()
+    return _factor_table
+
+def calculate_emission(user_input, urban_mode=False):
+    # Direct lookup-table scoring; same results as get_calculator(...) without building a calculator
+    try:
+        emission = get_factor_table().lookup().calculate(user_input, urban_mode)
+    except ZeroDivisionError:
+        raise ValueError("Fuel efficiency cannot be zero")
+    if emission != emission:
+        raise ValueError(f"No emission factor available for {user_input.vehicle_type.name} "
+                         f"with fuel type {user_input.fuel_type.name}")
+    return emission
+
 # Enhanced CarbonFootPrintSummary with validation
 class CarbonFootPrintSummary:
     def __init__(self, user_input, carbon_emission):
@@ -214,159 +1437,3568 @@ class CarbonFootPrintSummary:
             print(f"Fuel Type: {self.user_input.fuel_type.name if self.user_input.fuel_type else 'Not specified'}")
             print(f"Fuel Efficiency: {self.user_input.fuel_efficiency if self.user_input.fuel_efficiency else 'Not specified'} km/L")
             print(f"Distance Traveled: {self.user_input.distance_travelled} km")
-            print(f"Month: {self.user_input.emission_month}")
+            print(f"Month: {self.user_input.emission_month} {self.user_input.emission_year}")
             print(f"Total Carbon Emission: {self.carbon_emission:.2f} kg CO₂\n")
         except Exception as e:
             print(f"Error displaying summary: {str(e)}")
 
-# Enhanced EmissionHistory with error handling
-class EmissionHistory:
-    def __init__(self, user_input, carbon_emission):
-        if not isinstance(user_input, UserInput):
-            raise TypeError("user_input must be an instance of UserInput")
-        if not isinstance(carbon_emission, (int, float)) or carbon_emission < 0:
-            raise ValueError("Carbon emission must be a non-negative number")
-        
-        self.user_input = user_input
-        self.carbon_emission = carbon_emission
+# Emission table helpers shared by the ledger, history and viewer
+def open_emission_table(path=EMISSION_FILE):
+    # The table opened for reading, or None if it has no file yet
+    if os.path.exists(path):
+        return open(path, "r", newline="")
+    if os.path.exists(path + ".gz"):  # Archived partition
+        return gzip.open(path + ".gz", "rt", newline="")
+    return None
 
-    def store_emission(self):
-        try:
-            fieldnames = ["username"] + VALID_MONTHS
-            data = []
-            
-            # Read existing data if file exists
-            if os.path.exists(EMISSION_FILE):
-                with open(EMISSION_FILE, "r", newline="") as file:
-                    reader = csv.DictReader(file)
-                    data = list(reader)
-
-            # Update or add user data
-            found = False
-            for row in data:
-                if row["username"] == self.user_input.username:
-                    current_value = float(row.get(self.user_input.emission_month, "0") or 0)
-                    row[self.user_input.emission_month] = str(current_value + self.carbon_emission)
-                    found = True
-                    break
-            
-            if not found:
-                new_entry = {"username": self.user_input.username}
-                new_entry.update({month: "0" for month in VALID_MONTHS})
-                new_entry[self.user_input.emission_month] = str(self.carbon_emission)
-                data.append(new_entry)
-
-            # Write back to file
-            with open(EMISSION_FILE, "w", newline="") as file:
-                writer = csv.DictWriter(file, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(data)
-                
-        except IOError as e:
-            raise IOError(f"Failed to store emission data: {str(e)}")
-        except Exception as e:
-            raise ValueError(f"Error processing emission data: {str(e)}")
+def read_emission_table(path=EMISSION_FILE):
+    rows = []
+    file = open_emission_table(path)
+    if file is not None:
+        with file:
+            rows = list(csv.DictReader(file))
+    METRICS.count("rows_scanned", len(rows), file="emission_table")
+    return rows
 
-# Enhanced EmissionHistoryViewer with error handling
-class EmissionHistoryViewer:
-    @staticmethod
-    def view_emission_history(username):
-        try:
-            validate_username(username)
-            
-            if not os.path.exists(EMISSION_FILE):
-                print("No emission history found.")
-                return
-            
-            with open(EMISSION_FILE, "r") as file:
-                reader = csv.DictReader(file)
-                found = False
-                
-                for row in reader:
-                    if row["username"] == username:
-                        print("\n📜 Emission History:")
-                        for month in VALID_MONTHS:
-                            if row.get(month, "0") != "0":
-                                print(f"{month}: {row[month]} kg CO₂")
-                        found = True
-                        break
-                
-                if not found:
-                    print("No emission records found for this user.")
-                    
-        except IOError as e:
-            print(f"Error accessing emission history: {str(e)}")
-        except Exception as e:
-            print(f"Error viewing history: {str(e)}")
+def write_emission_rows(file, data):
+    writer = csv.DictWriter(file, fieldnames=["username"] + VALID_MONTHS)
+    writer.writeheader()
+    writer.writerows(data)
 
-def get_calculator(user_input, urban_mode=False):
-    try:
-        if not isinstance(user_input, UserInput):
-            raise TypeError("Invalid user input type")
-            
-        if user_input.fuel_efficiency and user_input.fuel_type:
-            return FuelBasedCalculator(user_input)
-        elif urban_mode:
-            return UrbanAdjustmentCalculator(user_input)
-        else:
-            return DistanceBasedCalculator(user_input)
-    except Exception as e:
-        raise ValueError(f"Error selecting calculator: {str(e)}")
+def write_emission_table(data, path=EMISSION_FILE):
+    # Write to a temp file first so a failed write never truncates the table
+    atomic_write(path, lambda file: write_emission_rows(file, data))
 
-def clear_screen():
-    os.system('cls' if os.name == 'nt' else 'clear')
+def apply_emission_delta(row, month, emission):
+    current_value = float(row.get(month, "0") or 0)
+    row[month] = str(current_value + emission)
 
-def main_menu():
-    while True:
-        try:
-            clear_screen()
-            print("\n=== VehiCalc - Carbon Footprint Calculator ===")
-            print("[1] Sign Up\n[2] Log In\n[3] Exit")
-            choice = input("Choose an option (1-3): ").strip()
-            
-            if choice == "1":
-                handle_signup()
-            elif choice == "2":
-                handle_login()
-            elif choice == "3":
-                print("Thank you for using VehiCalc. Goodbye!")
-                exit()
-            else:
-                print("Invalid choice. Please enter 1, 2, or 3.")
-                input("Press Enter to continue...")
-                
-        except KeyboardInterrupt:
-            print("\nOperation cancelled by user.")
-            exit()
-        except Exception as e:
-            print(f"\nError: {str(e)}")
-            input("Press Enter to continue...")
+def format_emission_row(username, values):
+    # Same value formatting as emission_history.csv so the viewer output is unchanged
+    row = {"username": username}
+    for month, value in zip(VALID_MONTHS, values):
+        row[month] = str(value) if value else "0"
+    return row
 
-def handle_signup():
-    clear_screen()
-    print("\n=== User Registration ===")
-    username = input("Enter username (4-20 alphanumeric characters): ").strip()
-    password = input("Enter password (minimum 8 characters): ").strip()
-    
-    try:
-        # Validate both fields FIRST, collect all errors
-        errors = []
-        try:
-            validate_username(username)
-        except ValueError as e:
-            errors.append(str(e))
+def new_emission_row(username):
+    row = {"username": username}
+    row.update({month: "0" for month in VALID_MONTHS})
+    return row
+
+def group_by_year(entries):
+    # (username, year, month, emission) entries -> {year: [(username, month, emission), ...]}
+    by_year = {}
+    for username, year, month, emission in entries:
+        by_year.setdefault(year, []).append((username, month, emission))
+    return by_year
+
+def group_totals_by_year(totals):
+    # {(username, year, month): kg} -> {year: {(username, month): kg}}
+    by_year = {}
+    for (username, year, month), emission in totals.items():
+        by_year.setdefault(year, {})[(username, month)] = emission
+    return by_year
+
+def pending_merge(storage, totals):
+    # JSON record of totals split into the storage's merge steps, saved before merging them
+    return {"steps": [[[*key, emission] for key, emission in step.items()] for step in storage.merge_steps(totals)],
+            "done": 0}
+
+def finish_pending_merge(storage, pending, save):
+    # Merges the steps not done yet and calls save() after each, so a crash repeats none of them
+    for index in range(pending["done"], len(pending["steps"])):
+        storage.merge_emissions({(username, year, month): emission
+                                 for username, year, month, emission in pending["steps"][index]})
+        pending["done"] = index + 1
+        save()
+
+# Append-only ledger of per-trip emission deltas, compacted into one year's table.
+# Each year is a separate partition with its own table, ledger and lock.
+class EmissionLedger:
+    FIELDNAMES = ["username", "month", "emission"]
+
+    def __init__(self, table_file=EMISSION_FILE, ledger_file=EMISSION_LEDGER_FILE):
+        self.table_file = table_file
+        self.ledger_file = ledger_file
+        self._compactor = None
+
+    @classmethod
+    def for_year(cls, year, directory=""):
+        return cls(partition_path(os.path.join(directory, EMISSION_FILE), year),
+                   partition_path(os.path.join(directory, EMISSION_LEDGER_FILE), year))
+
+    def segment_file(self):
+        # The ledger is renamed here while it is being folded into the table
+        return self.ledger_file + ".compacting"
+
+    def commit_marker(self):
+        # Exists only while a fully written table is being swapped in for the segment
+        return self.ledger_file + ".commit"
+
+    def adopting_file(self):
+        # A whole table renamed here to be added to this one by the next compaction, which
+        # removes it in the same committed step, so its rows are counted exactly once
+        return self.table_file + ".adopting"
+
+    def archive_file(self):
+        return self.table_file + ".gz"
+
+    def exists(self):
+        return any(os.path.exists(path) for path in (self.table_file, self.archive_file(), self.ledger_file,
+                                                     self.segment_file(), self.adopting_file()))
+
+    def recover(self):
+        # Finishes or rolls back a compaction interrupted by a crash; returns what was done
+        actions = []
+        with file_lock(self.table_file):
+            temp_file = self.table_file + ".tmp"
+            if os.path.exists(self.commit_marker()):
+                # The new table was complete, so redo the remaining steps
+                if os.path.exists(temp_file):
+                    os.replace(temp_file, self.table_file)
+                    fsync_directory(self.table_file)
+                for done in (self.segment_file(), self.adopting_file()):
+                    if os.path.exists(done):
+                        os.remove(done)
+                os.remove(self.commit_marker())
+                actions.append("finished an interrupted ledger compaction")
+            elif os.path.exists(temp_file):
+                os.remove(temp_file)
+                actions.append(f"discarded a partial write of {self.table_file}")
+            if os.path.exists(self.archive_file() + ".tmp"):
+                os.remove(self.archive_file() + ".tmp")
+                actions.append(f"discarded a partial archive of {self.table_file}")
+            if os.path.exists(self.table_file) and os.path.exists(self.archive_file()):
+                # Archiving wrote the archive but stopped before removing the table
+                os.remove(self.archive_file())
+                actions.append(f"discarded an unfinished archive of {self.table_file}")
+            for path in (self.segment_file(), self.ledger_file):
+                removed = truncate_torn_tail(path)
+                if removed:
+                    actions.append(f"dropped {removed} bytes of a partial entry from {path}")
+            if os.path.exists(self.adopting_file()):
+                self.compact()
+                actions.append(f"finished adding {self.adopting_file()} to {self.table_file}")
+        return actions
+
+    def _unarchive(self):
+        # Writes to an archived year bring its table back first; caller holds the lock
+        if os.path.exists(self.archive_file()) and not os.path.exists(self.table_file):
+            write_emission_table(read_emission_table(self.table_file), self.table_file)
+            os.remove(self.archive_file())
+
+    def append(self, username, month, emission):
+        self.append_many([(username, month, emission)])
+
+    def append_many(self, entries):
+        # All entries go out in a single write under the partition lock
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([username, month, repr(emission)] for username, month, emission in entries)
+        with file_lock(self.table_file):
+            self._unarchive()
+            with open(self.ledger_file, "ab+") as file:
+                trim_partial_line(file)  # Never extend another writer's torn entry
+                if file.seek(0, os.SEEK_END) == 0:
+                    file.write(",".join(self.FIELDNAMES).encode("utf-8") + b"\r\n")
+                data = buffer.getvalue().encode("utf-8")
+                file.write(data)
+                FSYNC_POLICY.after_append(file)
+                size = file.tell()
+            METRICS.count("bytes_written", len(data), file="emission_ledger")
+            if size >= LEDGER_COMPACT_THRESHOLD:
+                self.compact()
+
+    @staticmethod
+    def load_deltas(path, username=None):
+        # username -> [(month, emission), ...] for one ledger file, or for one user's rows only
+        deltas = {}
+        with open(path, "r", newline="") as file:
+            for row in csv.DictReader(file):
+                if username is None or row["username"] == username:
+                    deltas.setdefault(row["username"], []).append((row["month"], float(row["emission"])))
+        return deltas
+
+    def entries(self, username=None):
+        # Deltas not yet folded into the table, oldest first
+        pending = []
+        with file_lock(self.table_file):
+            for path in (self.segment_file(), self.ledger_file):
+                if username is not None:
+                    try:
+                        deltas = FILE_CACHE.get(path, self.load_deltas, lambda path: self.load_deltas(path, username))
+                    except FileNotFoundError:
+                        continue
+                    pending.extend((username, month, emission) for month, emission in deltas.get(username, ()))
+                    continue
+                if not os.path.exists(path):
+                    continue
+                with open(path, "r", newline="") as file:
+                    for row in csv.DictReader(file):
+                        if username is None or row["username"] == username:
+                            pending.append((row["username"], row["month"], float(row["emission"])))
+        return pending
+
+    def compact(self, totals=None):
+        # Folds pending deltas, then any extra (username, month) totals, in one table write
+        with file_lock(self.table_file):
+            segment = self.segment_file()
+            if not os.path.exists(segment) and os.path.exists(self.ledger_file):
+                # New appends start a fresh ledger while the segment is folded in
+                os.replace(self.ledger_file, segment)
+            adopting = self.adopting_file()
+            if not os.path.exists(segment) and not totals and not os.path.exists(adopting):
+                return 0
+
+            self._unarchive()
+            data = read_emission_table(self.table_file)
+            rows = {row["username"]: row for row in data}
+
+            def apply(username, month, emission):
+                row = rows.get(username)
+                if row is None:
+                    row = rows[username] = new_emission_row(username)
+                    data.append(row)
+                apply_emission_delta(row, month, emission)
+
+            applied = 0
+            if os.path.exists(segment):
+                with open(segment, "r", newline="") as file:
+                    for entry in csv.DictReader(file):
+                        apply(entry["username"], entry["month"], float(entry["emission"]))
+                        applied += 1
+            if os.path.exists(adopting):
+                for row in read_emission_table(adopting):
+                    for month in VALID_MONTHS:
+                        if float(row.get(month) or 0):
+                            apply(row["username"], month, float(row[month]))
+                            applied += 1
+            for (username, month), emission in (totals or {}).items():
+                apply(username, month, emission)
+                applied += 1
+
+            # The commit marker makes the table swap and segment removal one redoable step
+            temp_file = write_temp_file(self.table_file, lambda file: write_emission_rows(file, data))
+            with open(self.commit_marker(), "w") as file:
+                os.fsync(file.fileno())
+            fsync_directory(self.table_file)
+            os.replace(temp_file, self.table_file)
+            fsync_directory(self.table_file)
+            for done in (segment, adopting):
+                if os.path.exists(done):
+                    os.remove(done)
+            os.remove(self.commit_marker())
+            return applied
+
+    def archive(self):
+        # Folds the ledger in and gzips the table; reads still work, and the next
+        # write to this year restores the plain table
+        with file_lock(self.table_file):
+            self.compact()
+            if not os.path.exists(self.table_file):
+                return False
+            archive_file = self.archive_file()
+            with open(self.table_file, "rb") as source, open(archive_file + ".tmp", "wb") as target:
+                with gzip.GzipFile(fileobj=target, mode="wb", mtime=0) as compressed:
+                    compressed.write(source.read())
+                target.flush()
+                os.fsync(target.fileno())
+            os.replace(archive_file + ".tmp", archive_file)
+            fsync_directory(archive_file)
+            os.remove(self.table_file)
+            return True
+
+    def start_background_compaction(self, interval=60.0):
+        if self._compactor is not None and self._compactor.is_alive():
+            return self._compactor
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.compact()
+                except Exception as e:
+                    print(f"Warning: ledger compaction failed: {str(e)}", file=sys.stderr)
+
+        self._compactor = threading.Thread(target=run, name="ledger-compactor", daemon=True)
+        self._compactor.start()
+        return self._compactor
+
+# Storage backends behind User, EmissionHistory and EmissionHistoryViewer
+class StorageBackend:
+    def __init__(self, group_commit=False):
+        # In group-commit mode concurrent record_emission calls share one flush
+        self.committer = GroupCommitter(self.append_emissions) if group_commit else None
+
+    def get_password_hash(self, username):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def add_user(self, username, password_hash):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def add_users(self, users):
+        # Bulk signup of (username, password hash) pairs, e.g. for a data load
+        for username, password_hash in users:
+            self.add_user(username, password_hash)
+
+    def update_password_hash(self, username, password_hash):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def iter_users(self):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def record_emission(self, username, month, emission, year=None):
+        entry = (username, validate_year(year), month, emission)
+        if self.committer is not None:
+            self.committer.submit(entry)
+        else:
+            self.append_emissions([entry])
+
+    def append_emissions(self, entries):
+        # entries is a list of (username, year, month, emission) per-trip deltas, oldest first
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def merge_emissions(self, totals):
+        # totals maps (username, year, month) -> kg CO₂ to add, in one batch
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def merge_steps(self, totals):
+        # Splits totals into batches that merge_emissions applies all or nothing, so a caller
+        # can record which ones are done; one per year, as each year is its own partition
+        return [{(username, year, month): emission for (username, month), emission in year_totals.items()}
+                for year, year_totals in sorted(group_totals_by_year(totals).items())]
+
+    def list_years(self):
+        # Years with stored history, oldest first
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def get_emission_row(self, username, year=None):
+        # {"username": ..., "Jan": "0", ...} for one year with CSV-style values, or None
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def get_emission_range(self, username, start, end):
+        # [(year, month, kg CO₂)] for the periods start..end inclusive; only the
+        # partitions of years inside the range are read
+        first, last = period_index(*start), period_index(*end)
+        if first > last:
+            raise ValueError("The start of the range must not be after its end")
+        stored = set(self.list_years())
+        history = []
+        for year in range(start[0], end[0] + 1):
+            if year not in stored:
+                continue
+            row = self.get_emission_row(username, year)
+            if row is None:
+                continue
+            for month in VALID_MONTHS:
+                if first <= period_index(year, month) <= last:
+                    history.append((year, month, float(row.get(month) or 0)))
+        return history
+
+    def has_emission_history(self):
+        return bool(self.list_years())
+
+    def iter_emission_rows(self, year=None):
+        # Every row of one year's table
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def archive_year(self, year):
+        # Moves a finished year out of the way of current writes; False if there was nothing to do
+        return False
+
+    def close(self):
+        pass
+
+def legacy_partition_year(*paths):
+    # Unpartitioned history predates years, so it is filed under the year it was last written
+    mtimes = [os.path.getmtime(path) for path in paths if os.path.exists(path)]
+    return datetime.fromtimestamp(max(mtimes)).year if mtimes else datetime.now().year
+
+# users.csv plus one emission_history_<year>.csv table and ledger per year
+class CSVStorage(StorageBackend):
+    TABLE_SUFFIXES = ("", ".tmp", ".gz", ".gz.tmp", ".adopting")
+    LEDGER_SUFFIXES = ("", ".compacting", ".commit")
+
+    def __init__(self, group_commit=False, directory=""):
+        super().__init__(group_commit)
+        # directory roots all of the files; "" keeps them in the working directory
+        self.directory = directory
+        self.user_file = os.path.join(directory, USER_FILE)
+        self.emission_file = os.path.join(directory, EMISSION_FILE)
+        self.emission_ledger_file = os.path.join(directory, EMISSION_LEDGER_FILE)
+        self.user_index = UserIndex.for_file(self.user_file)
+        self._partitions = {}
+        self.recovery_actions = self.recover()
+
+    def partition(self, year):
+        ledger = self._partitions.get(year)
+        if ledger is None:
+            ledger = self._partitions.setdefault(year, EmissionLedger.for_year(year, self.directory))
+        return ledger
+
+    def recover(self):
+        # Repairs what a crash mid-write can leave behind
+        actions = []
+        with file_lock(self.user_file):
+            temp_file = self.user_index.index_file() + ".tmp"
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+                actions.append(f"discarded a partial write of {self.user_index.index_file()}")
+            removed = truncate_torn_tail(self.user_file)
+            if removed:
+                actions.append(f"dropped {removed} bytes of a partial entry from {self.user_file}")
+        actions += self.adopt_legacy_table()
+        for year in sorted(set(partition_years(self.emission_file, self.TABLE_SUFFIXES) +
+                               partition_years(self.emission_ledger_file, self.LEDGER_SUFFIXES))):
+            actions += self.partition(year).recover()
+        return actions
+
+    def adopt_legacy_table(self):
+        # Moves a pre-partitioning emission_history.csv (and its ledger) into a year partition
+        legacy = EmissionLedger(self.emission_file, self.emission_ledger_file)
+        with file_lock(self.emission_file):
+            if not legacy.exists() and not os.path.exists(legacy.commit_marker()):
+                return []
+            actions = legacy.recover()
+            year = legacy_partition_year(self.emission_file, self.emission_ledger_file, legacy.segment_file())
+            legacy.compact()
+            legacy._unarchive()
+            partition = self.partition(year)
+            with file_lock(partition.table_file):
+                if os.path.exists(self.emission_file):
+                    # One rename hands the table over; the partition's compaction adds it and
+                    # removes it together, and recovery finishes that if it is interrupted
+                    os.replace(self.emission_file, partition.adopting_file())
+                    fsync_directory(partition.adopting_file())
+                partition.compact()
+        return actions + [f"moved {self.emission_file} into the {year} partition"]
+
+    def list_years(self):
+        return sorted(set(partition_years(self.emission_file, ("", ".gz")) +
+                          partition_years(self.emission_ledger_file, ("", ".compacting"))))
+
+    @staticmethod
+    def load_emission_table(path, username=None):
+        rows = {}
+        with open(path, "r", newline="") as file:
+            for row in csv.DictReader(file):
+                if username is None or row["username"] == username:
+                    rows.setdefault(row["username"], row)
+        return rows
+
+    def get_password_hash(self, username):
+        # Through the index rather than FILE_CACHE: every signup changes users.csv, so a cached
+        # parse would be thrown away and the whole file re-read on each signup and the next login
+        if not os.path.exists(self.user_file):
+            return None
+        row = self.user_index.lookup(username)
+        if row is None or len(row) < 2:
+            return None
+        return row[1]
+
+    def add_user(self, username, password_hash):
+        # Held across the duplicate check and the append so concurrent signups cannot race
+        with file_lock(self.user_file):
+            if not os.path.exists(self.user_file):
+                with open(self.user_file, "w", newline="") as file:
+                    writer = csv.writer(file)
+                    writer.writerow(["username", "password"])
+
+            # Check if username already exists
+            if self.get_password_hash(username) is not None:
+                raise ValueError("Username already exists")
+
+            self.user_index.add(username, password_hash)
+
+    def add_users(self, users):
+        users = list(users)
+        with file_lock(self.user_file):
+            if not os.path.exists(self.user_file):
+                with open(self.user_file, "w", newline="") as file:
+                    csv.writer(file).writerow(["username", "password"])
+            seen = set()
+            for username, _ in users:
+                if username in seen or self.get_password_hash(username) is not None:
+                    raise ValueError(f"Username already exists: {username}")
+                seen.add(username)
+            self.user_index.add_many(users)
+
+    def update_password_hash(self, username, password_hash):
+        # Only hash upgrades change a stored hash, once per account, so the file is rewritten
+        with file_lock(self.user_file):
+            with open(self.user_file, "r", newline="") as file:
+                rows = list(csv.reader(file))
+            for row in rows[1:]:
+                if row and row[0] == username:
+                    row[1] = password_hash
+                    break
+            else:
+                raise ValueError(f"Unknown user: {username}")
+            atomic_write(self.user_file, lambda file: csv.writer(file).writerows(rows))
+            self.user_index.rebuild()
+
+    def iter_users(self):
+        if not os.path.exists(self.user_file):
+            return
+        with open(self.user_file, "r", newline="") as file:
+            for row in csv.DictReader(file):
+                yield row["username"], row["password"]
+
+    def append_emissions(self, entries):
+        # Append the deltas; compaction folds them into each year's table later
+        for year, year_entries in group_by_year(entries).items():
+            self.partition(year).append_many(year_entries)
+
+    def merge_emissions(self, totals):
+        for year, year_totals in group_totals_by_year(totals).items():
+            self.partition(year).compact(year_totals)
+
+    def get_emission_row(self, username, year=None):
+        # Table row with pending ledger deltas applied; the lock keeps compaction
+        # from moving deltas into the table between the two reads
+        ledger = self.partition(validate_year(year))
+        with file_lock(ledger.table_file):
+            try:
+                table = FILE_CACHE.get(ledger.table_file, self.load_emission_table,
+                                       lambda path: self.load_emission_table(path, username))
+                row = table.get(username)
+                row = dict(row) if row is not None else None
+            except FileNotFoundError:  # Not written yet, or archived and compressed
+                row = next((existing for existing in read_emission_table(ledger.table_file)
+                            if existing["username"] == username), None)
+
+            for _, month, emission in ledger.entries(username):
+                if row is None:
+                    row = new_emission_row(username)
+                apply_emission_delta(row, month, emission)
+        return row
+
+    def iter_emission_rows(self, year=None):
+        # Streams the table with only the pending ledger deltas held in memory. Compaction
+        # replaces the table instead of rewriting it, so the file opened under the lock stays
+        # a consistent snapshot; Windows cannot replace an open file, so there the lock is kept.
+        ledger = self.partition(validate_year(year))
+        lock = file_lock(ledger.table_file)
+        with lock:
+            file = open_emission_table(ledger.table_file)
+            entries = ledger.entries()
+        pending = {}
+        for username, month, emission in entries:
+            pending.setdefault(username, []).append((month, emission))
+        scanned = 0
+        with lock if fcntl is None else nullcontext():
+            if file is not None:
+                try:
+                    for row in csv.DictReader(file):
+                        scanned += 1
+                        for month, emission in pending.pop(row["username"], ()):
+                            apply_emission_delta(row, month, emission)
+                        yield row
+                finally:
+                    file.close()
+                    METRICS.count("rows_scanned", scanned, file="emission_table")
+        for username, deltas in pending.items():
+            row = new_emission_row(username)
+            for month, emission in deltas:
+                apply_emission_delta(row, month, emission)
+            yield row
+
+    def archive_year(self, year):
+        if year >= datetime.now().year:
+            raise ValueError("Only past years can be archived")
+        return self.partition(year).archive()
+
+# SQLite database with one reused connection in WAL mode and one emissions_<year> table per year
+class SQLiteStorage(StorageBackend):
+    SCHEMA = "CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, password TEXT NOT NULL);"
+    SELECT_USER = "SELECT password FROM users WHERE username = ?"
+    INSERT_USER = "INSERT INTO users (username, password) VALUES (?, ?)"
+    UPDATE_USER = "UPDATE users SET password = ? WHERE username = ?"
+
+    def __init__(self, path, group_commit=False):
+        super().__init__(group_commit)
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._tables = set()  # years whose table is known to exist
+        self._upserts = {}
+        try:
+            # Waits on other processes' write locks instead of failing right away
+            self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(self.SCHEMA)
+            self.recovery_actions = self.adopt_legacy_table()
+        except sqlite3.Error as e:
+            raise IOError(f"Failed to open database {path}: {str(e)}")
+
+    @contextmanager
+    def transaction(self):
+        # Nested calls join the outer transaction, so callers can batch many writes
+        with self._lock:
+            if self._depth == 0:
+                self.connection.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield self.connection
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self.connection.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self.connection.execute("COMMIT")
+
+    @staticmethod
+    def table_name(year):
+        return f"emissions_{int(year)}"
+
+    def create_table(self, year):
+        # Called inside a write transaction; another process may have created it already
+        if year not in self._tables:
+            self.connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table_name(year)} (username TEXT PRIMARY KEY, "
+                + ", ".join(f"{month} REAL NOT NULL DEFAULT 0" for month in VALID_MONTHS) + ")")
+            self._tables.add(year)
+
+    def adopt_legacy_table(self):
+        # Renames the pre-partitioning emissions table to the year the database was last written
+        with self.transaction() as connection:
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emissions'").fetchone() is None:
+                return []
+            year = legacy_partition_year(self.path)
+            if year in self.list_years():
+                columns = ", ".join(VALID_MONTHS)
+                connection.execute(
+                    f"INSERT INTO {self.table_name(year)} (username, {columns}) "
+                    f"SELECT username, {columns} FROM emissions WHERE true ON CONFLICT(username) DO UPDATE SET "
+                    + ", ".join(f"{month} = {month} + excluded.{month}" for month in VALID_MONTHS))
+                connection.execute("DROP TABLE emissions")
+            else:
+                connection.execute(f"ALTER TABLE emissions RENAME TO {self.table_name(year)}")
+        return [f"moved the emissions table into the {year} partition"]
+
+    def list_years(self):
+        with self._lock:
+            names = self.connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'emissions\\_%' ESCAPE '\\'").fetchall()
+        years = sorted(int(name[len("emissions_"):]) for name, in names if name[len("emissions_"):].isdigit())
+        self._tables.update(years)
+        return years
+
+    def _upsert_sql(self, year, month):
+        # Statement text is fixed per (year, month) so sqlite3's statement cache reuses the compiled plan
+        sql = self._upserts.get((year, month))
+        if sql is None:
+            validate_month(month)
+            table = self.table_name(year)
+            sql = self._upserts[(year, month)] = (
+                f"INSERT INTO {table} (username, {month}) VALUES (?, ?) "
+                f"ON CONFLICT(username) DO UPDATE SET {month} = {month} + excluded.{month}")
+        return sql
+
+    def get_password_hash(self, username):
+        with self._lock:
+            row = self.connection.execute(self.SELECT_USER, (username,)).fetchone()
+        return row[0] if row else None
+
+    def add_user(self, username, password_hash):
+        try:
+            with self.transaction() as connection:
+                connection.execute(self.INSERT_USER, (username, password_hash))
+        except sqlite3.IntegrityError:
+            raise ValueError("Username already exists")
+
+    def add_users(self, users):
+        try:
+            with self.transaction() as connection:
+                connection.executemany(self.INSERT_USER, users)
+        except sqlite3.IntegrityError:
+            raise ValueError("Username already exists")
+
+    def update_password_hash(self, username, password_hash):
+        with self.transaction() as connection:
+            if connection.execute(self.UPDATE_USER, (password_hash, username)).rowcount == 0:
+                raise ValueError(f"Unknown user: {username}")
+
+    def iter_users(self):
+        with self._lock:
+            rows = self.connection.execute("SELECT username, password FROM users ORDER BY rowid").fetchall()
+        yield from rows
+
+    def append_emissions(self, entries):
+        with self.transaction() as connection:
+            for username, year, month, emission in entries:
+                self.create_table(year)
+                connection.execute(self._upsert_sql(year, month), (username, emission))
+
+    def merge_emissions(self, totals):
+        by_statement = {}
+        for (username, year, month), emission in totals.items():
+            by_statement.setdefault((year, month), []).append((username, emission))
+        with self.transaction() as connection:
+            for (year, month), params in by_statement.items():
+                self.create_table(year)
+                connection.executemany(self._upsert_sql(year, month), params)
+
+    def merge_steps(self, totals):
+        return [totals] if totals else []  # merge_emissions is a single transaction
+
+    def _has_table(self, year):
+        return year in self._tables or year in self.list_years()
+
+    def get_emission_row(self, username, year=None):
+        year = validate_year(year)
+        if not self._has_table(year):
+            return None
+        with self._lock:
+            values = self.connection.execute(
+                f"SELECT username, {', '.join(VALID_MONTHS)} FROM {self.table_name(year)} WHERE username = ?",
+                (username,)).fetchone()
+        return format_emission_row(values[0], values[1:]) if values else None
+
+    def iter_emission_rows(self, year=None):
+        # Pages by rowid, so a full read holds one page in memory and the connection between pages
+        # stays free; upserts keep a row's rowid, so no row is seen twice
+        year = validate_year(year)
+        if not self._has_table(year):
+            return
+        query = (f"SELECT rowid, username, {', '.join(VALID_MONTHS)} FROM {self.table_name(year)} "
+                 f"WHERE rowid > ? ORDER BY rowid LIMIT ?")
+        last = 0
+        while True:
+            with self._lock:
+                rows = self.connection.execute(query, (last, EXPORT_CHUNK_ROWS)).fetchall()
+            if not rows:
+                return
+            for values in rows:
+                yield format_emission_row(values[1], values[2:])
+            last = rows[-1][0]
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+# Fixed-width binary users x 12 float64 matrix accessed through mmap. Layout:
+# header | username slots (capacity x NAME_SIZE) | values (capacity x 12 float64)
+class EmissionMatrix:
+    MAGIC = b"VEMX"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIQQ")  # magic, version, row count, row capacity
+    HEADER_SIZE = 64
+    NAME_SIZE = 80  # 20 characters of up to 4 UTF-8 bytes each
+    ROW_SIZE = 8 * len(VALID_MONTHS)
+    INITIAL_CAPACITY = 1024
+    ROWS_WINDOW = 4096  # rows() copies this many rows per step
+    MONTH_INDEX = {month: i for i, month in enumerate(VALID_MONTHS)}
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = file_lock(path)
+        self._file = None
+        self._mm = None
+        self._inode = None
+        self._index = {}
+        self._names = []
+        self._capacity = 0
+        with self._lock:
+            if not os.path.exists(path):
+                self._write_file(self.INITIAL_CAPACITY, [], b"")
+            self._refresh()
+
+    @classmethod
+    def _values_offset(cls, capacity):
+        return cls.HEADER_SIZE + capacity * cls.NAME_SIZE
+
+    def _write_file(self, capacity, names, values):
+        # Builds a complete matrix file next to path and renames it into place
+        temp_file = self.path + ".tmp"
+        with open(temp_file, "wb") as file:
+            file.truncate(self._values_offset(capacity) + capacity * self.ROW_SIZE)
+            file.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(names), capacity))
+            file.seek(self.HEADER_SIZE)
+            file.write(b"".join(name.encode("utf-8").ljust(self.NAME_SIZE, b"\0") for name in names))
+            file.seek(self._values_offset(capacity))
+            file.write(values)
+            file.flush()
+            os.fsync(file.fileno())
+        self._close_map()
+        os.replace(temp_file, self.path)
+        fsync_directory(self.path)
+
+    def _close_map(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+        self._mm = self._file = self._inode = None
+
+    def _refresh(self):
+        # Picks up rows added, or a regrown file written, by another process
+        inode = os.stat(self.path).st_ino
+        if self._mm is None or inode != self._inode:
+            self._close_map()
+            self._file = open(self.path, "r+b")
+            self._mm = mmap.mmap(self._file.fileno(), 0)
+            self._inode = inode
+            self._index, self._names = {}, []
+            magic, version, _, self._capacity = self.HEADER.unpack_from(self._mm, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise IOError(f"{self.path} is not a VehiCalc emission matrix")
+        count = self.HEADER.unpack_from(self._mm, 0)[2]
+        for row in range(len(self._names), count):
+            start = self.HEADER_SIZE + row * self.NAME_SIZE
+            name = self._mm[start:start + self.NAME_SIZE].rstrip(b"\0").decode("utf-8")
+            self._index.setdefault(name, row)
+            self._names.append(name)
+
+    def _append_row(self, username):
+        encoded = username.encode("utf-8")
+        if len(encoded) > self.NAME_SIZE:
+            raise ValueError("Username is too long for the binary emission matrix")
+        count = len(self._names)
+        if count == self._capacity:
+            values_offset = self._values_offset(self._capacity)
+            values = self._mm[values_offset:values_offset + count * self.ROW_SIZE]
+            self._write_file(self._capacity * 2, self._names, values)
+            self._refresh()
+        start = self.HEADER_SIZE + count * self.NAME_SIZE
+        self._mm[start:start + len(encoded)] = encoded
+        # Bumping the row count last makes the new row visible atomically
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self.VERSION, count + 1, self._capacity)
+        self._index[username] = count
+        self._names.append(username)
+        return count
+
+    def add_many(self, entries):
+        # entries: (username, month, emission); each is an in-place increment
+        with self._lock:
+            self._refresh()
+            values_offset = self._values_offset(self._capacity)
+            for username, month, emission in entries:
+                month_index = self.MONTH_INDEX.get(month)
+                if month_index is None:
+                    raise ValueError(f"Invalid month. Must be one of: {VALID_MONTHS}")
+                row = self._index.get(username)
+                if row is None:
+                    row = self._append_row(username)
+                    values_offset = self._values_offset(self._capacity)
+                offset = values_offset + row * self.ROW_SIZE + month_index * 8
+                current = struct.unpack_from("<d", self._mm, offset)[0]
+                struct.pack_into("<d", self._mm, offset, current + emission)
+            if FSYNC_POLICY.should_sync(self.path):
+                self._mm.flush()
+
+    def get(self, username):
+        # The 12 monthly values for username, or None
+        with self._lock:
+            self._refresh()
+            row = self._index.get(username)
+            if row is None:
+                return None
+            offset = self._values_offset(self._capacity) + row * self.ROW_SIZE
+            return struct.unpack_from(f"<{len(VALID_MONTHS)}d", self._mm, offset)
+
+    def __len__(self):
+        with self._lock:
+            self._refresh()
+            return len(self._names)
+
+    def values_view(self):
+        # Zero-copy float64 view of all rows (row-major, 12 per row). Release it
+        # (or use it in a with block) before the matrix grows or is closed.
+        with self._lock:
+            self._refresh()
+            offset = self._values_offset(self._capacity)
+            return memoryview(self._mm)[offset:offset + len(self._names) * self.ROW_SIZE].cast("d")
+
+    def rows(self):
+        # Copies ROWS_WINDOW rows at a time out of the map, taking the lock per window only;
+        # rows another process adds meanwhile are picked up when the loop reaches them
+        width = len(VALID_MONTHS)
+        start = 0
+        while True:
+            with self._lock:
+                self._refresh()
+                end = min(len(self._names), start + self.ROWS_WINDOW)
+                if start >= end:
+                    return
+                names = self._names[start:end]
+                offset = self._values_offset(self._capacity) + start * self.ROW_SIZE
+                values = array("d", self._mm[offset:offset + (end - start) * self.ROW_SIZE])
+            if sys.byteorder != "little":
+                values.byteswap()
+            for row, username in enumerate(names):
+                yield username, tuple(values[row * width:(row + 1) * width])
+            start = end
+
+    def import_rows(self, rows):
+        # Replaces the matrix with CSV-layout rows ({"username": ..., "Jan": "1.5", ...})
+        names, values = [], array("d")
+        for row in rows:
+            names.append(row["username"])
+            values.extend(float(row.get(month) or 0) for month in VALID_MONTHS)
+        if sys.byteorder != "little":
+            values.byteswap()
+        with self._lock:
+            self._write_file(max(self.INITIAL_CAPACITY, len(names)), names, values.tobytes())
+            self._refresh()
+        return len(names)
+
+    def compact(self):
+        # Shrinks the file to exactly its rows; used when archiving a finished year
+        with self._lock:
+            self._refresh()
+            count = len(self._names)
+            offset = self._values_offset(self._capacity)
+            values = self._mm[offset:offset + count * self.ROW_SIZE]
+            self._write_file(max(count, 1), list(self._names), values)
+            self._refresh()
+        return count
+
+    def close(self):
+        with self._lock:
+            self._close_map()
+
+# users.csv for accounts, one emission_matrix_<year>.bin per year for emissions
+class BinaryStorage(CSVStorage):
+    def __init__(self, path=None, group_commit=False):
+        super().__init__(group_commit)
+        self.path = path or EMISSION_MATRIX_FILE
+        self._matrices = {}
+        self._matrix_lock = threading.Lock()
+        self.recovery_actions += self.adopt_legacy_matrix()
+
+    def adopt_legacy_matrix(self):
+        # Moves a pre-partitioning matrix file into the year it was last written. When that year
+        # already has a matrix, the file is renamed to <year matrix>.adopting first, so a crash
+        # can neither lose it nor add it twice; the next start finishes the merge.
+        actions = []
+        with file_lock(self.path):
+            if os.path.exists(self.path):
+                year = legacy_partition_year(self.path)
+                target = partition_path(self.path, year)
+                with file_lock(target):
+                    os.replace(self.path, target + ".adopting" if os.path.exists(target) else target)
+                    fsync_directory(target)
+                actions.append(f"moved {self.path} into the {year} partition")
+            for year in partition_years(self.path, (".adopting",)):
+                self.finish_adopting(partition_path(self.path, year))
+        return actions
+
+    @staticmethod
+    def finish_adopting(target):
+        # The sum of target and target.adopting is written aside, then swapped in and the
+        # adopted file removed under a commit marker, the way a ledger compaction commits
+        adopting, merged, marker = target + ".adopting", target + ".merged", target + ".adopting.commit"
+        with file_lock(target):
+            if not os.path.exists(marker):
+                rows = {}
+                for path in (target, adopting):
+                    matrix = EmissionMatrix(path)
+                    try:
+                        for username, values in matrix.rows():
+                            current = rows.get(username)
+                            rows[username] = values if current is None else tuple(map(sum, zip(current, values)))
+                    finally:
+                        matrix.close()
+                matrix = EmissionMatrix(merged)
+                try:
+                    matrix.import_rows(format_emission_row(username, values) for username, values in rows.items())
+                finally:
+                    matrix.close()
+                with open(marker, "w") as file:
+                    os.fsync(file.fileno())
+                fsync_directory(marker)
+            if os.path.exists(merged):
+                os.replace(merged, target)
+                fsync_directory(target)
+            if os.path.exists(adopting):
+                os.remove(adopting)
+            os.remove(marker)
+
+    def matrix(self, year, create=False):
+        # The year's matrix, or None when it has no file and create is False
+        with self._matrix_lock:
+            matrix = self._matrices.get(year)
+            if matrix is None:
+                path = partition_path(self.path, year)
+                if not create and not os.path.exists(path):
+                    return None
+                matrix = self._matrices[year] = EmissionMatrix(path)
+            return matrix
+
+    def list_years(self):
+        return partition_years(self.path)
+
+    def append_emissions(self, entries):
+        for year, year_entries in group_by_year(entries).items():
+            self.matrix(year, create=True).add_many(year_entries)
+
+    def merge_emissions(self, totals):
+        for year, year_totals in group_totals_by_year(totals).items():
+            self.matrix(year, create=True).add_many(
+                (username, month, emission) for (username, month), emission in year_totals.items())
+
+    def get_emission_row(self, username, year=None):
+        matrix = self.matrix(validate_year(year))
+        values = matrix.get(username) if matrix is not None else None
+        return format_emission_row(username, values) if values is not None else None
+
+    def iter_emission_rows(self, year=None):
+        matrix = self.matrix(validate_year(year))
+        if matrix is None:
+            return
+        for username, values in matrix.rows():
+            yield format_emission_row(username, values)
+
+    def archive_year(self, year):
+        if year >= datetime.now().year:
+            raise ValueError("Only past years can be archived")
+        matrix = self.matrix(year)
+        if matrix is None:
+            return False
+        matrix.compact()
+        with self._matrix_lock:
+            # Unmapped until the year is read or written again
+            self._matrices.pop(year).close()
+        return True
+
+    def close(self):
+        with self._matrix_lock:
+            for matrix in self._matrices.values():
+                matrix.close()
+            self._matrices.clear()
+
+def import_emission_matrix(path=None):
+    # Loads every year of the CSV history into binary matrices. Each year's ledger is folded
+    # into its table first, so any ledger entry found later was written after the import.
+    path = path or EMISSION_MATRIX_FILE
+    source = CSVStorage()
+    rows = 0
+    for year in source.list_years():
+        ledger = source.partition(year)
+        matrix = EmissionMatrix(partition_path(path, year))
+        try:
+            with file_lock(ledger.table_file):
+                ledger.compact()
+                rows += matrix.import_rows(source.iter_emission_rows(year))
+        finally:
+            matrix.close()
+    return rows
+
+def export_emission_matrix(path=None):
+    # Writes every year's binary matrix back out as the CSV year tables. Deltas still in a
+    # year's ledger were recorded through CSV storage after the import, so they are not in
+    # the matrix; they are folded in on top of it rather than dropped.
+    path = path or EMISSION_MATRIX_FILE
+    rows = 0
+    for year in partition_years(path):
+        matrix = EmissionMatrix(partition_path(path, year))
+        try:
+            data = [format_emission_row(username, values) for username, values in matrix.rows()]
+        finally:
+            matrix.close()
+        ledger = EmissionLedger.for_year(year)
+        with file_lock(ledger.table_file):
+            ledger.recover()  # An interrupted compaction must not swap its table in over this one
+            write_emission_table(data, ledger.table_file)
+            if os.path.exists(ledger.archive_file()):
+                os.remove(ledger.archive_file())
+            ledger.compact()
+        rows += len(data)
+    return rows
+
+def validate_shard_count(buckets):
+    try:
+        buckets = int(buckets)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid bucket count: {buckets}")
+    if not 1 <= buckets <= MAX_SHARD_COUNT:
+        raise ValueError(f"The bucket count must be between 1 and {MAX_SHARD_COUNT}")
+    return buckets
+
+# users.csv and the emission history split into buckets by a hash of the username. Each bucket
+# is a CSV layout of its own, so one user's signup, login, record and history touch one bucket.
+# layout.json holds the bucket count, and while a reshard runs, the new count and the moved buckets.
+class ShardedStorage(StorageBackend):
+    def __init__(self, buckets=None, directory=SHARD_DIR, group_commit=False):
+        super().__init__(group_commit)
+        self.directory = directory
+        self.manifest_file = os.path.join(directory, SHARD_MANIFEST_FILE)
+        self.recovery_actions = []
+        self._shards = {}
+        self._shards_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with file_lock(self.manifest_file):
+            if not os.path.exists(self.manifest_file):
+                self.write_manifest({"buckets": validate_shard_count(buckets or DEFAULT_SHARD_COUNT)})
+
+    @staticmethod
+    def load_manifest(path):
+        with open(path, "r") as file:
+            return json.load(file)
+
+    def manifest(self):
+        return FILE_CACHE.get(self.manifest_file, self.load_manifest)
+
+    def write_manifest(self, manifest):
+        atomic_write(self.manifest_file, lambda file: json.dump(manifest, file))
+
+    def layout_dir(self, buckets):
+        return os.path.join(self.directory, f"b{buckets}")
+
+    def shard(self, buckets, bucket):
+        # Opened (and recovered) on first use, so a process only pays for the buckets it touches
+        with self._shards_lock:
+            storage = self._shards.get((buckets, bucket))
+            if storage is None:
+                path = os.path.join(self.layout_dir(buckets), f"{bucket:04d}")
+                os.makedirs(path, exist_ok=True)
+                storage = self._shards[(buckets, bucket)] = CSVStorage(directory=path)
+                self.recovery_actions += storage.recovery_actions
+            return storage
+
+    @contextmanager
+    def bucket(self, bucket, buckets):
+        # Yields the manifest with the bucket locked against a reshard moving it, or None when
+        # a reshard replaced the layout while waiting for the lock. The lock files sit outside
+        # the layout directories so removing an old layout never pulls one from under a waiter.
+        with file_lock(os.path.join(self.directory, f"b{buckets}_{bucket:04d}")):
+            manifest = self.manifest()
+            yield manifest if manifest["buckets"] == buckets else None
+
+    def owner(self, manifest, bucket, username):
+        if bucket in manifest.get("moved", ()):
+            return self.shard(manifest["next"], shard_for_username(username, manifest["next"]))
+        return self.shard(manifest["buckets"], bucket)
+
+    def dispatch(self, groups, apply):
+        # groups maps username -> payload; apply(shard, {username: payload}) runs once per owning shard
+        pending = dict(groups)
+        while pending:
+            buckets = self.manifest()["buckets"]
+            by_bucket = {}
+            for username, payload in pending.items():
+                by_bucket.setdefault(shard_for_username(username, buckets), {})[username] = payload
+            for bucket, group in sorted(by_bucket.items()):
+                with self.bucket(bucket, buckets) as manifest:
+                    if manifest is None:
+                        break  # Regroup what is left under the new bucket count
+                    by_shard = {}
+                    for username, payload in group.items():
+                        by_shard.setdefault(self.owner(manifest, bucket, username), {})[username] = payload
+                    for shard, part in by_shard.items():
+                        apply(shard, part)
+                for username in group:
+                    del pending[username]
+
+    def with_shard(self, username, call):
+        results = []
+        self.dispatch({username: None}, lambda shard, group: results.append(call(shard)))
+        return results[0]
+
+    def shards(self):
+        # (shard, skip) for every shard holding data; mid-reshard, the old buckets not moved yet plus
+        # the new layout. skip(username) is set on new shards after a bucket copy was interrupted:
+        # the old bucket still owns those users, so what already landed is left out of scans.
+        # Callers hold the manifest lock so a bucket cannot move while they read.
+        manifest = self.manifest()
+        moved = set(manifest.get("moved", ()))
+        old = manifest["buckets"]
+        shards = [(self.shard(old, bucket), None) for bucket in range(old) if bucket not in moved]
+        if "next" in manifest:
+            copying = manifest.get("copying")
+            skip = None if copying is None else lambda username: shard_for_username(username, old) == copying
+            shards += [(self.shard(manifest["next"], bucket), skip) for bucket in range(manifest["next"])]
+        return shards
+
+    def get_password_hash(self, username):
+        return self.with_shard(username, lambda shard: shard.get_password_hash(username))
+
+    def add_user(self, username, password_hash):
+        self.with_shard(username, lambda shard: shard.add_user(username, password_hash))
+
+    def add_users(self, users):
+        # Every bucket is checked before any is written, so a taken name rejects the whole batch
+        users = dict(users)
+        taken = []
+        self.dispatch(users, lambda shard, group: taken.extend(
+            username for username in group if shard.get_password_hash(username) is not None))
+        if taken:
+            raise ValueError(f"Username already exists: {taken[0]}")
+        self.dispatch(users, lambda shard, group: shard.add_users(group.items()))
+
+    def update_password_hash(self, username, password_hash):
+        self.with_shard(username, lambda shard: shard.update_password_hash(username, password_hash))
+
+    def iter_users(self):
+        with file_lock(self.manifest_file):
+            users = [user for shard, skip in self.shards() for user in shard.iter_users()
+                     if skip is None or not skip(user[0])]
+        yield from users
+
+    def append_emissions(self, entries):
+        by_user = {}
+        for entry in entries:
+            by_user.setdefault(entry[0], []).append(entry)
+        self.dispatch(by_user, lambda shard, group: shard.append_emissions(
+            [entry for user_entries in group.values() for entry in user_entries]))
+
+    def merge_emissions(self, totals):
+        by_user = {}
+        for key, emission in totals.items():
+            by_user.setdefault(key[0], {})[key] = emission
+        self.dispatch(by_user, lambda shard, group: shard.merge_emissions(
+            {key: emission for user_totals in group.values() for key, emission in user_totals.items()}))
+
+    def merge_steps(self, totals):
+        # One per bucket and year: each shard's partitions commit on their own
+        buckets = self.manifest()["buckets"]
+        by_bucket = {}
+        for key, emission in totals.items():
+            by_bucket.setdefault(shard_for_username(key[0], buckets), {})[key] = emission
+        return [step for _, bucket_totals in sorted(by_bucket.items())
+                for step in super().merge_steps(bucket_totals)]
+
+    def list_years(self):
+        with file_lock(self.manifest_file):
+            return sorted(set(year for shard, _ in self.shards() for year in shard.list_years()))
+
+    def get_emission_row(self, username, year=None):
+        return self.with_shard(username, lambda shard: shard.get_emission_row(username, year))
+
+    def get_emission_range(self, username, start, end):
+        return self.with_shard(username, lambda shard: shard.get_emission_range(username, start, end))
+
+    def iter_emission_rows(self, year=None):
+        # Streams shard by shard, holding the manifest lock so no bucket moves mid-read
+        with file_lock(self.manifest_file):
+            for shard, skip in self.shards():
+                if skip is None:
+                    yield from shard.iter_emission_rows(year)
+                else:
+                    yield from (row for row in shard.iter_emission_rows(year) if not skip(row["username"]))
+
+    def archive_year(self, year):
+        with file_lock(self.manifest_file):
+            return any([shard.archive_year(year) for shard, _ in self.shards()])
+
+    def reshard(self, buckets):
+        # Online: one bucket at a time is copied into the new layout with it locked, while other
+        # processes keep serving the rest. Running it again resumes an interrupted reshard.
+        buckets = validate_shard_count(buckets)
+        with file_lock(self.manifest_file):
+            manifest = self.manifest()
+            if manifest.get("next", buckets) != buckets:
+                raise ValueError(f"A reshard to {manifest['next']} buckets is unfinished; run that one first")
+            if manifest["buckets"] == buckets:
+                raise ValueError(f"The layout already has {buckets} buckets")
+            if "next" not in manifest:
+                if os.path.exists(self.layout_dir(buckets)):
+                    shutil.rmtree(self.layout_dir(buckets))  # Left over from an earlier layout of this size
+                self.write_manifest(dict(manifest, next=buckets, moved=[]))
+        old = manifest["buckets"]
+
+        users = 0
+        for bucket in range(old):
+            with file_lock(self.manifest_file), self.bucket(bucket, old) as manifest:
+                if manifest is None or bucket in manifest["moved"]:
+                    continue
+                # "copying" survives a crash mid-copy, so the resumed copy corrects what already landed
+                resume = manifest.get("copying") == bucket
+                self.write_manifest(dict(manifest, copying=bucket))
+                users += self.copy_bucket(self.shard(old, bucket), buckets, resume)
+                self.write_manifest({"buckets": old, "next": buckets, "moved": manifest["moved"] + [bucket]})
+
+        with file_lock(self.manifest_file):
+            if self.manifest().get("next") == buckets:
+                self.write_manifest({"buckets": buckets})
+                with self._shards_lock:
+                    self._shards = {key: shard for key, shard in self._shards.items() if key[0] != old}
+                shutil.rmtree(self.layout_dir(old), ignore_errors=True)
+        return users
+
+    def copy_bucket(self, source, buckets, resume):
+        users = 0
+        for username, password_hash in source.iter_users():
+            target = self.shard(buckets, shard_for_username(username, buckets))
+            if resume and target.get_password_hash(username) is not None:
+                continue
+            target.add_user(username, password_hash)
+            users += 1
+        for year in source.list_years():
+            by_target = {}
+            for row in source.iter_emission_rows(year):
+                target = shard_for_username(row["username"], buckets)
+                for month in VALID_MONTHS:
+                    value = float(row.get(month) or 0)
+                    if value:
+                        by_target.setdefault(target, {})[(row["username"], year, month)] = value
+            for target, totals in by_target.items():
+                shard = self.shard(buckets, target)
+                if resume:
+                    for (username, _, month), value in list(totals.items()):
+                        row = shard.get_emission_row(username, year)
+                        totals[(username, year, month)] = value - float((row or {}).get(month) or 0)
+                shard.merge_emissions(totals)
+        return users
+
+_storage = None
+
+def open_storage(spec, group_commit=False):
+    # "csv" for the CSV files, "sqlite:PATH" for an SQLite database,
+    # "binary[:PATH]" for the memory-mapped emission matrix, "sharded[:BUCKETS]" for
+    # the CSV files split into buckets under SHARD_DIR (BUCKETS only applies to a new layout)
+    if spec == "csv":
+        return CSVStorage(group_commit)
+    if spec.startswith("sqlite:") and len(spec) > len("sqlite:"):
+        return SQLiteStorage(spec[len("sqlite:"):], group_commit)
+    if spec == "binary" or spec.startswith("binary:"):
+        return BinaryStorage(spec[len("binary:"):] or None, group_commit)
+    if spec == "sharded" or spec.startswith("sharded:"):
+        return ShardedStorage(spec[len("sharded:"):] or None, group_commit=group_commit)
+    raise ValueError(f"Invalid storage '{spec}'. Use 'csv', 'sqlite:PATH', 'binary[:PATH]' or 'sharded[:BUCKETS]'")
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        _storage = open_storage(os.environ.get("VEHICALC_STORAGE", "csv"))
+    return _storage
+
+def set_storage(storage):
+    global _storage
+    if _storage is not None and _storage is not storage:
+        _storage.close()
+    _storage = storage
+    return storage
+
+def migrate_csv_to_sqlite(db_path):
+    # One-shot copy of users.csv and every year of the CSV history (with pending deltas) into SQLite
+    source = CSVStorage()
+    target = SQLiteStorage(db_path)
+    users = rows = 0
+    try:
+        with target.transaction() as connection:
+            for username, password_hash in source.iter_users():
+                connection.execute("INSERT OR REPLACE INTO users (username, password) VALUES (?, ?)",
+                                   (username, password_hash))
+                users += 1
+            for year in source.list_years():
+                target.create_table(year)
+                insert_row = (f"INSERT OR REPLACE INTO {target.table_name(year)} (username, {', '.join(VALID_MONTHS)}) "
+                              f"VALUES ({', '.join('?' * (len(VALID_MONTHS) + 1))})")
+                for row in source.iter_emission_rows(year):
+                    connection.execute(insert_row, [row["username"]] +
+                                       [float(row.get(month) or 0) for month in VALID_MONTHS])
+                    rows += 1
+    finally:
+        target.close()
+    return users, rows
+
+# Raw trip inputs held column by column, with usernames dictionary-encoded
+class TripColumns:
+    LAYOUT = (
+        ("user", "I"),  # index into names
+        ("year", "H"),
+        ("month", "B"),  # index into VALID_MONTHS
+        ("vehicle", "B"),  # VehicleType value
+        ("fuel", "B"),  # FuelType value, 0 for none
+        ("urban", "B"),
+        ("distance", "d"),
+        ("efficiency", "d"),  # NaN for none
+        ("emission", "d"),  # kg CO₂ as stored when the trip was recorded
+    )
+    MONTH_INDEX = {month: i for i, month in enumerate(VALID_MONTHS)}
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.columns = {name: array(code) for name, code in self.LAYOUT}
+
+    def __len__(self):
+        return len(self.columns["user"])
+
+    def add(self, username, year, month, vehicle_type, fuel_type, fuel_efficiency, distance, urban, emission):
+        user = self.ids.get(username)
+        if user is None:
+            user = self.ids[username] = len(self.names)
+            self.names.append(username)
+        columns = self.columns
+        columns["user"].append(user)
+        columns["year"].append(year)
+        columns["month"].append(self.MONTH_INDEX[month])
+        columns["vehicle"].append(vehicle_type.value)
+        columns["fuel"].append(fuel_type.value if fuel_type else 0)
+        columns["urban"].append(1 if urban else 0)
+        columns["distance"].append(distance)
+        columns["efficiency"].append(fuel_efficiency if fuel_efficiency else float("nan"))
+        columns["emission"].append(emission)
+
+    def add_user_input(self, user_input, urban, emission):
+        self.add(user_input.username, user_input.emission_year, user_input.emission_month,
+                 user_input.vehicle_type, user_input.fuel_type, user_input.fuel_efficiency,
+                 user_input.distance_travelled, urban, emission)
+
+    def extend(self, other):
+        remap = array("I")
+        for name in other.names:
+            user = self.ids.get(name)
+            if user is None:
+                user = self.ids[name] = len(self.names)
+                self.names.append(name)
+            remap.append(user)
+        self.columns["user"].extend(remap[user] for user in other.columns["user"])
+        for name, _ in self.LAYOUT[1:]:
+            self.columns[name].extend(other.columns[name])
+
+# Append-only columnar log of every recorded trip: one little-endian file per column under
+# TRIP_LOG_DIR, a usernames dictionary, and a row count that is written last as the commit point
+class TripLog:
+    LAYOUT = TripColumns.LAYOUT + (("version", "H"),)  # emission factor version used
+    COUNT = struct.Struct("<Q")
+    FUEL_BY_CODE = {0: None, **{fuel_type.value: fuel_type for fuel_type in FuelType}}
+
+    def __init__(self, directory=TRIP_LOG_DIR):
+        self.directory = directory
+        self._lock = file_lock(directory)  # trip_log.lock, next to the directory
+        self._names = []
+        self._ids = {}
+        self._names_offset = 0
+        self.recovery_actions = self.recover()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def column_file(self, name):
+        return self._path(name + ".col")
+
+    def commit_marker(self):
+        # Exists from the moment re-scored emission and version columns are complete until their
+        # deltas are all in the stored totals; holds the deltas and how many merge steps are done
+        return self._path("rescore.commit")
+
+    def _read_count(self):
+        try:
+            with open(self._path("count"), "rb") as file:
+                return self.COUNT.unpack(file.read(self.COUNT.size))[0]
+        except (FileNotFoundError, struct.error):
+            return 0
+
+    def _write_count(self, count, sync):
+        with open(self._path("count"), "r+b" if os.path.exists(self._path("count")) else "wb") as file:
+            file.write(self.COUNT.pack(count))
+            file.flush()
+            if sync:
+                os.fsync(file.fileno())
+
+    def recover(self):
+        # Finishes or discards an interrupted re-score and drops rows past the committed count
+        actions = []
+        if not os.path.isdir(self.directory):
+            return actions
+        with self._lock:
+            temp_files = [self.column_file(name) + ".tmp" for name in ("emission", "version")]
+            if os.path.exists(self.commit_marker()):
+                for temp_file in temp_files:
+                    if os.path.exists(temp_file):
+                        os.replace(temp_file, temp_file[:-len(".tmp")])
+                fsync_directory(self.commit_marker())
+                self._finish_rescore(get_storage())
+                actions.append("finished an interrupted trip re-score")
+            elif any(os.path.exists(temp_file) for temp_file in temp_files):
+                for temp_file in temp_files:
+                    if os.path.exists(temp_file):
+                        os.remove(temp_file)
+                actions.append("discarded an unfinished trip re-score")
+
+            count = self._read_count()
+            for name, code in self.LAYOUT:
+                path = self.column_file(name)
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                count = min(count, size // array(code).itemsize)
+            if count != self._read_count():
+                self._write_count(count, True)
+                actions.append(f"trip log count set back to {count} complete rows")
+            for name, code in self.LAYOUT:
+                path = self.column_file(name)
+                if os.path.exists(path) and os.path.getsize(path) > count * array(code).itemsize:
+                    with open(path, "r+b") as file:
+                        file.truncate(count * array(code).itemsize)
+                    actions.append(f"dropped a partial append from {path}")
+            removed = truncate_torn_tail(self._path("users.txt"))
+            if removed:
+                actions.append(f"dropped {removed} bytes of a partial entry from {self._path('users.txt')}")
+        return actions
+
+    def _refresh_names(self):
+        # Picks up usernames added by other processes
+        path = self._path("users.txt")
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as file:
+            file.seek(self._names_offset)
+            data = file.read()
+        end = data.rfind(b"\n") + 1
+        for name in data[:end].decode("utf-8").splitlines():
+            self._ids.setdefault(name, len(self._names))
+            self._names.append(name)
+        self._names_offset += end
+
+    def __len__(self):
+        return self._read_count()
+
+    def append(self, trips):
+        # trips is a TripColumns batch; one write per column, then the new row count
+        if not len(trips):
+            return 0
+        version = get_factor_table().current_version()
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            self._refresh_names()
+            new_names = [name for name in trips.names if name not in self._ids]
+            if new_names:
+                with open(self._path("users.txt"), "ab+") as file:
+                    trim_partial_line(file)
+                    file.write("".join(name + "\n" for name in new_names).encode("utf-8"))
+                    FSYNC_POLICY.after_append(file)
+                self._refresh_names()
+            remap = [self._ids[name] for name in trips.names]
+
+            columns = dict(trips.columns)
+            columns["user"] = array("I", (remap[user] for user in trips.columns["user"]))
+            columns["version"] = array("H", [version]) * len(trips)
+            count = self._read_count()
+            sync = FSYNC_POLICY.should_sync(self._path("count"))
+            for name, code in self.LAYOUT:
+                values = columns[name]
+                if sys.byteorder != "little":
+                    values = array(code, values)
+                    values.byteswap()
+                with open(self.column_file(name), "ab+") as file:
+                    file.truncate(count * values.itemsize)  # Rows a crash left past the count
+                    file.seek(0, os.SEEK_END)
+                    values.tofile(file)
+                    file.flush()
+                    if sync:
+                        os.fsync(file.fileno())
+                METRICS.count("bytes_written", len(values) * values.itemsize, file="trip_log")
+            self._write_count(count + len(trips), sync)
+            return len(trips)
+
+    def read_columns(self):
+        # (usernames, {column: array}) for every committed row
+        with self._lock:
+            self._refresh_names()
+            count = self._read_count()
+            columns = {}
+            for name, code in self.LAYOUT:
+                values = array(code)
+                if count:
+                    with open(self.column_file(name), "rb") as file:
+                        values.fromfile(file, count)
+                if sys.byteorder != "little":
+                    values.byteswap()
+                columns[name] = values
+            return list(self._names), columns
+
+    def rescore(self, version=None, storage=None):
+        # Re-scores every logged trip with one factor version in a single batch pass and
+        # adds the per user-month differences to the stored totals
+        started = time.perf_counter()
+        lookup = get_factor_table().lookup(version)
+        version = get_factor_table().current_version() if version is None else version
+        storage = storage or get_storage()
+        report = RescoreReport(version)
+        with self._lock:
+            names, columns = self.read_columns()
+            old = columns["emission"]
+            fuel_by_code = self.FUEL_BY_CODE
+            new, _ = calculate_emissions_batch(columns["distance"], columns["efficiency"],
+                                               [fuel_by_code[code] for code in columns["fuel"]],
+                                               columns["urban"], lookup, columns["vehicle"])
+            report.trips = len(old)
+            report.total_before = math.fsum(old)
+
+            deltas = {}
+            breakdown = {}
+            # NaN: trip no longer scorable. Last-bit differences from a changed operation
+            # order are not real changes.
+            changed = [n == n and not math.isclose(n, o, rel_tol=1e-12) for n, o in zip(new, old)]
+            emission = array("d", old)
+            users, years, months = columns["user"], columns["year"], columns["month"]
+            vehicles, fuels = columns["vehicle"], columns["fuel"]
+            for i in compress(range(len(old)), changed):
+                delta = new[i] - old[i]
+                emission[i] = new[i]
+                key = (names[users[i]], years[i], VALID_MONTHS[months[i]])
+                deltas[key] = deltas.get(key, 0.0) + delta
+                fuel = fuel_by_code[fuels[i]]
+                vehicle_key = (VehicleType(vehicles[i]).name, fuel.name if fuel else "NONE")
+                breakdown[vehicle_key] = breakdown.get(vehicle_key, 0.0) + delta
+                report.changed += 1
+            report.deltas = deltas
+            report.total_after = math.fsum(emission)
+            if deltas:
+                self._commit_rescore(emission, version, deltas, storage)
+            else:
+                get_factor_table().activate(version)
+        try:
+            get_analytics().merge(deltas, breakdown)
+        except Exception as e:
+            print(f"Warning: fleet analytics not updated: {str(e)}", file=sys.stderr)
+        report.elapsed = time.perf_counter() - started
+        return report
+
+    def _commit_rescore(self, emission, version, deltas, storage):
+        # New columns are written aside, then a commit marker holding the deltas, then the
+        # columns are swapped in and the deltas merged step by step. Recovery redoes the swap
+        # and merges only the steps the marker does not list as done, so none applies twice.
+        versions = array("H", [version]) * len(emission)
+        temp_files = []
+        for name, values in (("emission", emission), ("version", versions)):
+            if sys.byteorder != "little":
+                values = array(values.typecode, values)
+                values.byteswap()
+            temp_file = self.column_file(name) + ".tmp"
+            with open(temp_file, "wb") as file:
+                values.tofile(file)
+                file.flush()
+                os.fsync(file.fileno())
+            temp_files.append(temp_file)
+        self._write_marker({"version": version, **pending_merge(storage, deltas)})
+        for temp_file in temp_files:
+            os.replace(temp_file, temp_file[:-len(".tmp")])
+        fsync_directory(self.commit_marker())
+        self._finish_rescore(storage)
+
+    def _write_marker(self, state):
+        atomic_write(self.commit_marker(), lambda file: json.dump(state, file))
+
+    def _finish_rescore(self, storage):
+        # Merges the steps still pending in the commit marker, recording each one as it lands
+        try:
+            with open(self.commit_marker(), "r") as file:
+                state = json.load(file)
+        except ValueError:
+            state = None  # Empty marker from an older version, which merged before writing it
+        if state is not None:
+            finish_pending_merge(storage, state, lambda: self._write_marker(state))
+            get_factor_table().activate(state["version"])
+        os.remove(self.commit_marker())
+
+class RescoreReport:
+    def __init__(self, version):
+        self.version = version
+        self.trips = 0
+        self.changed = 0
+        self.total_before = 0.0
+        self.total_after = 0.0
+        self.deltas = {}  # (username, year, month) -> kg CO₂ added
+        self.elapsed = 0.0
+
+    def display(self, top=5):
+        change = self.total_after - self.total_before
+        percent = change / self.total_before * 100 if self.total_before else 0.0
+        print(f"\n🔁 Re-score with emission factor version {self.version}:")
+        print(f"Trips re-scored: {self.trips}")
+        print(f"Trips changed: {self.changed}")
+        print(f"User-months updated: {len(self.deltas)}")
+        print(f"Logged trip total: {self.total_before:.2f} -> {self.total_after:.2f} kg CO₂ "
+              f"({change:+.2f}, {percent:+.1f}%)")
+        print(f"Elapsed: {self.elapsed:.2f} s")
+        largest = sorted(self.deltas.items(), key=lambda item: -abs(item[1]))[:top]
+        if largest:
+            print("Largest changes:")
+            for (username, year, month), delta in largest:
+                print(f"  {username} {month} {year}: {delta:+.2f} kg CO₂")
+
+_trip_log = None
+
+def get_trip_log():
+    global _trip_log
+    if _trip_log is None:
+        _trip_log = TripLog()
+    return _trip_log
+
+# Fleet-wide aggregates kept up to date on every write. State is a JSON snapshot plus an
+# append-only journal; each process replays journal lines written by other processes.
+# Kept in main.py: a module importing its locks and storage from main would load a second
+# copy of main when run as a script, with its own fsync policy, metrics and singletons.
+class FleetAnalytics:
+    UNATTRIBUTED = "UNKNOWN"  # history recorded before analytics existed
+
+    def __init__(self, path=None):
+        self.path = path or ANALYTICS_FILE
+        self._lock = file_lock(self.path)
+        self._snapshot_signature = None
+        self._journal_generation = None
+        self._journal_offset = 0
+        self._reset()
+
+    def journal_file(self):
+        return self.path + ".journal"
+
+    def _reset(self):
+        self.month_totals = {}  # "2025-Mar" -> kg CO₂
+        self.vehicle_totals = {}
+        self.fuel_totals = {}
+        self.user_totals = {}
+        self._ranking = []  # sorted (total, username) for percentiles and top-N
+
+    # --- applying changes -------------------------------------------------
+    def _apply(self, username, period, vehicle, fuel, emission):
+        if username:
+            self.month_totals[period] = self.month_totals.get(period, 0.0) + emission
+            old_total = self.user_totals.get(username)
+            if old_total is not None:
+                del self._ranking[bisect_left(self._ranking, (old_total, username))]
+            new_total = (old_total or 0.0) + emission
+            self.user_totals[username] = new_total
+            insort(self._ranking, (new_total, username))
+        if vehicle:
+            self.vehicle_totals[vehicle] = self.vehicle_totals.get(vehicle, 0.0) + emission
+            self.fuel_totals[fuel] = self.fuel_totals.get(fuel, 0.0) + emission
+
+    def _replay(self, data):
+        for line in data.decode("utf-8").splitlines():
+            username, period, vehicle, fuel, emission = line.split(",")
+            self._apply(username, period, vehicle, fuel, float(emission))
+
+    def _refresh(self):
+        # Reloads after another process wrote a snapshot, then replays new journal lines
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except FileNotFoundError:
+            signature = None
+        if signature != self._snapshot_signature:
+            self._reset()
+            self._journal_generation, self._journal_offset = None, 0
+            if signature is not None:
+                with open(self.path, "r") as file:
+                    state = json.load(file)
+                self.month_totals = state["month_totals"]
+                self.vehicle_totals = state["vehicle_totals"]
+                self.fuel_totals = state["fuel_totals"]
+                self.user_totals = state["user_totals"]
+                self._ranking = sorted((total, username) for username, total in self.user_totals.items())
+                self._journal_generation = state["journal_generation"]
+                self._journal_offset = state["journal_offset"]
+            self._snapshot_signature = signature
+
+        if not os.path.exists(self.journal_file()):
+            return
+        with open(self.journal_file(), "rb") as file:
+            generation = file.readline().decode("utf-8").strip()
+            if generation != self._journal_generation:
+                # A journal the snapshot has not seen yet; replay it from the start
+                self._journal_generation, self._journal_offset = generation, file.tell()
+            file.seek(self._journal_offset)
+            data = file.read()
+        end = data.rfind(b"\n") + 1  # Leave a partial last line for later
+        self._replay(data[:end])
+        self._journal_offset += end
+
+    def _append(self, lines):
+        with open(self.journal_file(), "ab+") as file:
+            trim_partial_line(file)
+            if file.seek(0, os.SEEK_END) == 0:
+                generation = os.urandom(8).hex()
+                file.write(f"{generation}\n".encode("utf-8"))
+                self._journal_generation, self._journal_offset = generation, file.tell()
+            file.write("".join(lines).encode("utf-8"))
+            size = file.tell()
+        self._refresh()
+        if size >= ANALYTICS_SNAPSHOT_THRESHOLD:
+            self._write_snapshot()
+
+    def record_many(self, entries):
+        # entries: (username, year, month, VehicleType, FuelType or None, emission) per trip
+        lines = [f"{username},{year}-{month},{vehicle.name},{fuel.name if fuel else 'NONE'},{emission!r}\n"
+                 for username, year, month, vehicle, fuel, emission in entries]
+        with self._lock:
+            self._refresh()
+            self._append(lines)
+
+    def record(self, username, year, month, vehicle, fuel, emission):
+        self.record_many([(username, year, month, vehicle, fuel, emission)])
+
+    def merge(self, totals, breakdown):
+        # Bulk updates: totals maps (username, year, month) -> kg, breakdown (vehicle, fuel) -> kg
+        lines = [f"{username},{year}-{month},,,{emission!r}\n"
+                 for (username, year, month), emission in totals.items()]
+        lines += [f",,{vehicle},{fuel},{emission!r}\n" for (vehicle, fuel), emission in breakdown.items()]
+        if lines:
+            with self._lock:
+                self._refresh()
+                self._append(lines)
+
+    def _write_snapshot(self):
+        state = {
+            "month_totals": self.month_totals,
+            "vehicle_totals": self.vehicle_totals,
+            "fuel_totals": self.fuel_totals,
+            "user_totals": self.user_totals,
+            # The journal position already folded in, so a crash before the journal
+            # is removed does not count those lines twice
+            "journal_generation": self._journal_generation,
+            "journal_offset": self._journal_offset,
+        }
+        atomic_write(self.path, lambda file: json.dump(state, file))
+        if os.path.exists(self.journal_file()):
+            os.remove(self.journal_file())
+        stat = os.stat(self.path)
+        self._snapshot_signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def rebuild(self, storage=None):
+        # Recomputes month and user totals from the emission table; vehicle and fuel
+        # breakdowns cannot be derived from it, so they are carried over
+        storage = storage or get_storage()
+        with self._lock:
+            self._refresh()
+            vehicle_totals, fuel_totals = self.vehicle_totals, self.fuel_totals
+            self._reset()
+            self.vehicle_totals, self.fuel_totals = vehicle_totals, fuel_totals
+            for year in storage.list_years():
+                for row in storage.iter_emission_rows(year):
+                    total = 0.0
+                    for month in VALID_MONTHS:
+                        value = float(row.get(month) or 0)
+                        if value:
+                            period = f"{year}-{month}"
+                            self.month_totals[period] = self.month_totals.get(period, 0.0) + value
+                            total += value
+                    username = row["username"]
+                    self.user_totals[username] = self.user_totals.get(username, 0.0) + total
+            self._ranking = sorted((total, username) for username, total in self.user_totals.items())
+            self._journal_generation, self._journal_offset = None, 0
+            self._write_snapshot()
+
+    # --- queries ----------------------------------------------------------
+    def fleet_total(self):
+        with self._lock:
+            self._refresh()
+            return sum(self.month_totals.values())
+
+    def monthly_totals(self, year=None):
+        # {month: kg CO₂} for one year, the current one by default
+        year = validate_year(year)
+        with self._lock:
+            self._refresh()
+            return {month: self.month_totals.get(f"{year}-{month}", 0.0) for month in VALID_MONTHS}
+
+    def period_totals(self):
+        # [(year, month, kg CO₂)] for every month with emissions, oldest first
+        with self._lock:
+            self._refresh()
+            totals = []
+            for period, total in self.month_totals.items():
+                year, _, month = period.partition("-")
+                totals.append((int(year), month, total))
+        return sorted(totals, key=lambda item: period_index(item[0], item[1]))
+
+    def breakdown(self, by):
+        # by is "vehicle" or "fuel"; emissions recorded before analytics show as UNKNOWN
+        with self._lock:
+            self._refresh()
+            totals = dict(self.vehicle_totals if by == "vehicle" else self.fuel_totals)
+            unattributed = sum(self.month_totals.values()) - sum(totals.values())
+            if unattributed > 1e-9:
+                totals[self.UNATTRIBUTED] = unattributed
+            return totals
+
+    def percentile(self, percent):
+        # Nearest-rank percentile of per-user totals
+        if not 0 <= percent <= 100:
+            raise ValueError("Percentile must be between 0 and 100")
+        with self._lock:
+            self._refresh()
+            if not self._ranking:
+                return 0.0
+            rank = max(1, -(-percent * len(self._ranking) // 100))
+            return self._ranking[int(rank) - 1][0]
+
+    def top_emitters(self, count=10):
+        with self._lock:
+            self._refresh()
+            return [(username, total) for total, username in reversed(self._ranking[-count:])] if count > 0 else []
+
+    def display(self, top=10, percentiles=(50, 90, 99)):
+        total = self.fleet_total()
+        print("\n🌍 Fleet Emission Analytics:")
+        print(f"Users: {len(self.user_totals)}")
+        print(f"Total: {total:.2f} kg CO₂")
+        print("\nBy month:")
+        for year, month, total in self.period_totals():
+            if total:
+                print(f"  {month} {year}: {total:.2f} kg CO₂")
+        for label, by in (("vehicle type", "vehicle"), ("fuel type", "fuel")):
+            print(f"\nBy {label}:")
+            for name, total in sorted(self.breakdown(by).items(), key=lambda item: -item[1]):
+                print(f"  {name}: {total:.2f} kg CO₂")
+        print("\nPer-user percentiles:")
+        for percent in percentiles:
+            print(f"  p{percent:g}: {self.percentile(percent):.2f} kg CO₂")
+        print(f"\nTop {top} emitters:")
+        for username, total in self.top_emitters(top):
+            print(f"  {username}: {total:.2f} kg CO₂")
+
+_analytics = None
+
+def get_analytics():
+    global _analytics
+    if _analytics is None:
+        _analytics = FleetAnalytics()
+    return _analytics
+
+# Stores one already validated and scored trip: the emission total, then the trip log and
+# fleet analytics, whose failures are reported but do not fail the write
+def store_trip(username, year, month, vehicle_type, fuel_type, fuel_efficiency, distance, urban_mode, emission):
+    try:
+        with METRICS.span("store.history"):
+            get_storage().record_emission(username, month, emission, year)
+    except IOError as e:
+        raise IOError(f"Failed to store emission data: {str(e)}")
+    except Exception as e:
+        raise ValueError(f"Error processing emission data: {str(e)}")
+
+    # Raw inputs are kept so the trip can be re-scored when emission factors change
+    try:
+        with METRICS.span("store.trip_log"):
+            trips = TripColumns()
+            trips.add(username, year, month, vehicle_type, fuel_type, fuel_efficiency, distance, urban_mode, emission)
+            get_trip_log().append(trips)
+    except Exception as e:
+        print(f"Warning: trip not added to the trip log: {str(e)}", file=sys.stderr)
+
+    # `analytics --rebuild` brings the aggregates back in line after a failure
+    try:
+        with METRICS.span("store.analytics"):
+            get_analytics().record(username, year, month, vehicle_type, fuel_type, emission)
+    except Exception as e:
+        print(f"Warning: fleet analytics not updated: {str(e)}", file=sys.stderr)
+
+# Enhanced EmissionHistory with error handling
+class EmissionHistory:
+    def __init__(self, user_input, carbon_emission, urban_mode=False):
+        if not isinstance(user_input, UserInput):
+            raise TypeError("user_input must be an instance of UserInput")
+        if not isinstance(carbon_emission, (int, float)) or carbon_emission < 0:
+            raise ValueError("Carbon emission must be a non-negative number")
         
+        self.user_input = user_input
+        self.carbon_emission = carbon_emission
+        self.urban_mode = urban_mode
+
+    def store_emission(self):
+        user_input = self.user_input
+        store_trip(user_input.username, user_input.emission_year, user_input.emission_month,
+                   user_input.vehicle_type, user_input.fuel_type, user_input.fuel_efficiency,
+                   user_input.distance_travelled, self.urban_mode, self.carbon_emission)
+
+    @staticmethod
+    def get_user_row(username, year=None):
+        # Monthly row for username in one year (the current one by default), or None
+        return get_storage().get_emission_row(username, year)
+
+# Enhanced EmissionHistoryViewer with error handling
+class EmissionHistoryViewer:
+    @staticmethod
+    def get_history(username, start=None, end=None):
+        # [(year, month, kg CO₂)] for the months with emissions; start and end are
+        # (year, month) periods, by default every stored year
+        validate_username(username)
+        storage = get_storage()
+        years = storage.list_years()
+        if not years:
+            return None
+        start = start or (years[0], VALID_MONTHS[0])
+        end = end or (years[-1], VALID_MONTHS[-1])
+        return [(year, month, value) for year, month, value in
+                storage.get_emission_range(username, start, end) if value]
+
+    @staticmethod
+    def view_emission_history(username, start=None, end=None):
+        try:
+            with METRICS.span("history.read"):
+                history = EmissionHistoryViewer.get_history(username, start, end)
+            if history is None:
+                print("No emission history found.")
+                return
+            if not history:
+                print("No emission records found for this user.")
+                return
+
+            with METRICS.span("history.render"):
+                print("\n📜 Emission History:")
+                for year, month, value in history:
+                    print(f"{month} {year}: {value} kg CO₂")
+                    
+        except IOError as e:
+            print(f"Error accessing emission history: {str(e)}")
+        except Exception as e:
+            print(f"Error viewing history: {str(e)}")
+
+def iter_report_rows(storage=None, usernames=None, years=None):
+    # (username, year, (12 monthly kg CO₂)) streamed year by year; with usernames, only their
+    # rows are read, one lookup each, instead of scanning the whole table
+    storage = storage or get_storage()
+    stored = storage.list_years()
+    if years is not None:
+        stored = [year for year in stored if year in set(years)]
+    for year in stored:
+        if usernames is None:
+            rows = storage.iter_emission_rows(year)
+        else:
+            rows = (storage.get_emission_row(username, year) for username in usernames)
+        for row in rows:
+            if row is not None:
+                yield row["username"], year, tuple(float(row.get(month) or 0) for month in VALID_MONTHS)
+
+def chunked(rows, size=EXPORT_CHUNK_ROWS):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Monthly reports, one row per user and year: username, year, Jan..Dec, total
+class ReportWriter:
+    MODE = "w"
+    FIELDNAMES = ["username", "year"] + VALID_MONTHS + ["total"]
+
+    def __init__(self, file):
+        self.file = file
+        self.rows = 0
+
+    def write_chunk(self, chunk):
+        self.rows += len(chunk)
+
+    def close(self):
+        pass
+
+class CSVReportWriter(ReportWriter):
+    def __init__(self, file):
+        super().__init__(file)
+        csv.writer(file).writerow(self.FIELDNAMES)
+
+    def write_chunk(self, chunk):
+        # One write per chunk: rows are formatted into a buffer first
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([username, year, *values, math.fsum(values)] for username, year, values in chunk)
+        self.file.write(buffer.getvalue())
+        super().write_chunk(chunk)
+
+class JSONLReportWriter(ReportWriter):
+    def write_chunk(self, chunk):
+        self.file.write("".join(json.dumps({"username": username, "year": year, **dict(zip(VALID_MONTHS, values)),
+                                            "total": math.fsum(values)}) + "\n"
+                                for username, year, values in chunk))
+        super().write_chunk(chunk)
+
+# Parquet-like columnar file: every chunk is a row group stored column by column (usernames as
+# newline-separated UTF-8, numbers as little-endian arrays), then a JSON footer with the schema
+# and each column chunk's offset and length, the footer's length and the magic again
+class ColumnarReportWriter(ReportWriter):
+    MODE = "wb"
+    MAGIC = b"VRPT"
+    VERSION = 1
+    FOOTER_SIZE = struct.Struct("<I")
+    SCHEMA = [("username", "utf8"), ("year", "H")] + [(month, "d") for month in VALID_MONTHS] + [("total", "d")]
+
+    def __init__(self, file):
+        super().__init__(file)
+        file.write(self.MAGIC)
+        self.offset = len(self.MAGIC)
+        self.row_groups = []
+
+    def write_chunk(self, chunk):
+        usernames, years, values = zip(*chunk)
+        columns = [("\n".join(usernames)).encode("utf-8"), array("H", years)]
+        columns += [array("d", (row[i] for row in values)) for i in range(len(VALID_MONTHS))]
+        columns.append(array("d", map(math.fsum, values)))
+        extents = []
+        for column in columns:
+            if isinstance(column, array):
+                if sys.byteorder != "little":
+                    column.byteswap()
+                column = column.tobytes()
+            self.file.write(column)
+            extents.append([self.offset, len(column)])
+            self.offset += len(column)
+        self.row_groups.append({"rows": len(chunk), "columns": extents})
+        super().write_chunk(chunk)
+
+    def close(self):
+        footer = json.dumps({"version": self.VERSION, "schema": self.SCHEMA, "rows": self.rows,
+                             "row_groups": self.row_groups}).encode("utf-8")
+        self.file.write(footer + self.FOOTER_SIZE.pack(len(footer)) + self.MAGIC)
+
+    @classmethod
+    def read(cls, path, columns=None):
+        # Yields {column: list of values} per row group, decoding only the requested columns
+        with open(path, "rb") as file:
+            if file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a columnar report")
+            file.seek(-(cls.FOOTER_SIZE.size + len(cls.MAGIC)), os.SEEK_END)
+            size, = cls.FOOTER_SIZE.unpack(file.read(cls.FOOTER_SIZE.size))
+            if file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is incomplete")
+            file.seek(-(size + cls.FOOTER_SIZE.size + len(cls.MAGIC)), os.SEEK_END)
+            footer = json.loads(file.read(size))
+            schema = [tuple(field) for field in footer["schema"]]
+            wanted = [name for name, _ in schema] if columns is None else columns
+            for group in footer["row_groups"]:
+                decoded = {}
+                for (name, code), (offset, length) in zip(schema, group["columns"]):
+                    if name not in wanted:
+                        continue
+                    file.seek(offset)
+                    data = file.read(length)
+                    if code == "utf8":
+                        decoded[name] = data.decode("utf-8").split("\n") if group["rows"] else []
+                    else:
+                        values = array(code)
+                        values.frombytes(data)
+                        if sys.byteorder != "little":
+                            values.byteswap()
+                        decoded[name] = values.tolist()
+                yield decoded
+
+REPORT_WRITERS = {"csv": CSVReportWriter, "jsonl": JSONLReportWriter, "columnar": ColumnarReportWriter}
+
+def export_reports(path, report_format="csv", usernames=None, years=None, storage=None):
+    # Streams the monthly reports into path ("-" for stdout, text formats only) in chunks of
+    # EXPORT_CHUNK_ROWS; a file only appears under its name once it is complete
+    writer_class = REPORT_WRITERS.get(report_format)
+    if writer_class is None:
+        raise ValueError(f"Invalid export format '{report_format}'. Use one of: {', '.join(REPORT_WRITERS)}")
+    if usernames is not None:
+        usernames = [validate_username(username) for username in usernames]
+    rows = iter_report_rows(storage, usernames, years)
+    if path == "-":
+        if writer_class.MODE == "wb":
+            raise ValueError("The columnar format needs an output file")
+        writer = writer_class(sys.stdout)
+        for chunk in chunked(rows):
+            writer.write_chunk(chunk)
+        writer.close()
+        sys.stdout.flush()
+        return writer.rows
+
+    temp_file = path + ".tmp"
+    try:
+        with open(temp_file, writer_class.MODE, buffering=EXPORT_BUFFER_SIZE,
+                  **({} if writer_class.MODE == "wb" else {"newline": ""})) as file:
+            writer = writer_class(file)
+            for chunk in chunked(rows):
+                writer.write_chunk(chunk)
+            writer.close()
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    os.replace(temp_file, path)
+    if METRICS.enabled:
+        METRICS.count("bytes_written", os.path.getsize(path), file=os.path.basename(path))
+    return writer.rows
+
+# A user's saved vehicle: validated once when it is registered, with its per-km factor
+# resolved from the current emission factors and cached until they change
+class VehicleProfile:
+    FIELDNAMES = ["username", "profile_id", "name", "vehicle_type", "fuel_type", "fuel_efficiency", "urban"]
+
+    def __init__(self, username, profile_id, name, vehicle_type, fuel_type, fuel_efficiency, urban_mode):
+        self.username = username
+        self.profile_id = profile_id
+        self.name = name
+        self.vehicle_type = vehicle_type
+        self.fuel_type = fuel_type
+        self.fuel_efficiency = fuel_efficiency
+        self.urban_mode = urban_mode
+        self._factor = None  # (EmissionFactorLookup, kg CO₂ per km)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row["username"], int(row["profile_id"]), row["name"], VehicleType[row["vehicle_type"]],
+                   FuelType[row["fuel_type"]] if row["fuel_type"] else None,
+                   float(row["fuel_efficiency"]) if row["fuel_efficiency"] else None, row["urban"] == "y")
+
+    def to_row(self):
+        return [self.username, self.profile_id, self.name, self.vehicle_type.name,
+                self.fuel_type.name if self.fuel_type else "", repr(self.fuel_efficiency) if self.fuel_efficiency else "",
+                "y" if self.urban_mode else "n"]
+
+    def factor(self):
+        # kg CO₂ per km for this vehicle; fuel-based profiles fold the efficiency in
+        lookup = get_factor_table().lookup()
+        cached = self._factor
+        if cached is None or cached[0] is not lookup:
+            if self.fuel_type and self.fuel_efficiency:
+                per_km = lookup.factor(self.vehicle_type, self.fuel_type) / self.fuel_efficiency
+            else:
+                per_km = lookup.factor(self.vehicle_type, None, self.urban_mode)
+            if per_km != per_km:
+                raise ValueError(f"No emission factor available for vehicle profile '{self.name}'")
+            cached = self._factor = (lookup, per_km)
+        return cached[1]
+
+    def calculate(self, distance):
+        return distance * self.factor()
+
+    def describe(self):
+        if self.fuel_type and self.fuel_efficiency:
+            basis = f"{self.fuel_type.name}, {self.fuel_efficiency:g} km/L"
+        else:
+            basis = "distance-based"
+        return f"[{self.profile_id}] {self.name} ({self.vehicle_type.name}, {basis}{', urban' if self.urban_mode else ''})"
+
+# vehicle_profiles.csv: one row per saved vehicle, appended like users.csv
+class VehicleProfileStore:
+    def __init__(self, path=VEHICLE_PROFILE_FILE):
+        self.path = path
+
+    @staticmethod
+    def load_profiles(path):
+        # username -> {profile id: VehicleProfile}
+        profiles = {}
+        with open(path, "r", newline="") as file:
+            for row in csv.DictReader(file):
+                profile = VehicleProfile.from_row(row)
+                profiles.setdefault(profile.username, {})[profile.profile_id] = profile
+        return profiles
+
+    def _profiles(self):
+        try:
+            return FILE_CACHE.get(self.path, self.load_profiles)
+        except FileNotFoundError:
+            return {}
+
+    def list(self, username):
+        return sorted(self._profiles().get(username, {}).values(), key=lambda profile: profile.profile_id)
+
+    def get(self, username, profile_id):
+        try:
+            return self._profiles()[username][int(profile_id)]
+        except (KeyError, ValueError, TypeError):
+            raise ValueError(f"No vehicle profile {profile_id} for user {username}")
+
+    def add(self, username, name, vehicle_type, fuel_type=None, fuel_efficiency=None, urban_mode=False):
+        username = validate_username(username)
+        name = str(name or "").strip()
+        if not 1 <= len(name) <= 30:
+            raise ValueError("Vehicle name must be between 1 and 30 characters")
+        vehicle_type = validate_vehicle_type(vehicle_type)
+        fuel_type = validate_fuel_type(fuel_type)
+        fuel_efficiency = validate_fuel_efficiency(fuel_efficiency)
+        if fuel_type and not fuel_efficiency:
+            raise ValueError("Fuel efficiency required when fuel type is specified")
+        if fuel_efficiency and not fuel_type:
+            raise ValueError("Fuel type required when fuel efficiency is specified")
+
+        with file_lock(self.path):
+            profile_id = max(self._profiles().get(username, {0: None})) + 1
+            profile = VehicleProfile(username, profile_id, name, vehicle_type, fuel_type, fuel_efficiency,
+                                     bool(urban_mode))
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            with open(self.path, "ab+") as file:
+                trim_partial_line(file)
+                if file.seek(0, os.SEEK_END) == 0:
+                    writer.writerow(VehicleProfile.FIELDNAMES)
+                writer.writerow(profile.to_row())
+                file.write(buffer.getvalue().encode("utf-8"))
+                FSYNC_POLICY.after_append(file)
+        return profile
+
+    def record_trip(self, username, profile_id, distance, month=None, year=None):
+        # Only the distance (and optional month/year) is validated per trip; returns the emission
+        profile = self.get(username, profile_id)
+        distance = validate_distance(distance)
+        month = validate_month(month) if month else VALID_MONTHS[datetime.now().month - 1]
+        year = validate_year(year)
+        emission = profile.calculate(distance)
+        store_trip(username, year, month, profile.vehicle_type, profile.fuel_type, profile.fuel_efficiency,
+                   distance, profile.urban_mode, emission)
+        return emission
+
+_profile_store = None
+
+def get_profile_store():
+    global _profile_store
+    if _profile_store is None:
+        _profile_store = VehicleProfileStore()
+    return _profile_store
+
+# Recurring trips ("25 km, 22 trips a month with the work car"). Each due month is scored
+# in closed form (one trip's emission x trips per month) and what every template added to
+# each month is remembered, so a change only writes the months whose total moved.
+class RecurringTripStore:
+    def __init__(self, path=RECURRING_TRIP_FILE):
+        self.path = path
+
+    @staticmethod
+    def load_file(path):
+        with open(path, "r") as file:
+            return json.load(file)
+
+    @staticmethod
+    def period_key(year, month):
+        return f"{year}-{MONTH_INDEX[month] + 1:02d}"
+
+    def _state(self):
+        try:
+            return FILE_CACHE.get(self.path, self.load_file)
+        except FileNotFoundError:
+            return {"next_id": 1, "templates": []}
+
+    def list(self, username):
+        return [template for template in self._state()["templates"] if template["username"] == username]
+
+    def describe(self, template):
+        profile = get_profile_store().get(template["username"], template["profile_id"])
+        until = f" until {template['end']}" if template["end"] else ""
+        return (f"[{template['id']}] {template['distance']:g} km x {template['trips']} trips/month with "
+                f"{profile.name}, from {template['start']}{until}")
+
+    @staticmethod
+    def validate_trips(trips):
+        try:
+            trips = int(str(trips).strip())
+        except ValueError:
+            raise ValueError("Trips per month must be a whole number")
+        if trips <= 0:
+            raise ValueError("Trips per month must be positive")
+        return trips
+
+    def validate_range(self, start, end):
+        start = self.period_key(*parse_period(start)) if start else self.period_key(*self.current_period())
+        end = self.period_key(*parse_period(end)) if end else None
+        if end and end < start:
+            raise ValueError("The template must not end before it starts")
+        return start, end
+
+    @staticmethod
+    def current_period():
+        now = datetime.now()
+        return now.year, VALID_MONTHS[now.month - 1]
+
+    def expand(self, template):
+        # {period key: kg CO₂} for every month of the template up to the current one
+        profile = get_profile_store().get(template["username"], template["profile_id"])
+        trip = calculate_emission(UserInput(
+            template["username"], profile.vehicle_type.name, profile.fuel_type.name if profile.fuel_type else "",
+            profile.fuel_efficiency, template["distance"], "Jan"), profile.urban_mode)
+        monthly = trip * template["trips"]
+        first = period_index(*parse_period(template["start"]))
+        last = period_index(*self.current_period())
+        if template["end"]:
+            last = min(last, period_index(*parse_period(template["end"])))
+        return {self.period_key(index // 12, VALID_MONTHS[index % 12]): monthly for index in range(first, last + 1)}
+
+    def add(self, username, profile_id, distance, trips, start=None, end=None, storage=None):
+        profile = get_profile_store().get(username, profile_id)
+        distance = validate_distance(distance)
+        trips = self.validate_trips(trips)
+        start, end = self.validate_range(start, end)
+        with file_lock(self.path):
+            state = self._load(storage)
+            template = {"id": state["next_id"], "username": username, "profile_id": profile.profile_id,
+                        "distance": distance, "trips": trips, "start": start, "end": end, "applied": {}}
+            state["next_id"] += 1
+            state["templates"].append(template)
+            self._apply(state, [template], storage, force_write=True)
+        return template
+
+    def edit(self, username, template_id, distance=None, trips=None, start=None, end=None, storage=None):
+        # Blank fields keep their value; end="none" makes the template open-ended again
+        with file_lock(self.path):
+            state = self._load(storage)
+            template = self._find(state, username, template_id)
+            if distance is not None:
+                template["distance"] = validate_distance(distance)
+            if trips is not None:
+                template["trips"] = self.validate_trips(trips)
+            if start is not None or end is not None:
+                new_end = template["end"] if end is None else (None if str(end).lower() == "none" else end)
+                template["start"], template["end"] = self.validate_range(start or template["start"], new_end)
+            self._apply(state, [template], storage, force_write=True)
+        return template
+
+    def remove(self, username, template_id, storage=None):
+        # Takes back everything the template added
+        with file_lock(self.path):
+            state = self._load(storage)
+            template = self._find(state, username, template_id)
+            state["templates"].remove(template)
+            self._apply(state, [template], storage, force_write=True, removed=True)
+
+    def sync(self, username=None, storage=None):
+        # Brings templates up to the current month and the current emission factors;
+        # returns the number of months whose total changed
+        with file_lock(self.path):
+            state = self._load(storage)
+            templates = [template for template in state["templates"]
+                         if username is None or template["username"] == username]
+            return self._apply(state, templates, storage)
+
+    def _load(self, storage):
+        # A copy of the state, with the merge a crash interrupted finished first
+        state = copy_state(self._state())
+        if "pending" in state:
+            self._merge_pending(state, storage)
+        return state
+
+    def recover(self, storage=None):
+        if not os.path.exists(self.path):
+            return []
+        with file_lock(self.path):
+            if "pending" not in self._state():
+                return []
+            self._load(storage)
+        return [f"finished an interrupted update of {self.path}"]
+
+    def _merge_pending(self, state, storage):
+        finish_pending_merge(storage or get_storage(), state["pending"], lambda: self._write(state))
+        del state["pending"]
+        self._write(state)
+
+    @staticmethod
+    def _find(state, username, template_id):
+        for template in state["templates"]:
+            if template["username"] == username and str(template["id"]) == str(template_id).strip():
+                return template
+        raise ValueError(f"No recurring trip {template_id} for user {username}")
+
+    def _apply(self, state, templates, storage, force_write=False, removed=False):
+        deltas = {}
+        breakdown = {}
+        for template in templates:
+            wanted = {} if removed else self.expand(template)
+            applied = template["applied"]
+            profile = get_profile_store().get(template["username"], template["profile_id"])
+            vehicle_key = (profile.vehicle_type.name, profile.fuel_type.name if profile.fuel_type else "NONE")
+            for period in set(wanted) | set(applied):
+                new, old = wanted.get(period, 0.0), applied.get(period, 0.0)
+                if math.isclose(new, old, rel_tol=1e-12):
+                    continue
+                year, month = parse_period(period)
+                key = (template["username"], year, month)
+                deltas[key] = deltas.get(key, 0.0) + new - old
+                breakdown[vehicle_key] = breakdown.get(vehicle_key, 0.0) + new - old
+                if period in wanted:
+                    applied[period] = new
+                else:
+                    del applied[period]
+        # The new applied amounts and the deltas are saved together before any is merged
+        if deltas:
+            state["pending"] = pending_merge(storage or get_storage(), deltas)
+        if deltas or force_write:
+            self._write(state)
+        if deltas:
+            self._merge_pending(state, storage)
+        try:
+            get_analytics().merge(deltas, breakdown)
+        except Exception as e:
+            print(f"Warning: fleet analytics not updated: {str(e)}", file=sys.stderr)
+        return len(deltas)
+
+    def _write(self, state):
+        atomic_write(self.path, lambda file: json.dump(state, file, indent=2))
+
+def copy_state(state):
+    # Deep copy of a JSON state so cached copies are never modified in place
+    return json.loads(json.dumps(state))
+
+_recurring_store = None
+
+def get_recurring_store():
+    global _recurring_store
+    if _recurring_store is None:
+        _recurring_store = RecurringTripStore()
+    return _recurring_store
+
+_calculators = {}  # (vehicle type, calculator class) -> shared calculator
+
+def get_calculator(user_input, urban_mode=False):
+    try:
+        if not isinstance(user_input, UserInput):
+            raise TypeError("Invalid user input type")
+            
+        if user_input.fuel_efficiency and user_input.fuel_type:
+            calculator_class = FuelBasedCalculator
+        elif urban_mode:
+            calculator_class = UrbanAdjustmentCalculator
+        else:
+            calculator_class = DistanceBasedCalculator
+        key = (user_input.vehicle_type, calculator_class)
+        calculator = _calculators.get(key)
+        if calculator is None:
+            calculator = _calculators.setdefault(key, calculator_class(user_input.vehicle_type))
+        return calculator
+    except Exception as e:
+        raise ValueError(f"Error selecting calculator: {str(e)}")
+
+# Batch emission engine for scoring many trips at once
+class BatchEmissionCalculator:
+    # Columns are any sequences (lists, array.array, NumPy arrays). Missing
+    # efficiencies may be None, "" or NaN; missing fuel types None or "".
+    @staticmethod
+    def _to_floats(values):
+        # Fast path for clean numeric columns; unparseable cells become None
+        try:
+            return list(map(float, values))
+        except (ValueError, TypeError):
+            floats = []
+            for value in values:
+                try:
+                    floats.append(float(value))
+                except (ValueError, TypeError):
+                    floats.append(None)
+            return floats
+
+    @staticmethod
+    def _parse_fuel_type(value):
+        if isinstance(value, FuelType):
+            return value, True
+        if not value:
+            return None, True
+        try:
+            return FuelType[value.upper()], True
+        except (KeyError, AttributeError):
+            return None, False
+
+    @classmethod
+    def _fuel_column(cls, fuel_types):
+        # Fuel columns hold a handful of distinct values, so parse each once
+        try:
+            parsed = {value: cls._parse_fuel_type(value) for value in set(fuel_types)}
+        except TypeError:
+            return [cls._parse_fuel_type(value) for value in fuel_types]
+        return [parsed[value] for value in fuel_types]
+
+    @classmethod
+    def build_masks(cls, distances, efficiencies, fuel_types, urban_flags=None):
+        size = len(distances)
+        if urban_flags is None:
+            urban_flags = [False] * size
+        if not (len(efficiencies) == len(fuel_types) == len(urban_flags) == size):
+            raise ValueError("All input columns must have the same length")
+
+        inf = float("inf")
+        dist_col = [d if d is not None and 0 < d < inf else None for d in cls._to_floats(distances)]
+
+        # NaN marks a missing efficiency in float columns, like None or ""
+        nan = float("nan")
+        eff_raw = cls._to_floats([nan if e is None or e == "" else e for e in efficiencies])
+        eff_ok = [e is not None and (e != e or 0 < e < inf) for e in eff_raw]
+        eff_col = [e if ok and e == e else None for e, ok in zip(eff_raw, eff_ok)]
+
+        fuel_pairs = cls._fuel_column(fuel_types)
+        fuel_col = [f for f, _ in fuel_pairs]
+
+        valid = [d is not None and e and ok for d, e, (_, ok) in zip(dist_col, eff_ok, fuel_pairs)]
+        fuel_mask = [v and e is not None and f is not None for v, e, f in zip(valid, eff_col, fuel_col)]
+        urban_mask = [v and not fm and bool(u) for v, fm, u in zip(valid, fuel_mask, urban_flags)]
+        distance_mask = [v and not fm and not um for v, fm, um in zip(valid, fuel_mask, urban_mask)]
+        return {
+            "distance": dist_col,
+            "efficiency": eff_col,
+            "fuel_type": fuel_col,
+            "valid": valid,
+            "fuel_mask": fuel_mask,
+            "urban_mask": urban_mask,
+            "distance_mask": distance_mask,
+        }
+
+    @staticmethod
+    def _vehicle_offsets(vehicle_types, size):
+        # Start of each row's vehicle block in the factor lookup; accepts VehicleType,
+        # names or enum values, and treats a missing column as all cars. An unknown
+        # vehicle type gives None, which makes that row invalid.
+        if vehicle_types is None:
+            return [0] * size
+        if len(vehicle_types) != size:
+            raise ValueError("All input columns must have the same length")
+        offsets = {}
+        for value in set(vehicle_types):
+            try:
+                if isinstance(value, VehicleType):
+                    vehicle_type = value
+                elif isinstance(value, int):
+                    vehicle_type = VehicleType(value)
+                else:
+                    vehicle_type = validate_vehicle_type(value)
+            except (ValueError, AttributeError):
+                offsets[value] = None
+                continue
+            offsets[value] = (vehicle_type.value - 1) * EmissionFactorLookup.VEHICLE_STRIDE
+        return [offsets[value] for value in vehicle_types]
+
+    @classmethod
+    def calculate(cls, distances, efficiencies, fuel_types, urban_flags=None, lookup=None, vehicle_types=None):
+        # lookup is an EmissionFactorLookup; the current factor version's by default
+        lookup = lookup or get_factor_table().lookup()
+        masks = cls.build_masks(distances, efficiencies, fuel_types, urban_flags)
+        offsets = cls._vehicle_offsets(vehicle_types, len(distances))
+        if None in offsets:
+            known = [offset is not None for offset in offsets]
+            for name in ("valid", "fuel_mask", "urban_mask", "distance_mask"):
+                masks[name] = [ok and vehicle_ok for ok, vehicle_ok in zip(masks[name], known)]
+        dist_col = masks["distance"]
+        eff_col = masks["efficiency"]
+        fuel_col = masks["fuel_type"]
+        emissions = array("d", [float("nan")]) * len(dist_col)
+
+        # Same operation order as the scalar calculators so results match bit for bit
+        factors = lookup.factors
+        adjustments = lookup.adjustments
+        for i in compress(range(len(dist_col)), masks["fuel_mask"]):
+            emissions[i] = dist_col[i] / eff_col[i] * factors[offsets[i] + fuel_col[i].value * 2]
+
+        for i in compress(range(len(dist_col)), masks["urban_mask"]):
+            emissions[i] = dist_col[i] * adjustments[offsets[i] + 1] * factors[offsets[i] + 1]
+
+        for i in compress(range(len(dist_col)), masks["distance_mask"]):
+            emissions[i] = dist_col[i] * factors[offsets[i]]
+
+        invalid_rows = array("q", (i for i, ok in enumerate(masks["valid"]) if not ok))
+        return emissions, invalid_rows
+
+def calculate_emissions_batch(distances, efficiencies, fuel_types, urban_flags=None, lookup=None,
+                              vehicle_types=None):
+    try:
+        return BatchEmissionCalculator.calculate(distances, efficiencies, fuel_types, urban_flags, lookup,
+                                                 vehicle_types)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Error in batch emission calculation: {str(e)}")
+
+# Bulk trip import: parse -> validate -> calculate -> aggregate -> one merge-write
+class ImportReport:
+    def __init__(self, max_rejects=IMPORT_MAX_REJECTS, trip_spool=None):
+        self.processed = 0
+        self.imported = 0
+        self.rejected = 0
+        self.rejected_rows = []  # (line number, reason), first max_rejects only
+        self.max_rejects = max_rejects
+        self.totals = {}
+        self.first_seen = {}  # (username, year, month) -> line number of its first trip
+        self.breakdown = {}  # (vehicle type, fuel type) -> kg CO₂, for fleet analytics
+        self.trip_spools = [trip_spool] if trip_spool else []  # scored trips waiting for the storage merge
+        self.trip_log_error = None  # first failed trip-log append; later chunks are not logged
+        self.elapsed = 0.0
+
+    def reject(self, line_no, reason):
+        self.rejected += 1
+        if len(self.rejected_rows) < self.max_rejects:
+            self.rejected_rows.append((line_no, reason))
+
+    def log_trips(self, trips):
+        # Raw inputs are spooled a chunk at a time, so an import never holds them all. They reach
+        # the trip log in commit_trips, once the totals are merged, so a failed merge logs nothing.
+        if not len(trips) or not self.trip_spools:
+            return
+        with open(self.trip_spools[-1], "ab") as file:
+            pickle.dump(trips, file, pickle.HIGHEST_PROTOCOL)
+
+    def commit_trips(self):
+        # Call after the storage merge: appends the spooled trips to the trip log chunk by chunk
+        for path in self.trip_spools:
+            try:
+                with open(path, "rb") as file:
+                    while True:
+                        try:
+                            trips = pickle.load(file)
+                        except EOFError:
+                            break
+                        get_trip_log().append(trips)
+            except FileNotFoundError:
+                continue  # No trip was scored into this spool
+            except Exception as e:
+                self.trip_log_error = str(e)
+                return
+
+    @property
+    def throughput(self):
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+
+    def display(self):
+        print("\n📥 Trip Import Summary:")
+        print(f"Rows processed: {self.processed}")
+        print(f"Trips imported: {self.imported}")
+        print(f"Rows rejected: {self.rejected}")
+        print(f"User-months updated: {len(self.totals)}")
+        print(f"Elapsed: {self.elapsed:.2f} s ({self.throughput:,.0f} rows/s)")
+        for line_no, reason in self.rejected_rows:
+            print(f"  line {line_no}: {reason}")
+        if self.rejected > len(self.rejected_rows):
+            print(f"  ... {self.rejected - len(self.rejected_rows)} more rejected rows not shown")
+
+def read_trip_records(path):
+    # Yields (line number, record dict) from a CSV file with a header row or a JSONL file
+    if path.lower().endswith((".jsonl", ".ndjson")):
+        with open(path, "r") as file:
+            for line_no, line in enumerate(file, 1):
+                yield from read_jsonl_line(line_no, line)
+    else:
+        with open(path, "r", newline="") as file:
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield reader.line_num, record
+
+def read_jsonl_line(line_no, line):
+    if not line.strip():
+        return
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        record = {"_error": f"Malformed JSON: {str(e)}"}
+    if not isinstance(record, dict):
+        record = {"_error": "Each JSONL line must be an object"}
+    yield line_no, record
+
+def parse_urban_flag(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in ("y", "yes", "true", "1")
+
+def validate_trip_records(records, report, chunk_size=IMPORT_CHUNK_SIZE):
+    # Yields (line number, UserInput, urban_mode) for valid records and reports the rest;
+    # records are checked a chunk at a time by the batch validator
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        report.processed += len(chunk)
+        fields = [record for _, record in chunk if "_error" not in record]
+        result = validate_columns(
+            [record.get("username") for record in fields],
+            [record.get("vehicle_type") or "" for record in fields],
+            [record.get("fuel_type") for record in fields],
+            [None if record.get("fuel_efficiency") == "" else record.get("fuel_efficiency") for record in fields],
+            [record.get("distance_travelled", record.get("distance")) for record in fields],
+            [str(record.get("emission_month", record.get("month")) or "").strip().capitalize() for record in fields],
+            [record.get("emission_year", record.get("year")) for record in fields])
+        errors = result.errors
+        user_inputs = result.user_inputs()  # valid rows, in order
+        row = 0
+        for line_no, record in chunk:
+            if "_error" in record:
+                report.reject(line_no, record["_error"])
+                continue
+            if errors[row]:
+                report.reject(line_no, result.message(row))
+            else:
+                yield line_no, next(user_inputs)[1], parse_urban_flag(record.get("urban"))
+            row += 1
+
+def score_trips(trips, report, chunk_size=IMPORT_CHUNK_SIZE):
+    # Yields (line number, UserInput, urban_mode, emission), scoring each chunk with the batch engine.
+    # Rows the engine cannot score (e.g. a NaN or infinite distance) are rejected, never merged.
+    while True:
+        chunk = list(islice(trips, chunk_size))
+        if not chunk:
+            return
+        emissions, invalid_rows = calculate_emissions_batch(
+            [user_input.distance_travelled for _, user_input, _ in chunk],
+            [user_input.fuel_efficiency for _, user_input, _ in chunk],
+            [user_input.fuel_type for _, user_input, _ in chunk],
+            [urban_mode for _, _, urban_mode in chunk],
+            vehicle_types=[user_input.vehicle_type for _, user_input, _ in chunk]
+        )
+        invalid_rows = set(invalid_rows)
+        for i, ((line_no, user_input, urban_mode), emission) in enumerate(zip(chunk, emissions)):
+            if i in invalid_rows:
+                report.reject(line_no, "Emission could not be calculated from this trip's values")
+                continue
+            yield line_no, user_input, urban_mode, emission
+
+def aggregate_emissions(scored, report, chunk_size=IMPORT_CHUNK_SIZE):
+    totals = report.totals
+    breakdown = report.breakdown
+    trips = TripColumns()
+    for line_no, user_input, urban_mode, emission in scored:
+        key = (user_input.username, user_input.emission_year, user_input.emission_month)
+        if key in totals:
+            totals[key] += emission
+        else:
+            totals[key] = emission
+            report.first_seen[key] = line_no
+        fuel = user_input.fuel_type.name if user_input.fuel_type else "NONE"
+        vehicle_key = (user_input.vehicle_type.name, fuel)
+        breakdown[vehicle_key] = breakdown.get(vehicle_key, 0.0) + emission
+        trips.add_user_input(user_input, urban_mode, emission)
+        report.imported += 1
+        if len(trips) >= chunk_size:
+            report.log_trips(trips)
+            trips = TripColumns()
+    report.log_trips(trips)
+    return totals
+
+def shard_for_username(username, shard_count):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(str(username).encode("utf-8")) % shard_count
+
+def read_spooled_records(spool_path):
+    # Same (line number, record) stream read_trip_records yields for the original rows
+    if spool_path.endswith(".jsonl"):
+        with open(spool_path, "r") as file:
+            for line in file:
+                line_no, _, raw = line.partition("\t")
+                yield from read_jsonl_line(int(line_no), raw)
+    else:
+        with open(spool_path, "r", newline="") as file:
+            reader = csv.DictReader(file)
+            for record in reader:
+                yield int(record.pop("_line")), record
+
+def spool_trip_file(path, spool_dir, shard_count):
+    # Splits the trip file into one spool file per username shard, keeping file order.
+    # Rows are copied mostly unparsed so the parent process stays cheap.
+    is_jsonl = path.lower().endswith((".jsonl", ".ndjson"))
+    extension = "jsonl" if is_jsonl else "csv"
+    spool_paths = [os.path.join(spool_dir, f"shard_{i:03d}.{extension}") for i in range(shard_count)]
+    files = [open(spool_path, "w", newline="") for spool_path in spool_paths]
+    try:
+        if is_jsonl:
+            with open(path, "r") as source:
+                for line_no, line in enumerate(source, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        username = json.loads(line).get("username", "")
+                    except (ValueError, AttributeError):
+                        username = ""
+                    files[shard_for_username(username, shard_count)].write(f"{line_no}\t{line.rstrip()}\n")
+        else:
+            with open(path, "r", newline="") as source:
+                reader = csv.reader(source)
+                header = next(reader, None)
+                while header == []:  # DictReader skips leading blank rows
+                    header = next(reader, None)
+                header = header or []
+                column = header.index("username") if "username" in header else None
+                writers = [csv.writer(file) for file in files]
+                for writer in writers:
+                    writer.writerow(["_line"] + header)
+                for row in reader:
+                    if not row:
+                        continue  # DictReader skips blank rows too
+                    username = row[column] if column is not None and column < len(row) else ""
+                    writers[shard_for_username(username, shard_count)].writerow([reader.line_num] + row)
+    finally:
+        for file in files:
+            file.close()
+    return spool_paths
+
+def import_trip_shard(spool_path, chunk_size, max_rejects):
+    # Runs in a worker process; every trip of a given username lands in the same shard.
+    # The worker spools its own trips, so only the totals travel back to the parent.
+    report = ImportReport(max_rejects, spool_path + ".trips")
+    trips = validate_trip_records(read_spooled_records(spool_path), report, chunk_size)
+    aggregate_emissions(score_trips(trips, report, chunk_size), report, chunk_size)
+    return report
+
+def merge_import_reports(reports, max_rejects):
+    # Shards hold disjoint usernames, so ordering keys by first line reproduces a serial run
+    merged = ImportReport(max_rejects)
+    first_seen = []
+    rejected_rows = []
+    for report in reports:
+        merged.processed += report.processed
+        merged.imported += report.imported
+        merged.rejected += report.rejected
+        rejected_rows.extend(report.rejected_rows)
+        for key, emission in report.breakdown.items():
+            merged.breakdown[key] = merged.breakdown.get(key, 0.0) + emission
+        merged.trip_spools.extend(report.trip_spools)
+        first_seen.extend((line_no, key, report.totals[key]) for key, line_no in report.first_seen.items())
+    for line_no, key, total in sorted(first_seen, key=lambda item: item[0]):
+        merged.totals[key] = total
+        merged.first_seen[key] = line_no
+    merged.rejected_rows = sorted(rejected_rows)[:max_rejects]
+    return merged
+
+def import_trips(path, chunk_size=IMPORT_CHUNK_SIZE, max_rejects=IMPORT_MAX_REJECTS, workers=1):
+    if chunk_size <= 0:
+        raise ValueError("Chunk size must be positive")
+    if workers <= 0:
+        raise ValueError("Worker count must be positive")
+    started = time.perf_counter()
+    try:
+        with tempfile.TemporaryDirectory(prefix="vehicalc_import_") as spool_dir:
+            if workers == 1:
+                report = ImportReport(max_rejects, os.path.join(spool_dir, "trips"))
+                trips = validate_trip_records(read_trip_records(path), report, chunk_size)
+                aggregate_emissions(score_trips(trips, report, chunk_size), report, chunk_size)
+            else:
+                get_trip_log()  # Recovered once here, not in every worker
+                spool_paths = spool_trip_file(path, spool_dir, workers)
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    reports = list(executor.map(import_trip_shard, spool_paths,
+                                                [chunk_size] * workers, [max_rejects] * workers))
+                report = merge_import_reports(reports, max_rejects)
+            get_storage().merge_emissions(report.totals)
+            report.commit_trips()
+    except IOError as e:
+        raise IOError(f"Failed to import trips: {str(e)}")
+    if report.trip_log_error is not None:
+        print(f"Warning: trips not added to the trip log: {report.trip_log_error}", file=sys.stderr)
+    try:
+        get_analytics().merge(report.totals, report.breakdown)
+    except Exception as e:
+        print(f"Warning: fleet analytics not updated: {str(e)}", file=sys.stderr)
+    report.elapsed = time.perf_counter() - started
+    return report
+
+# Stores several scored trips with one storage merge, one trip-log append and one analytics update
+def store_trip_batch(trips):
+    # trips: [(user_input, urban_mode, emission)]
+    totals = {}
+    breakdown = {}
+    columns = TripColumns()
+    for user_input, urban_mode, emission in trips:
+        key = (user_input.username, user_input.emission_year, user_input.emission_month)
+        totals[key] = totals.get(key, 0.0) + emission
+        vehicle_key = (user_input.vehicle_type.name, user_input.fuel_type.name if user_input.fuel_type else "NONE")
+        breakdown[vehicle_key] = breakdown.get(vehicle_key, 0.0) + emission
+        columns.add_user_input(user_input, urban_mode, emission)
+    try:
+        get_storage().merge_emissions(totals)
+    except IOError as e:
+        raise IOError(f"Failed to store emission data: {str(e)}")
+    try:
+        get_trip_log().append(columns)
+    except Exception as e:
+        print(f"Warning: trips not added to the trip log: {str(e)}", file=sys.stderr)
+    try:
+        get_analytics().merge(totals, breakdown)
+    except Exception as e:
+        print(f"Warning: fleet analytics not updated: {str(e)}", file=sys.stderr)
+
+class ServiceError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# Request counts and latencies per endpoint; percentiles cover the most recent requests
+class LatencyStats:
+    def __init__(self, window=SERVICE_LATENCY_WINDOW):
+        self.window = window
+        self.endpoints = {}  # "METHOD /path" -> [count, errors, total seconds, max seconds, recent deque]
+
+    def observe(self, endpoint, seconds, error=False):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = [0, 0, 0.0, 0.0, deque(maxlen=self.window)]
+        stats[0] += 1
+        stats[1] += 1 if error else 0
+        stats[2] += seconds
+        stats[3] = max(stats[3], seconds)
+        stats[4].append(seconds)
+
+    def snapshot(self):
+        report = {}
+        for endpoint, (count, errors, total, slowest, recent) in sorted(self.endpoints.items()):
+            ordered = sorted(recent)
+            rank = lambda p: ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+            report[endpoint] = {"count": count, "errors": errors, "mean_ms": round(total / count * 1000, 3),
+                                "p50_ms": round(rank(50) * 1000, 3), "p95_ms": round(rank(95) * 1000, 3),
+                                "max_ms": round(slowest * 1000, 3)}
+        return report
+
+# Local HTTP/JSON front end over the same User / calculator / EmissionHistory code as the menu.
+# Storage work runs on one worker thread, so in-process writes keep the order they arrived in;
+# password hashing runs on the Authenticator pool. The event loop only parses and routes requests.
+class VehiCalcService:
+    def __init__(self):
+        self.sessions = {}  # token -> (username, expires at)
+        self.stats = LatencyStats()
+        self._storage_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vehicalc-storage")
+        self.routes = {
+            ("POST", "/signup"): self.signup,
+            ("POST", "/login"): self.login,
+            ("POST", "/record"): self.record,
+            ("GET", "/history"): self.history,
+            ("POST", "/batch"): self.batch,
+            ("GET", "/metrics"): self.metrics,
+        }
+
+    def close(self):
+        self._storage_pool.shutdown()
+
+    async def run_storage(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._storage_pool, function, *args)
+
+    async def handle(self, method, path, query=None, body=None, token=None):
+        # Returns (status, JSON-serialisable body) and records the endpoint's latency
+        started = time.perf_counter()
+        endpoint = f"{method} {path}"
+        route = self.routes.get((method, path))
         try:
-            validate_password(password)
+            if route is None:
+                if any(route_path == path for _, route_path in self.routes):
+                    raise ServiceError(405, f"Method {method} not allowed for {path}")
+                raise ServiceError(404, f"Unknown endpoint: {path}")
+            status, result = 200, await route(query or {}, body if body is not None else {}, token)
+        except ServiceError as e:
+            status, result = e.status, {"error": str(e)}
         except ValueError as e:
-            errors.append(str(e))
-        
-        if errors:
-            raise ValueError("\n- " + "\n- ".join(errors))  # Combine errors
-        
-        # Proceed if validation passes
-        user = User(username, password)
-        user.save_user()
+            status, result = 400, {"error": str(e)}
+        except Exception as e:
+            status, result = 500, {"error": str(e)}
+        if route is not None:
+            self.stats.observe(endpoint, time.perf_counter() - started, status >= 400)
+        return status, result
+
+    def authenticate(self, token):
+        # Tokens expire SERVICE_SESSION_TTL seconds after their last use
+        session = self.sessions.get(token)
+        now = time.monotonic()
+        if session is None or session[1] < now:
+            self.sessions.pop(token, None)
+            raise ServiceError(401, "Log in first and send the token as 'Authorization: Bearer <token>'")
+        self.sessions[token] = (session[0], now + SERVICE_SESSION_TTL)
+        return session[0]
+
+    @staticmethod
+    def fields(body, *names):
+        if not isinstance(body, dict):
+            raise ValueError("Request body must be a JSON object")
+        return [body.get(name) for name in names]
+
+    async def signup(self, query, body, token):
+        username, password = self.fields(body, "username", "password")
+        username = validate_username(str(username or "").strip())
+        password = validate_password(str(password or "").strip())
+        user = User(username, password, await get_authenticator().hash_async(password))
+        await self.run_storage(user.save_user)
+        return {"username": user.username}
+
+    async def login(self, query, body, token):
+        username, password = self.fields(body, "username", "password")
+        username, password = str(username or "").strip(), str(password or "").strip()
+        if not await get_authenticator().verify_async(username, password, self.run_storage):
+            raise ServiceError(401, "Invalid username or password")
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        if len(self.sessions) > 10000:
+            self.sessions = {key: session for key, session in self.sessions.items() if session[1] >= now}
+        self.sessions[token] = (username, now + SERVICE_SESSION_TTL)
+        return {"token": token}
+
+    def score(self, username, body):
+        # The menu's record path: validate, then score with the current emission factors
+        vehicle_type, fuel_type, fuel_efficiency, distance, month, year, urban = self.fields(
+            body, "vehicle_type", "fuel_type", "fuel_efficiency", "distance", "month", "year", "urban")
+        user_input = UserInput(username, str(vehicle_type or ""), fuel_type or "", fuel_efficiency, distance,
+                               str(month or "").capitalize(), year)
+        user_input.validate()
+        urban_mode = bool(urban)
+        return user_input, urban_mode, calculate_emission(user_input, urban_mode)
+
+    async def record(self, query, body, token):
+        user_input, urban_mode, emission = self.score(self.authenticate(token), body)
+        await self.run_storage(EmissionHistory(user_input, emission, urban_mode).store_emission)
+        return {"emission": emission, "month": user_input.emission_month, "year": user_input.emission_year}
+
+    async def history(self, query, body, token):
+        username = self.authenticate(token)
+        start = parse_period(query["from"]) if query.get("from") else None
+        end = parse_period(query["to"]) if query.get("to") else None
+        rows = await self.run_storage(EmissionHistoryViewer.get_history, username, start, end)
+        return {"history": [{"year": year, "month": month, "emission": value} for year, month, value in rows or []]}
+
+    async def metrics(self, query, body, token):
+        return self.stats.snapshot()
+
+    async def batch(self, query, body, token):
+        # {"requests": [{"method", "path", "query", "body"}, ...]} -> {"responses": [{"status", "body"}, ...]}
+        # Runs of /record requests are stored with a single write.
+        requests = body.get("requests") if isinstance(body, dict) else None
+        if not isinstance(requests, list):
+            raise ValueError("Batch body must be {\"requests\": [...]}")
+        if len(requests) > SERVICE_MAX_BATCH:
+            raise ValueError(f"At most {SERVICE_MAX_BATCH} requests per batch")
+        responses = [None] * len(requests)
+        pending = []  # (index, scored trip) for the current run of records
+        for index, request in enumerate(requests + [None]):
+            is_record = (isinstance(request, dict) and request.get("method", "POST") == "POST"
+                         and request.get("path") == "/record")
+            if is_record:
+                try:
+                    pending.append((index, self.score(self.authenticate(token), request.get("body") or {})))
+                except ServiceError as e:
+                    responses[index] = {"status": e.status, "body": {"error": str(e)}}
+                except ValueError as e:
+                    responses[index] = {"status": 400, "body": {"error": str(e)}}
+                continue
+            if pending:
+                await self._store_pending(pending, responses)
+                pending = []
+            if request is None:
+                break
+            if not isinstance(request, dict) or request.get("path") == "/batch":
+                responses[index] = {"status": 400, "body": {"error": "Invalid batch entry"}}
+                continue
+            status, result = await self.handle(request.get("method", "GET"), request.get("path"),
+                                               request.get("query"), request.get("body"), token)
+            responses[index] = {"status": status, "body": result}
+        return {"responses": responses}
+
+    async def _store_pending(self, pending, responses):
+        try:
+            await self.run_storage(store_trip_batch, [trip for _, trip in pending])
+            for index, (user_input, urban_mode, emission) in pending:
+                responses[index] = {"status": 200, "body": {"emission": emission, "month": user_input.emission_month,
+                                                            "year": user_input.emission_year}}
+        except Exception as e:
+            for index, _ in pending:
+                responses[index] = {"status": 500, "body": {"error": str(e)}}
+
+    async def handle_connection(self, reader, writer):
+        # Minimal HTTP/1.1: JSON bodies with Content-Length, keep-alive unless the client closes
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                except ValueError:  # Longer than the stream limit
+                    await self.respond(writer, 400, {"error": "Request line too long"}, False)
+                    break
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, 400, {"error": "Malformed request line"}, False)
+                    break
+                headers = {}
+                try:
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                except ValueError:  # A header line longer than the stream limit
+                    await self.respond(writer, 431, {"error": "Request header line too long"}, False)
+                    break
+                keep_alive = (headers.get("connection", "").lower() != "close"
+                              and version.upper() == "HTTP/1.1")
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    # Without a usable length the body cannot be skipped, so the connection ends here
+                    await self.respond(writer, 400, {"error": "Invalid Content-Length"}, False)
+                    break
+                if length > SERVICE_MAX_BODY:
+                    await self.respond(writer, 413, {"error": "Request body too large"}, False)
+                    break
+                body = None
+                if length:
+                    try:
+                        body = json.loads(await reader.readexactly(length))
+                    except ValueError:
+                        await self.respond(writer, 400, {"error": "Request body must be JSON"}, keep_alive)
+                        continue
+                url = urlsplit(target)
+                query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                authorization = headers.get("authorization", "")
+                token = authorization[7:].strip() if authorization.lower().startswith("bearer ") else None
+                status, result = await self.handle(method.upper(), url.path, query, body, token)
+                await self.respond(writer, status, result, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def respond(writer, status, result, keep_alive):
+        payload = json.dumps(result).encode("utf-8")
+        reason = SERVICE_REASONS.get(status, "Error")
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}"
+                     f"\r\n\r\n".encode("latin-1") + payload)
+        await writer.drain()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT, ready=None):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        if ready is not None:
+            ready(server)
+        async with server:
+            await server.serve_forever()
+
+def run_service(host=SERVICE_HOST, port=SERVICE_PORT):
+    service = VehiCalcService()
+    bound = lambda server: print(f"VehiCalc service listening on http://{host}:{server.sockets[0].getsockname()[1]}")
+    try:
+        asyncio.run(service.serve(host, port, bound))
+    finally:
+        service.close()
+
+# One spooled file being ingested. The count of its lines already stored is kept in a sidecar
+# file, so a restart resumes after the last stored batch instead of replaying the whole file.
+class SpoolFile:
+    def __init__(self, path):
+        self.path = path
+        self.offset_file = path + ".offset"
+        self.committed = 0
+        self.last_line = None  # set once every line has been queued
+        self._lock = threading.Lock()
+        if os.path.exists(self.offset_file):
+            with open(self.offset_file, "r") as file:
+                self.committed = int(file.read().strip() or 0)
+
+    def commit(self, line_no):
+        # Called by the writer once the lines up to line_no are stored
+        with self._lock:
+            self.committed = max(self.committed, line_no)
+            if self.last_line is None or self.committed < self.last_line:
+                atomic_write(self.offset_file, lambda file: file.write(str(self.committed)))
+                return
+        self.remove()
+
+    def finish(self, last_line):
+        with self._lock:
+            self.last_line = last_line
+            if self.committed < last_line:
+                return
+        self.remove()
+
+    def remove(self):
+        for path in (self.path, self.offset_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+# Ingests complete *.jsonl files dropped into a directory, in name order. Producers write
+# elsewhere (or under another suffix) and rename the file in, so no file is read half-written.
+class SpoolSource:
+    name = "spool"
+
+    def __init__(self, directory=INGEST_SPOOL_DIR):
+        self.directory = directory
+        self.active = {}  # file name -> SpoolFile not fully stored yet
+        self.idle = False
+        os.makedirs(directory, exist_ok=True)
+
+    def run(self, daemon):
+        while not daemon.stopping.is_set():
+            self.active = {name: spool for name, spool in self.active.items() if os.path.exists(spool.path)}
+            names = [name for name in sorted(os.listdir(self.directory))
+                     if name.endswith(".jsonl") and name not in self.active]
+            self.idle = not names and not self.active
+            if not names:
+                daemon.stopping.wait(INGEST_POLL_INTERVAL)
+                continue
+            for name in names:
+                if not self.consume(daemon, name):
+                    return
+
+    def consume(self, daemon, name):
+        spool = self.active[name] = SpoolFile(os.path.join(self.directory, name))
+        line_no = 0
+        with open(spool.path, "r") as file:
+            for line_no, line in enumerate(file, 1):
+                if line_no <= spool.committed:
+                    continue
+                if not daemon.submit(line, time.time(), spool, line_no):
+                    return False
+        spool.finish(line_no)
+        return True
+
+    def close(self):
+        pass
+
+# Newline-delimited JSON events over a Unix domain socket. A full queue stops the reads,
+# so the socket buffer fills up and the senders block.
+class SocketSource:
+    name = "socket"
+
+    def __init__(self, path):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("Unix sockets are not available on this platform; use the spool directory")
+        self.path = path
+        self.connections = 0
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            os.remove(path)  # Left behind by an earlier run
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen()
+        self.server.settimeout(0.2)
+
+    @property
+    def idle(self):
+        return self.connections == 0
+
+    def run(self, daemon):
+        while not daemon.stopping.is_set():
+            try:
+                connection, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return  # Closed
+            connection.settimeout(None)
+            with self._lock:
+                self.connections += 1
+            threading.Thread(target=self.serve, args=(daemon, connection), daemon=True).start()
+
+    def serve(self, daemon, connection):
+        try:
+            with connection, connection.makefile("r", encoding="utf-8") as lines:
+                for line in lines:
+                    if not daemon.submit(line, time.time()):
+                        return
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self.connections -= 1
+
+    def close(self):
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Long-running ingestion: sources push raw JSON trip events (the import fields, plus an optional
+# "ts" in Unix seconds for when the trip ended) into a bounded queue, and one writer stores them
+# in micro-batches through the bulk import path. When storage lags, the queue fills and the
+# sources block, so producers slow down instead of memory growing; a backlog makes batches bigger.
+class IngestDaemon:
+    def __init__(self, batch_size=INGEST_BATCH_SIZE, batch_wait=INGEST_BATCH_WAIT, queue_limit=INGEST_QUEUE_LIMIT):
+        if batch_size <= 0 or queue_limit <= 0:
+            raise ValueError("Batch size and queue limit must be positive")
+        self.queue = queue.Queue(maxsize=queue_limit)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.stopping = threading.Event()
+        self.lag = LatencyStats()
+        self.sources = []
+        self.stored = 0
+        self.rejected = 0
+        self.batches = 0
+        self.last_lag = 0.0
+
+    def submit(self, line, received, spool=None, line_no=0):
+        # Blocks while the queue is full; False once the daemon is stopping
+        item = (line, received, spool, line_no)
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def start_source(self, source):
+        thread = threading.Thread(target=source.run, args=(self,), daemon=True, name=f"vehicalc-ingest-{source.name}")
+        self.sources.append((source, thread))
+        thread.start()
+
+    def next_batch(self, timeout):
+        # Up to batch_size events: waits for the first, then batch_wait for more, but always
+        # takes what is already queued
+        try:
+            batch = [self.queue.get(timeout=timeout) if timeout else self.queue.get_nowait()]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def process(self, batch):
+        report = ImportReport()
+        records = [record for index, (line, _, _, _) in enumerate(batch) for record in read_jsonl_line(index, line)]
+        with METRICS.span("ingest.score"):
+            scored = list(score_trips(validate_trip_records(records, report, chunk_size=max(1, len(records))), report))
+        self.store([(user_input, urban_mode, emission) for _, user_input, urban_mode, emission in scored])
+
+        # Stored: advance the spool offsets, then account for the batch
+        committed = {}
+        for _, _, spool, line_no in batch:
+            if spool is not None:
+                committed[spool] = max(committed.get(spool, 0), line_no)
+        for spool, line_no in committed.items():
+            spool.commit(line_no)
+        now = time.time()
+        timestamps = {index: record.get("ts") for index, record in records}
+        lags = []
+        for index, (_, received, _, _) in enumerate(batch):
+            started = timestamps.get(index)
+            # bool is an int subclass, but "ts": true is no timestamp; neither is a NaN or a future time
+            has_ts = isinstance(started, (int, float)) and not isinstance(started, bool) and 0 <= started <= now
+            lags.append(now - (started if has_ts else received))
+            self.lag.observe("end_to_end", lags[-1])
+        for index, reason in report.rejected_rows:
+            _, _, spool, line_no = batch[index]
+            origin = f"{spool.path} line {line_no}" if spool is not None else "socket"
+            print(f"Rejected event ({origin}): {reason}", file=sys.stderr)
+        self.stored += len(scored)
+        self.rejected += report.rejected
+        self.batches += 1
+        self.last_lag = max(lags)
+        if METRICS.enabled:
+            METRICS.count("ingest_events", len(scored), result="stored")
+            METRICS.count("ingest_events", report.rejected, result="rejected")
+            METRICS.count("ingest_batches")
+            for lag in lags:
+                METRICS.observe("ingest.lag", lag)
+            METRICS.gauge("ingest_queue_depth", self.queue.qsize())
+            METRICS.gauge("ingest_lag_seconds", self.last_lag)
+
+    def store(self, trips):
+        # A failed write is retried with backoff: the events stay unacknowledged, and the
+        # blocked writer holds the sources back through the full queue
+        delay = 0.1
+        while trips:
+            try:
+                with METRICS.span("ingest.store"):
+                    store_trip_batch(trips)
+                return
+            except IOError as e:
+                if self.stopping.is_set():
+                    raise
+                print(f"Warning: ingest batch not stored, retrying in {delay:.1f} s: {str(e)}", file=sys.stderr)
+                self.stopping.wait(delay)
+                delay = min(delay * 2, INGEST_RETRY_MAX)
+
+    def status(self):
+        return {"queue_depth": self.queue.qsize(), "queue_limit": self.queue.maxsize, "stored": self.stored,
+                "rejected": self.rejected, "batches": self.batches, "last_lag_s": round(self.last_lag, 6),
+                "lag": self.lag.snapshot().get("end_to_end", {})}
+
+    def report(self):
+        status = self.status()
+        lag = status["lag"]
+        print(f"[ingest] queue {status['queue_depth']}/{status['queue_limit']}, {status['stored']} stored, "
+              f"{status['rejected']} rejected in {status['batches']} batches; end-to-end lag "
+              f"p50 {lag.get('p50_ms', 0)} ms, p95 {lag.get('p95_ms', 0)} ms, max {lag.get('max_ms', 0)} ms", flush=True)
+        if METRICS.enabled:
+            METRICS.gauge("ingest_queue_depth", status["queue_depth"])
+            METRICS.dump()
+
+    def run(self, exit_when_idle=False):
+        next_report = time.monotonic() + INGEST_REPORT_INTERVAL
+        try:
+            while True:
+                batch = self.next_batch(0.2)
+                if batch:
+                    self.process(batch)
+                elif exit_when_idle and all(source.idle for source, _ in self.sources):
+                    break
+                if time.monotonic() >= next_report:
+                    self.report()
+                    next_report = time.monotonic() + INGEST_REPORT_INTERVAL
+        except KeyboardInterrupt:
+            print("\nStopping ingestion...")
+        finally:
+            self.stopping.set()
+            for source, thread in self.sources:
+                source.close()
+                thread.join(1.0)
+            # Whatever was queued before the stop is still stored
+            batch = self.next_batch(0)
+            while batch:
+                self.process(batch)
+                batch = self.next_batch(0)
+            self.report()
+
+def run_ingest(spool=None, socket_path=None, batch_size=INGEST_BATCH_SIZE, batch_wait=INGEST_BATCH_WAIT,
+               queue_limit=INGEST_QUEUE_LIMIT, exit_when_idle=False):
+    daemon = IngestDaemon(batch_size, batch_wait, queue_limit)
+    if socket_path:
+        daemon.start_source(SocketSource(socket_path))
+    if spool or not socket_path:
+        daemon.start_source(SpoolSource(spool or INGEST_SPOOL_DIR))
+    print(f"Ingesting from {', '.join(source.name for source, _ in daemon.sources)} (Ctrl+C to stop)", flush=True)
+    daemon.run(exit_when_idle)
+    return daemon
+
+def clear_screen():
+    # ANSI clear and home instead of spawning cls/clear; nothing to clear when output is not a terminal
+    if sys.stdout.isatty():
+        sys.stdout.write("\033[2J\033[H")
+        sys.stdout.flush()
+
+def main_menu():
+    while True:
+        try:
+            clear_screen()
+            print("\n=== VehiCalc - Carbon Footprint Calculator ===")
+            print("[1] Sign Up\n[2] Log In\n[3] Exit")
+            choice = input("Choose an option (1-3): ").strip()
+            
+            if choice == "1":
+                handle_signup()
+            elif choice == "2":
+                handle_login()
+            elif choice == "3":
+                print("Thank you for using VehiCalc. Goodbye!")
+                exit()
+            else:
+                print("Invalid choice. Please enter 1, 2, or 3.")
+                input("Press Enter to continue...")
+                
+        except KeyboardInterrupt:
+            print("\nOperation cancelled by user.")
+            exit()
+        except Exception as e:
+            print(f"\nError: {str(e)}")
+            input("Press Enter to continue...")
+
+def register_user(username, password):
+    # Validate both fields FIRST, collect all errors
+    errors = []
+    try:
+        validate_username(username)
+    except ValueError as e:
+        errors.append(str(e))
+
+    try:
+        validate_password(password)
+    except ValueError as e:
+        errors.append(str(e))
+
+    if errors:
+        raise ValueError("\n- " + "\n- ".join(errors))  # Combine errors
+
+    # Proceed if validation passes
+    user = User(username, password)
+    user.save_user()
+    return user
+
+def log_in(username, password):
+    with METRICS.span("login.total"):
+        valid = User.validate_user(username, password)
+    METRICS.count("logins", result="ok" if valid else "rejected")
+    return valid
+
+def handle_signup():
+    clear_screen()
+    print("\n=== User Registration ===")
+    username = input("Enter username (4-20 alphanumeric characters): ").strip()
+    password = input("Enter password (minimum 8 characters): ").strip()
+    
+    try:
+        register_user(username, password)
         print("\n✅ User registered successfully!")
     
     except ValueError as e:
@@ -383,7 +5015,7 @@ def handle_login():
     password = input("Password: ").strip()
     
     try:
-        if User.validate_user(username, password):
+        if log_in(username, password):
             user_session(username)
         else:
             print("\n❌ Invalid username or password")
@@ -393,23 +5025,34 @@ def handle_login():
         input("Press Enter to try again...")
 
 def user_session(username):
+    try:
+        get_recurring_store().sync(username)  # Adds the recurring trips of months started since the last login
+    except Exception as e:
+        print(f"Warning: recurring trips not updated: {str(e)}", file=sys.stderr)
     while True:
         try:
             clear_screen()
             print(f"\n=== Welcome, {username} ===")
-            print("[1] Record Emission\n[2] View Emission History\n[3] Logout")
-            action = input("Choose an action (1-3): ").strip()
+            print("[1] Record Emission\n[2] Record Trip with a Saved Vehicle\n[3] Add a Vehicle"
+                  "\n[4] Recurring Trips\n[5] View Emission History\n[6] Logout")
+            action = input("Choose an action (1-6): ").strip()
             
             if action == "1":
                 record_emission(username)
             elif action == "2":
-                view_history(username)
+                record_profile_trip(username)
             elif action == "3":
+                add_vehicle_profile(username)
+            elif action == "4":
+                manage_recurring_trips(username)
+            elif action == "5":
+                view_history(username)
+            elif action == "6":
                 print("\nLogging out...")
                 input("Press Enter to continue...")
                 return
             else:
-                print("Invalid choice. Please enter 1, 2, or 3.")
+                print("Invalid choice. Please enter 1 to 6.")
                 input("Press Enter to continue...")
                 
         except KeyboardInterrupt:
@@ -444,28 +5087,32 @@ def record_emission(username):
         fuel_efficiency = input("Enter fuel efficiency (km/L) or leave blank: ").strip() or None
         distance_travelled = input("Enter distance travelled (km): ").strip()
         emission_month = input("Enter month (e.g., Jan, Feb, etc.): ").strip().capitalize()
+        emission_year = input("Enter year (leave blank for the current year): ").strip()
         urban_mode = input("Is the travel in urban traffic? (y/n): ").strip().lower() == "y"
         
         # Create and validate user input
-        user_input = UserInput(
-            username=username,
-            vehicle_type=vehicle_type,
-            fuel_type=fuel_type,
-            fuel_efficiency=fuel_efficiency,
-            distance_travelled=distance_travelled,
-            emission_month=emission_month
-        )
+        with METRICS.span("record.validate"):
+            user_input = UserInput(
+                username=username,
+                vehicle_type=vehicle_type,
+                fuel_type=fuel_type,
+                fuel_efficiency=fuel_efficiency,
+                distance_travelled=distance_travelled,
+                emission_month=emission_month,
+                emission_year=emission_year
+            )
         
         # Calculate emissions
-        calculator = get_calculator(user_input, urban_mode)
-        emission = calculator.calculate_carbon_emission()
+        with METRICS.span("record.calculate"):
+            emission = calculate_emission(user_input, urban_mode)
         
         # Show summary and store
         summary = CarbonFootPrintSummary(user_input, emission)
         summary.display_summary()
         
-        history = EmissionHistory(user_input, emission)
-        history.store_emission()
+        with METRICS.span("record.store"):
+            history = EmissionHistory(user_input, emission, urban_mode)
+            history.store_emission()
         
         print("\n✅ Emission recorded successfully!")
         input("Press Enter to continue...")
@@ -477,6 +5124,100 @@ def record_emission(username):
         print(f"\n❌ Error recording emission: {str(e)}")
         input("Press Enter to try again...")
 
+def add_vehicle_profile(username):
+    clear_screen()
+    print("\n=== Add a Vehicle ===")
+    try:
+        name = input("Vehicle name (e.g., Work car): ").strip()
+        print("\nAvailable vehicle types:")
+        for i, vt in enumerate(VehicleType, 1):
+            print(f"[{i}] {vt.name}")
+        vt_choice = input("Select vehicle type (1-3): ").strip()
+        vehicle_type = list(VehicleType)[int(vt_choice)-1].name
+
+        print("\nAvailable fuel types:")
+        for i, ft in enumerate(FuelType, 1):
+            print(f"[{i}] {ft.name}")
+        print("[0] Skip (for distance-based calculation)")
+        ft_choice = input("Select fuel type (0-2): ").strip()
+        fuel_type = list(FuelType)[int(ft_choice)-1].name if ft_choice != "0" else ""
+        fuel_efficiency = input("Enter fuel efficiency (km/L) or leave blank: ").strip() or None
+        urban_mode = input("Is it mostly driven in urban traffic? (y/n): ").strip().lower() == "y"
+
+        profile = get_profile_store().add(username, name, vehicle_type, fuel_type, fuel_efficiency, urban_mode)
+        print(f"\n✅ Saved {profile.describe()}")
+        input("Press Enter to continue...")
+    except (ValueError, IndexError) as e:
+        print(f"\n❌ Invalid input: {str(e)}")
+        input("Press Enter to try again...")
+    except Exception as e:
+        print(f"\n❌ Error saving vehicle: {str(e)}")
+        input("Press Enter to try again...")
+
+def record_profile_trip(username):
+    clear_screen()
+    print("\n=== Record Trip with a Saved Vehicle ===")
+    try:
+        store = get_profile_store()
+        profiles = store.list(username)
+        if not profiles:
+            print("\nNo saved vehicles yet. Add one from the menu first.")
+            input("Press Enter to continue...")
+            return
+        for profile in profiles:
+            print(profile.describe())
+        profile_id = input("Select vehicle: ").strip()
+        distance = input("Enter distance travelled (km): ").strip()
+
+        emission = store.record_trip(username, profile_id, distance)
+        print(f"\n✅ Recorded {emission:.2f} kg CO₂ for {VALID_MONTHS[datetime.now().month - 1]}")
+        input("Press Enter to continue...")
+    except ValueError as e:
+        print(f"\n❌ Invalid input: {str(e)}")
+        input("Press Enter to try again...")
+    except Exception as e:
+        print(f"\n❌ Error recording trip: {str(e)}")
+        input("Press Enter to try again...")
+
+def manage_recurring_trips(username):
+    clear_screen()
+    print("\n=== Recurring Trips ===")
+    try:
+        store = get_recurring_store()
+        for template in store.list(username):
+            print(store.describe(template))
+        print("\n[1] Add\n[2] Change\n[3] Remove\n[0] Back")
+        action = input("Choose an action (0-3): ").strip()
+        if action == "1":
+            for profile in get_profile_store().list(username):
+                print(profile.describe())
+            profile_id = input("Select vehicle: ").strip()
+            distance = input("Distance per trip (km): ").strip()
+            trips = input("Trips per month (e.g., 22 workdays): ").strip()
+            start = input("First month (e.g., Mar 2025) or leave blank for this month: ").strip()
+            end = input("Last month or leave blank if ongoing: ").strip()
+            template = store.add(username, profile_id, distance, trips, start, end)
+            print(f"\n✅ Saved {store.describe(template)}")
+        elif action == "2":
+            template_id = input("Recurring trip to change: ").strip()
+            distance = input("New distance per trip (km) or leave blank: ").strip() or None
+            trips = input("New trips per month or leave blank: ").strip() or None
+            end = input("New last month, 'none' if ongoing, or leave blank: ").strip() or None
+            template = store.edit(username, template_id, distance, trips, end=end)
+            print(f"\n✅ Updated {store.describe(template)}")
+        elif action == "3":
+            store.remove(username, input("Recurring trip to remove: ").strip())
+            print("\n✅ Removed")
+        else:
+            return
+        input("Press Enter to continue...")
+    except ValueError as e:
+        print(f"\n❌ Invalid input: {str(e)}")
+        input("Press Enter to try again...")
+    except Exception as e:
+        print(f"\n❌ Error updating recurring trips: {str(e)}")
+        input("Press Enter to try again...")
+
 def view_history(username):
     clear_screen()
     print("\n=== Emission History ===")
@@ -487,9 +5228,364 @@ def view_history(username):
         print(f"\n❌ Error viewing history: {str(e)}")
         input("Press Enter to try again...")
 
+# Headless sessions: the signup, login, record and history flows driven by one JSON command per
+# line, e.g. {"op": "login", "username": "alice", "password": "..."}, with one JSON result per
+# command. An optional "session" name lets a single stream interleave many logged-in users.
+class HeadlessRunner:
+    def __init__(self):
+        self.sessions = {}  # session name -> logged-in username
+        self.commands = 0
+        self.failed = 0
+        self.ops = {"signup": self.signup, "login": self.login, "logout": self.logout,
+                    "record": self.record, "history": self.history}
+
+    def run(self, command):
+        self.commands += 1
+        op = command.get("op") if isinstance(command, dict) else None
+        try:
+            handler = self.ops.get(op)
+            if handler is None:
+                raise ValueError(f"Unknown op: {op}. Use one of: {', '.join(self.ops)}")
+            return {"op": op, "ok": True, "result": handler(command)}
+        except Exception as e:
+            self.failed += 1
+            return {"op": op, "ok": False, "error": str(e)}
+
+    @staticmethod
+    def session_name(command):
+        return str(command.get("session", ""))
+
+    def session_user(self, command):
+        username = self.sessions.get(self.session_name(command))
+        if username is None:
+            raise ValueError("Log in first")
+        return username
+
+    def signup(self, command):
+        username, password = VehiCalcService.fields(command, "username", "password")
+        user = register_user(str(username or "").strip(), str(password or "").strip())
+        return {"username": user.username}
+
+    def login(self, command):
+        username, password = VehiCalcService.fields(command, "username", "password")
+        username = str(username or "").strip()
+        if not log_in(username, str(password or "").strip()):
+            raise ValueError("Invalid username or password")
+        self.sessions[self.session_name(command)] = username
+        result = {"username": username}
+        try:
+            get_recurring_store().sync(username)  # As at the start of a menu session
+        except Exception as e:
+            result["warning"] = f"recurring trips not updated: {str(e)}"
+        return result
+
+    def logout(self, command):
+        return {"username": self.sessions.pop(self.session_name(command), None)}
+
+    def record(self, command):
+        username = self.session_user(command)
+        vehicle_type, fuel_type, fuel_efficiency, distance, month, year, urban = VehiCalcService.fields(
+            command, "vehicle_type", "fuel_type", "fuel_efficiency", "distance", "month", "year", "urban")
+        urban_mode = str(urban).strip().lower() in ("y", "yes", "true", "1")
+        with METRICS.span("record.validate"):
+            user_input = UserInput(username, str(vehicle_type or ""), str(fuel_type or ""), fuel_efficiency or None,
+                                   distance, str(month or "").strip().capitalize(), year)
+            user_input.validate()
+        with METRICS.span("record.calculate"):
+            emission = calculate_emission(user_input, urban_mode)
+        with METRICS.span("record.store"):
+            EmissionHistory(user_input, emission, urban_mode).store_emission()
+        return {"emission": emission, "month": user_input.emission_month, "year": user_input.emission_year}
+
+    def history(self, command):
+        username = self.session_user(command)
+        start = parse_period(command["from"]) if command.get("from") else None
+        end = parse_period(command["to"]) if command.get("to") else None
+        rows = EmissionHistoryViewer.get_history(username, start, end)
+        return [{"year": year, "month": month, "emission": value} for year, month, value in rows or []]
+
+def run_script(path="-", output=None):
+    # Reads commands from path ("-" for stdin), writes one JSON result per line to output or stdout
+    runner = HeadlessRunner()
+    source = sys.stdin if path == "-" else open(path, "r")
+    target = sys.stdout if output is None else open(output, "w")
+    started = time.perf_counter()
+    try:
+        for line_no, line in enumerate(source, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                result = runner.run(json.loads(line))
+            except ValueError:
+                runner.commands += 1
+                runner.failed += 1
+                result = {"op": None, "ok": False, "error": "Command must be a JSON object"}
+            target.write(json.dumps(dict(line=line_no, **result)) + "\n")
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if target is not sys.stdout:
+            target.close()
+        else:
+            target.flush()
+    elapsed = time.perf_counter() - started
+    rate = runner.commands / elapsed if elapsed > 0 else 0.0
+    print(f"{runner.commands} commands, {runner.failed} failed in {elapsed:.2f} s ({rate:,.0f}/s)", file=sys.stderr)
+    return runner
+
+def show_emission_factors(changes, use=None, load=None):
+    table = get_factor_table()
+    if load:
+        print(f"Added emission factor version {table.load_csv(load)} from {load}")
+    if changes:
+        try:
+            parsed = dict(change.split("=", 1) for change in changes)
+        except ValueError:
+            raise ValueError("Factor changes must look like NAME=VALUE")
+        print(f"Added emission factor version {table.add(parsed)}")
+    if use is not None:
+        table.activate(use)
+    current = table.current_version()
+    for version in sorted(table.versions()):
+        lookup = table.lookup(version)
+        print(f"v{version}{' (current)' if version == current else ''}:")
+        for vehicle_type in VehicleType:
+            fuel = ", ".join(f"{fuel_type.name} {lookup.factor(vehicle_type, fuel_type):g} kg/L"
+                             for fuel_type in FuelType)
+            print(f"  {vehicle_type.name}: {fuel}; {lookup.factor(vehicle_type):g} kg/km, "
+                  f"urban {lookup.factor(vehicle_type, urban_mode=True):g} kg/km")
+    if load or changes or use is not None:
+        print("Run `python main.py rescore` to apply it to recorded trips.")
+    return 0
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="VehiCalc - Carbon Footprint Calculator")
+    parser.add_argument("--storage", default=os.environ.get("VEHICALC_STORAGE", "csv"),
+                        help="'csv' (default), 'sqlite:PATH', 'binary[:PATH]' or 'sharded[:BUCKETS]'")
+    parser.add_argument("--group-commit", action="store_true",
+                        help="batch concurrent emission writes into a single flush")
+    parser.add_argument("--fsync", default=os.environ.get("VEHICALC_FSYNC", "always"),
+                        help="fsync policy for appends: always (default), every:N, interval:MS or never")
+    parser.add_argument("--metrics", nargs="?", const=METRICS_FILE, default=os.environ.get("VEHICALC_METRICS"),
+                        metavar="FILE", help=f"record timing spans and counters, written to FILE on exit "
+                                             f"in the Prometheus text format (default: {METRICS_FILE})")
+    parser.add_argument("--profile", metavar="FILE", help="capture a cProfile profile of the run into FILE")
+    parser.add_argument("--tracemalloc", type=int, default=0, metavar="N",
+                        help="trace allocations and print the top N allocation sites on exit")
+    subparsers = parser.add_subparsers(dest="command")
+
+    migrate_parser = subparsers.add_parser("migrate", help="copy the CSV files into an SQLite database")
+    migrate_parser.add_argument("db", help="SQLite database path")
+
+    analytics_parser = subparsers.add_parser("analytics", help="fleet-wide emission totals and rankings")
+    analytics_parser.add_argument("--top", type=int, default=10, help="number of top emitters to list")
+    analytics_parser.add_argument("--percentiles", default="50,90,99",
+                                  help="comma-separated per-user percentiles")
+    analytics_parser.add_argument("--rebuild", action="store_true",
+                                  help="recompute the aggregates from the emission table first")
+
+    factors_parser = subparsers.add_parser("factors", help="list or revise the versioned emission factors")
+    factors_parser.add_argument("--set", dest="changes", action="append", default=[], metavar="NAME=VALUE",
+                                help="add a version with this factor changed (fuel type, distance, "
+                                     "urban_adjustment or urban); repeatable")
+    factors_parser.add_argument("--load", metavar="CSV",
+                                help="add a version from a vehicle_type,fuel_type,urban,factor data file")
+    factors_parser.add_argument("--use", type=int, help="score new trips with this version")
+
+    rescore_parser = subparsers.add_parser("rescore", help="recompute stored totals from the trip log")
+    rescore_parser.add_argument("--version", type=int,
+                                help="emission factor version to apply (default: the current one)")
+
+    vehicles_parser = subparsers.add_parser("vehicles", help="list or add a user's saved vehicles")
+    vehicles_parser.add_argument("username")
+    vehicles_parser.add_argument("--add", metavar="NAME", help="save a new vehicle under this name")
+    vehicles_parser.add_argument("--vehicle-type", default="car", help="car, motorcycle or van")
+    vehicles_parser.add_argument("--fuel-type", default="", help="gasoline or diesel (blank: distance-based)")
+    vehicles_parser.add_argument("--efficiency", help="fuel efficiency in km/L")
+    vehicles_parser.add_argument("--urban", action="store_true", help="mostly driven in urban traffic")
+
+    trip_parser = subparsers.add_parser("trip", help="record a trip with a saved vehicle")
+    trip_parser.add_argument("username")
+    trip_parser.add_argument("vehicle", help="saved vehicle number")
+    trip_parser.add_argument("distance", help="distance travelled in km")
+    trip_parser.add_argument("--month", help="default: the current month")
+    trip_parser.add_argument("--year", help="default: the current year")
+
+    recurring_parser = subparsers.add_parser("recurring",
+                                             help="list, add or change recurring trips; with no user, bring "
+                                                  "every user's recurring trips up to date")
+    recurring_parser.add_argument("username", nargs="?")
+    recurring_group = recurring_parser.add_mutually_exclusive_group()
+    recurring_group.add_argument("--add", action="store_true", help="add a recurring trip")
+    recurring_group.add_argument("--edit", metavar="ID", help="change a recurring trip")
+    recurring_group.add_argument("--remove", metavar="ID", help="remove a recurring trip and what it added")
+    recurring_parser.add_argument("--vehicle", help="saved vehicle number")
+    recurring_parser.add_argument("--distance", help="distance per trip in km")
+    recurring_parser.add_argument("--trips", help="trips per month")
+    recurring_parser.add_argument("--from", dest="start", help="first month, e.g. 'Mar 2025' (default: this month)")
+    recurring_parser.add_argument("--to", dest="end", help="last month ('none': ongoing)")
+
+    history_parser = subparsers.add_parser("history", help="show a user's emission history for a range of months")
+    history_parser.add_argument("username")
+    history_parser.add_argument("--from", dest="start", type=parse_period,
+                                help="first month, e.g. 'Mar 2025' or 2025-03 (default: oldest stored)")
+    history_parser.add_argument("--to", dest="end", type=parse_period,
+                                help="last month, e.g. 'Feb 2026' or 2026-02 (default: newest stored)")
+
+    script_parser = subparsers.add_parser("script", help="run signup/login/record/history commands headless "
+                                                         "from a JSON-lines script")
+    script_parser.add_argument("path", nargs="?", default="-", help="script file (default: stdin)")
+    script_parser.add_argument("--output", help="write the JSON results here instead of stdout")
+
+    ingest_parser = subparsers.add_parser("ingest", help="run the trip ingestion daemon")
+    ingest_parser.add_argument("--spool", help=f"directory of *.jsonl event files (default: {INGEST_SPOOL_DIR} "
+                                               f"unless --socket is given)")
+    ingest_parser.add_argument("--socket", dest="socket_path", help="Unix socket for newline-delimited JSON events")
+    ingest_parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="events per micro-batch")
+    ingest_parser.add_argument("--batch-wait", type=float, default=INGEST_BATCH_WAIT,
+                               help="seconds a micro-batch waits to fill up")
+    ingest_parser.add_argument("--queue-limit", type=int, default=INGEST_QUEUE_LIMIT,
+                               help="queued events before the sources are held back")
+    ingest_parser.add_argument("--exit-when-idle", action="store_true",
+                               help="stop once every source is drained instead of waiting for more")
+
+    export_parser = subparsers.add_parser("export", help="export monthly emission reports for every user")
+    export_parser.add_argument("path", help="output file ('-' for stdout)")
+    export_parser.add_argument("--format", dest="report_format", choices=sorted(REPORT_WRITERS), default="csv")
+    export_parser.add_argument("--user", dest="usernames", action="append",
+                               help="only this user (repeat for several)")
+    export_parser.add_argument("--year", dest="years", type=validate_year, action="append",
+                               help="only this year (repeat for several)")
+
+    reshard_parser = subparsers.add_parser("reshard", help="move the sharded layout to a new bucket count")
+    reshard_parser.add_argument("buckets", type=int)
+
+    archive_parser = subparsers.add_parser("archive", help="compact a finished year's emission partition")
+    archive_parser.add_argument("year", type=validate_year)
+
+    matrix_parser = subparsers.add_parser("matrix", help="convert between the CSV table and the binary matrix")
+    matrix_parser.add_argument("action", choices=["import", "export"],
+                               help="import: CSV -> binary, export: binary -> CSV")
+    matrix_parser.add_argument("--path", default=EMISSION_MATRIX_FILE, help="binary matrix file")
+
+    import_parser = subparsers.add_parser("import", help="bulk import trips from a CSV or JSONL file")
+    import_parser.add_argument("path", help="trip file (.csv with a header row, or .jsonl)")
+    import_parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE,
+                               help="trips scored per batch")
+    import_parser.add_argument("--max-rejects", type=int, default=IMPORT_MAX_REJECTS,
+                               help="rejected rows listed in the summary")
+    import_parser.add_argument("--workers", type=int, default=1,
+                               help="worker processes; input is sharded by username")
+
+    serve_parser = subparsers.add_parser("serve", help="run the local HTTP/JSON service")
+    serve_parser.add_argument("--host", default=SERVICE_HOST)
+    serve_parser.add_argument("--port", type=int, default=SERVICE_PORT, help="0 picks a free port")
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    if args.metrics:
+        METRICS.enable(args.metrics)
+    with profile_capture(args.profile, args.tracemalloc):
+        return run_command(args)
+
+def run_command(args):
+    if args.command == "migrate":
+        users, rows = migrate_csv_to_sqlite(args.db)
+        print(f"Migrated {users} users and {rows} emission rows to {args.db}")
+        return 0
+    if args.command == "matrix":
+        if args.action == "import":
+            print(f"Imported {import_emission_matrix(args.path)} rows into {args.path}")
+        else:
+            print(f"Exported {export_emission_matrix(args.path)} rows to the {EMISSION_FILE} year tables")
+        return 0
+    if args.command == "factors":
+        return show_emission_factors(args.changes, args.use, args.load)
+    set_fsync_policy(args.fsync)
+    storage = set_storage(open_storage(args.storage, args.group_commit))
+    for action in (getattr(storage, "recovery_actions", []) + get_trip_log().recovery_actions
+                   + get_recurring_store().recover(storage)):
+        print(f"Recovered: {action}", file=sys.stderr)
+    if args.command == "serve":
+        run_service(args.host, args.port)
+        return 0
+    if args.command == "rescore":
+        get_trip_log().rescore(args.version, storage).display()
+        print(f"Recurring trips: {get_recurring_store().sync(storage=storage)} month total(s) updated")
+        return 0
+    if args.command == "recurring":
+        store = get_recurring_store()
+        if not args.username:
+            print(f"{store.sync(storage=storage)} month total(s) updated")
+            return 0
+        if args.add:
+            store.add(args.username, args.vehicle, args.distance, args.trips, args.start, args.end, storage)
+        elif args.edit:
+            store.edit(args.username, args.edit, args.distance, args.trips, args.start, args.end, storage)
+        elif args.remove:
+            store.remove(args.username, args.remove, storage)
+        else:
+            store.sync(args.username, storage)
+        for template in store.list(args.username):
+            print(store.describe(template))
+        return 0
+    if args.command == "vehicles":
+        store = get_profile_store()
+        if args.add:
+            store.add(args.username, args.add, args.vehicle_type, args.fuel_type, args.efficiency, args.urban)
+        for profile in store.list(args.username):
+            print(profile.describe())
+        return 0
+    if args.command == "trip":
+        emission = get_profile_store().record_trip(args.username, args.vehicle, args.distance,
+                                                   args.month.capitalize() if args.month else None, args.year)
+        print(f"Recorded {emission:.2f} kg CO₂")
+        return 0
+    if args.command == "history":
+        EmissionHistoryViewer.view_emission_history(args.username, args.start, args.end)
+        return 0
+    if args.command == "script":
+        return 1 if run_script(args.path, args.output).failed else 0
+    if args.command == "ingest":
+        daemon = run_ingest(args.spool, args.socket_path, args.batch_size, args.batch_wait, args.queue_limit,
+                            args.exit_when_idle)
+        return 1 if daemon.rejected else 0
+    if args.command == "export":
+        rows = export_reports(args.path, args.report_format, args.usernames, args.years, storage)
+        if args.path != "-":
+            print(f"Exported {rows} user-year reports to {args.path}")
+        return 0
+    if args.command == "reshard":
+        if not isinstance(storage, ShardedStorage):
+            raise ValueError("Resharding needs the sharded layout; pass --storage sharded")
+        users = storage.reshard(args.buckets)
+        print(f"Moved {users} users into {args.buckets} buckets")
+        return 0
+    if args.command == "archive":
+        if storage.archive_year(args.year):
+            print(f"Archived the {args.year} emission history")
+        else:
+            print(f"Nothing to archive for {args.year}")
+        return 0
+    if args.command == "analytics":
+        analytics = get_analytics()
+        if args.rebuild:
+            analytics.rebuild(storage)
+        analytics.display(args.top, [float(p) for p in args.percentiles.split(",") if p.strip()])
+        return 0
+    if args.command == "import":
+        report = import_trips(args.path, chunk_size=args.chunk_size, max_rejects=args.max_rejects,
+                              workers=args.workers)
+        report.display()
+        return 1 if report.rejected else 0
+    main_menu()
+    return 0
+
 if __name__ == "__main__":
     try:
-        main_menu()
+        exit(main())
     except KeyboardInterrupt:
         print("\nProgram terminated by user.")
         exit()
@@ -1,73 +1,23 @@
-from enum import Enum, auto
-
-# Enums and constants
-VALID_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", 
-                "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
-
-class VehicleType(Enum):
-    CAR = auto()
-    MOTORCYCLE = auto()
-    VAN = auto()
-
-class FuelType(Enum):
-    GASOLINE = auto()
-    DIESEL = auto()
-
-# Validation & Utility functions 
-def validate_username(username):
-    if not username or not isinstance(username, str):
-        raise ValueError("Username must be a non-empty string")
-    if len(username) < 4 or len(username) > 20:
-        raise ValueError("Username must be between 4 and 20 characters")
-    if not username.isalnum():
-        raise ValueError("Username can only contain letters and numbers")
-    return username
-
-def validate_password(password):
-    if not password or not isinstance(password, str):
-        raise ValueError("Password must be a non-empty string")
-    if len(password) < 8:
-        raise ValueError("Password must be at least 8 characters long")
-    return password
-
-def validate_vehicle_type(vehicle_type):
-    try:
-        return VehicleType[vehicle_type.upper()]
-    except KeyError:
-        raise ValueError(f"Invalid vehicle type. Must be one of: {[v.name for v in VehicleType]}")
-
-def validate_fuel_type(fuel_type):
-    if not fuel_type:
-        return None
-    try:
-        return FuelType[fuel_type.upper()]
-    except KeyError:
-        raise ValueError(f"Invalid fuel type. Must be one of: {[f.name for f in FuelType]} or empty")
+import asyncio
+import csv
+import json
+import math
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
 
-def validate_fuel_efficiency(efficiency):
-    if efficiency is None:
-        return None
-    try:
-        eff = float(efficiency)
-        if eff <= 0:
-            raise ValueError("Fuel efficiency must be positive")
-        return eff
-    except (ValueError, TypeError):
-        raise ValueError("Fuel efficiency must be a positive number")
-
-def validate_distance(distance):
-    try:
-        dist = float(distance)
-        if dist <= 0:
-            raise ValueError("Distance must be positive")
-        return dist
-    except (ValueError, TypeError):
-        raise ValueError("Distance must be a positive number")
-
-def validate_month(month):
-    if month not in VALID_MONTHS:
-        raise ValueError(f"Invalid month. Must be one of: {VALID_MONTHS}")
-    return month
+import main
+from main import (VALID_MONTHS, VehicleType, FuelType, validate_username, validate_password,
+                  validate_vehicle_type, validate_fuel_type, validate_fuel_efficiency, validate_distance,
+                  validate_month)
 
 
 # Manual Unit Test
@@ -159,4 +109,1413 @@ def run_all_validation_tests():
                     print("Result          : ❌ Test Failed")
 
 
+# Behaviour tests: each one runs in a fresh scratch directory and prints the same report as above
+def check(label, actual, expected):
+    print(f"\nTest Case - {label}")
+    print(f"Expected Output : {repr(expected)}")
+    print(f"Actual Output   : {repr(actual)}")
+    if actual == expected:
+        print("Result          : ✅ Test Passed")
+    else:
+        print("Result          : ❌ Test Failed")
+
+def reset_singletons():
+    if main._storage is not None:
+        main._storage.close()
+    for name in ("_storage", "_trip_log", "_analytics", "_factor_table", "_profile_store", "_recurring_store"):
+        setattr(main, name, None)
+    main.FILE_CACHE.clear()
+
+@contextmanager
+def scratch_directory():
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        reset_singletons()
+        main.set_fsync_policy("never")
+        try:
+            yield directory
+        finally:
+            reset_singletons()
+            os.chdir(previous)
+
+def signup_cost(storage, first, last):
+    started = time.perf_counter()
+    for i in range(first, last):
+        storage.add_user(f"user{i:06d}", "hash")
+    return (time.perf_counter() - started) / (last - first)
+
+def run_user_index_tests():
+    print("\n=== User Index Tests ===")
+    with scratch_directory():
+        main.set_storage(main.CSVStorage())
+        for name in ("alice1", "bobby", "carol"):
+            main.User(name, "secret123").save_user()
+        check("Login with the right password", main.User.validate_user("bobby", "secret123"), True)
+        check("Login with a wrong password", main.User.validate_user("bobby", "wrong1234"), False)
+        check("Login of an unknown user", main.User.validate_user("nobody", "secret123"), False)
+        index = main.UserIndex.for_file()
+        check("The index file is written next to users.csv", os.path.exists(index.index_file()), True)
+
+        # Another writer appends a row without updating the index
+        with open(main.USER_FILE, "a", newline="") as file:
+            file.write(f"dave1,{main.hash_password('secret123')}\r\n")
+        check("A row added behind the index's back is found", main.User.validate_user("dave1", "secret123"), True)
+
+        os.remove(index.index_file())
+        main.UserIndex._instances.clear()  # As in a new process
+        main.set_storage(main.CSVStorage())
+        check("A missing index is rebuilt", (main.User.validate_user("carol", "secret123"),
+                                             os.path.exists(main.UserIndex.for_file().index_file())), (True, True))
+        with open(main.UserIndex.for_file().index_file(), "w") as file:
+            file.write("VIDX1 garbage\n")
+        main.UserIndex._instances.clear()
+        main.set_storage(main.CSVStorage())
+        check("A damaged index is rebuilt", main.User.validate_user("alice1", "secret123"), True)
+
+def storage_snapshot(spec):
+    # Runs the same writes through a backend and returns everything it reads back
+    storage = main.open_storage(spec)
+    try:
+        storage.add_user("alice1", "hash1")
+        storage.add_user("bobby", "hash2")
+        storage.update_password_hash("bobby", "hash3")
+        storage.record_emission("alice1", "Jan", 1.5, 2024)
+        storage.record_emission("alice1", "Jan", 2.0, 2024)
+        storage.record_emission("bobby", "Feb", 3.0, 2025)
+        storage.append_emissions([("alice1", 2025, "Mar", 4.0), ("bobby", 2024, "Nov", 0.5)])
+        storage.merge_emissions({("alice1", 2024, "Dec"): 5.0, ("carol", 2025, "Jan"): 6.0})
+        rows = {year: sorted((row["username"], tuple(float(row[month]) for month in main.VALID_MONTHS))
+                             for row in storage.iter_emission_rows(year)) for year in storage.list_years()}
+        return (sorted(storage.iter_users()), storage.list_years(), rows,
+                storage.get_emission_range("alice1", (2024, "Nov"), (2025, "Mar")),
+                storage.get_emission_row("nobody", 2024), storage.has_emission_history())
+    finally:
+        storage.close()
+
+def run_read_cache_tests():
+    print("\n=== Read Cache Tests ===")
+    with scratch_directory():
+        loads = []
+        def loader(path):
+            loads.append(path)
+            with open(path) as file:
+                return file.read()
+        cache = main.FileCache(max_bytes=64)
+        with open("a.txt", "w") as file:
+            file.write("first")
+        check("First read loads the file", (cache.get("a.txt", loader), len(loads)), ("first", 1))
+        check("Unchanged file is served from the cache", (cache.get("a.txt", loader), len(loads)), ("first", 1))
+        with open("a.txt", "w") as file:
+            file.write("other")  # Same size
+        stat = os.stat("a.txt")
+        os.utime("a.txt", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+        check("A rewrite of the same size is picked up", (cache.get("a.txt", loader), len(loads)), ("other", 2))
+        with open("big.txt", "w") as file:
+            file.write("x" * 100)
+        check("Files over the limit are read but not cached",
+              [(cache.get("big.txt", loader), len(loads)) for _ in range(2)] + [cache.skipped],
+              [("x" * 100, 3), ("x" * 100, 4), 2])
+        check("Files over the limit can be read another way",
+              cache.get("big.txt", loader, lambda path: "streamed"), "streamed")
+        try:
+            cache.get("missing.txt", loader)
+            check("Missing files raise FileNotFoundError", "read", "FileNotFoundError")
+        except FileNotFoundError:
+            check("Missing files raise FileNotFoundError", "FileNotFoundError", "FileNotFoundError")
+        for name in ("b.txt", "c.txt"):
+            with open(name, "w") as file:
+                file.write("y" * 30)
+            cache.get(name, loader)
+        check("The least recently used entry is evicted", cache.evictions, 1)
+
+        # A write through another storage object, as from another process, is seen by the next read
+        reader, writer = main.CSVStorage(), main.CSVStorage()
+        writer.record_emission("alice1", "May", 2.0, 2024)
+        check("First view", float(reader.get_emission_row("alice1", 2024)["May"]), 2.0)
+        writer.record_emission("alice1", "May", 3.0, 2024)
+        check("View after another writer's update", float(reader.get_emission_row("alice1", 2024)["May"]), 5.0)
+
+        # Files over the cache bound are still read in full, never mistaken for missing ones
+        max_bytes = main.FILE_CACHE.max_bytes
+        main.FILE_CACHE.max_bytes = 16
+        try:
+            check("A large table is read without the cache", float(reader.get_emission_row("alice1", 2024)["May"]),
+                  5.0)
+            store = main.get_profile_store()
+            store.add("alice1", "Work car", "car", "gasoline", 12.5)
+            store.add("alice1", "Scooter", "motorcycle")
+            check("A large profile file keeps its profiles on the next add",
+                  [profile.name for profile in store.list("alice1")], ["Work car", "Scooter"])
+            table = main.get_factor_table()
+            table.add({"GASOLINE": 3.0})
+            table.add({"DIESEL": 3.0})
+            check("A large factor file keeps its versions on the next add",
+                  sorted(main.EmissionFactorTable().versions()), [1, 2, 3])
+        finally:
+            main.FILE_CACHE.max_bytes = max_bytes
+
+def concurrent_writer(worker, records, signups):
+    # Runs in a forked process inside the parent's scratch directory
+    main.UserIndex._instances.clear()
+    storage = main.CSVStorage()
+    for i in range(records):
+        storage.record_emission(f"user{i % 5}", "Jan", 0.5, 2024)
+    for i in range(signups):
+        storage.add_user(f"w{worker}u{i:03d}", "hash")
+    storage.close()
+
+def run_concurrent_write_tests():
+    print("\n=== Concurrent Write Tests ===")
+    threshold = main.LEDGER_COMPACT_THRESHOLD
+    main.LEDGER_COMPACT_THRESHOLD = 2048  # Compactions run while other processes append
+    try:
+        with scratch_directory():
+            context = multiprocessing.get_context("fork")
+            workers = [context.Process(target=concurrent_writer, args=(worker, 200, 20)) for worker in range(4)]
+            for process in workers:
+                process.start()
+            for process in workers:
+                process.join(120)
+            check("Every writer process finished", [process.exitcode for process in workers], [0] * 4)
+            storage = main.CSVStorage()
+            check("No emission is lost or doubled across processes",
+                  [stored_emission(f"user{i}", 2024, "Jan") for i in range(5)], [80.0] * 5)
+            check("Every concurrent signup is kept", len(list(storage.iter_users())), 80)
+            check("Concurrent signups are all found", all(storage.get_password_hash(f"w{worker}u{i:03d}") == "hash"
+                                                          for worker in range(4) for i in range(20)), True)
+            storage.close()
+    finally:
+        main.LEDGER_COMPACT_THRESHOLD = threshold
+
+    with scratch_directory():
+        storage = main.set_storage(main.CSVStorage(group_commit=True))
+        threads = [threading.Thread(target=lambda: [storage.record_emission("alice1", "Feb", 0.25, 2024)
+                                                    for _ in range(100)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        check("Group commit stores every submitted entry", (storage.committer.items,
+                                                             stored_emission("alice1", 2024, "Feb")), (800, 200.0))
+
+def run_sqlite_storage_tests():
+    print("\n=== SQLite Storage Tests ===")
+    with scratch_directory():
+        expected = storage_snapshot("csv")
+    with scratch_directory():
+        check("SQLite reads back what CSV storage does", storage_snapshot("sqlite:vehicalc.db"), expected)
+        storage = main.SQLiteStorage("vehicalc.db")
+        connection = storage.connection
+        storage.get_emission_row("alice1", 2024)
+        storage.record_emission("alice1", "Jan", 1.0, 2024)
+        check("One connection is reused across calls", storage.connection is connection, True)
+        try:
+            storage.add_user("alice1", "other")
+            check("Duplicate SQLite signup is rejected", "accepted", "Username already exists")
+        except ValueError as e:
+            check("Duplicate SQLite signup is rejected", str(e), "Username already exists")
+        storage.close()
+    with scratch_directory():
+        expected = storage_snapshot("csv")
+        main.migrate_csv_to_sqlite("migrated.db")
+        storage = main.SQLiteStorage("migrated.db")
+        rows = {year: sorted((row["username"], tuple(float(row[month]) for month in main.VALID_MONTHS))
+                             for row in storage.iter_emission_rows(year)) for year in storage.list_years()}
+        check("Migration copies users and every year", (sorted(storage.iter_users()), rows),
+              (expected[0], expected[2]))
+        storage.close()
+
+def run_user_storage_tests():
+    print("\n=== User Storage Tests ===")
+    with scratch_directory():
+        storage = main.CSVStorage()
+        signup_cost(storage, 0, 1000)
+        small = signup_cost(storage, 1000, 1500)
+        signup_cost(storage, 1500, 8000)
+        large = signup_cost(storage, 8000, 8500)
+        # Signup must not re-read users.csv: 8x the users may not cost anywhere near 8x per signup
+        check("Signup cost stays flat from 1k to 8k users", large < small * 3, True)
+        check("Lookup of an early user", storage.get_password_hash("user000003"), "hash")
+        check("Lookup of an unknown user", storage.get_password_hash("nobody"), None)
+        try:
+            storage.add_user("user000003", "other")
+            check("Duplicate signup is rejected", "accepted", "Username already exists")
+        except ValueError as e:
+            check("Duplicate signup is rejected", str(e), "Username already exists")
+
+    with scratch_directory():
+        index = main.UserIndex.for_file()
+        with scratch_directory() as second:
+            check("Each directory's users.csv has its own index", main.UserIndex.for_file() is index, False)
+            check("Indexes are opened by absolute path", main.UserIndex.for_file().user_file,
+                  os.path.join(os.path.realpath(second), main.USER_FILE))
+        check("Index for the same file is shared", main.UserIndex.for_file() is index, True)
+
+    for spec in ("csv", "sqlite:users.db", "sharded:4"):
+        with scratch_directory():
+            storage = main.open_storage(spec)
+            storage.add_users([(f"bulk{i:05d}", f"hash{i}") for i in range(2000)])
+            storage.add_user("single1", "hash")
+            check(f"Bulk signup is visible to lookups ({spec})",
+                  [storage.get_password_hash(name) for name in ("bulk00000", "bulk01999", "single1")],
+                  ["hash0", "hash1999", "hash"])
+            try:
+                storage.add_users([("fresh1", "hash"), ("bulk00005", "hash")])
+                check(f"Bulk signup rejects a taken username ({spec})", "accepted", "rejected")
+            except ValueError:
+                check(f"Bulk signup rejects a taken username ({spec})", "rejected", "rejected")
+            check(f"Bulk signup counts ({spec})", len(list(storage.iter_users())), 2001)
+            storage.close()
+
+def record_trip(username, year, month, vehicle, fuel, efficiency, distance):
+    user_input = main.UserInput(username, vehicle, fuel, efficiency, distance, month, year)
+    emission = main.calculate_emission(user_input)
+    main.store_trip(username, year, month, user_input.vehicle_type, user_input.fuel_type, efficiency,
+                    distance, False, emission)
+    return emission
+
+def stored_emission(username, year, month):
+    row = main.get_storage().get_emission_row(username, year)
+    return round(float(row[month]), 6) if row else 0.0
+
+def run_rescore_tests():
+    print("\n=== Trip Re-score Tests ===")
+    with scratch_directory():
+        main.set_storage(main.CSVStorage())
+        record_trip("alice1", 2023, "Jan", "car", "gasoline", 10.0, 100.0)
+        record_trip("alice1", 2024, "Feb", "car", "gasoline", 10.0, 50.0)
+        record_trip("bobby", 2024, "Feb", "car", "", None, 40.0)
+        main.get_factor_table().add({"GASOLINE": main.FuelBasedCalculator.EMISSION_FACTORS[main.FuelType.GASOLINE] * 2})
+        expected = {key: stored_emission(*key) for key in (("alice1", 2023, "Jan"), ("alice1", 2024, "Feb"))}
+        expected = {key: round(value * 2, 6) for key, value in expected.items()}
+        expected[("bobby", 2024, "Feb")] = stored_emission("bobby", 2024, "Feb")
+
+        # Crash once the columns are swapped in and the first year is merged
+        storage = main.get_storage()
+        merge = storage.merge_emissions
+        calls = []
+        def crashing_merge(totals):
+            calls.append(totals)
+            if len(calls) == 2:
+                raise KeyboardInterrupt("crash")
+            merge(totals)
+        storage.merge_emissions = crashing_merge
+        try:
+            main.get_trip_log().rescore()
+        except KeyboardInterrupt:
+            pass
+        storage.merge_emissions = merge
+        check("Crash leaves the re-score marker behind", os.path.exists(main.get_trip_log().commit_marker()), True)
+
+        main._trip_log = None
+        actions = main.get_trip_log().recovery_actions
+        check("Recovery finishes the re-score", "finished an interrupted trip re-score" in actions, True)
+        check("Each delta is merged exactly once", {key: stored_emission(*key) for key in expected}, expected)
+        check("Factor version after recovery", main.get_factor_table().current_version(), 2)
+        check("A second re-score finds nothing left to change", main.get_trip_log().rescore().changed, 0)
+        check("Totals after the second re-score", {key: stored_emission(*key) for key in expected}, expected)
+
+def write_trip_file(path, rows):
+    with open(path, "w") as file:
+        file.write("username,vehicle_type,fuel_type,fuel_efficiency,distance_travelled,emission_month,emission_year\n")
+        for i in range(rows):
+            fuel, efficiency = (("gasoline", 8 + i % 5) if i % 3 else ("", ""))
+            file.write(f"user{i % 37:04d},car,{fuel},{efficiency},{10 + i % 90},{main.VALID_MONTHS[i % 12]},"
+                       f"{2023 + i % 2}\n")
+        file.write("user0001,car,gasoline,10,-5,Jan,2024\n")  # rejected
+
+def import_snapshot(path, workers, chunk_size):
+    with scratch_directory():
+        report = main.import_trips(path, chunk_size=chunk_size, workers=workers)
+        totals = {}
+        for year in (2023, 2024):
+            for row in main.get_storage().iter_emission_rows(year):
+                for month in main.VALID_MONTHS:
+                    if float(row[month]):
+                        totals[(row["username"], year, month)] = round(float(row[month]), 6)
+        _, columns = main.get_trip_log().read_columns()
+        logged = (len(columns["emission"]), round(math.fsum(columns["emission"]), 6))
+        return report.imported, report.rejected, totals, logged
+
+def write_jsonl_trips(path):
+    lines = [json.dumps({"username": f"user{i % 5:04d}", "vehicle_type": "van" if i % 4 else "car",
+                         "fuel_type": "diesel" if i % 2 else "", "fuel_efficiency": 9 if i % 2 else "",
+                         "distance": 5 + i, "month": main.VALID_MONTHS[i % 12], "year": 2024, "urban": i % 3 == 0})
+             for i in range(40)]
+    lines[3] = "{not json"
+    lines[7] = json.dumps(["a", "list"])
+    lines[11] = json.dumps({"username": "user0001", "vehicle_type": "boat", "distance": 5, "month": "Jan"})
+    lines[20] = ""
+    with open(path, "w") as file:
+        file.write("\n".join(lines) + "\n")
+
+def run_bulk_import_tests():
+    print("\n=== Bulk Import Tests ===")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trips.jsonl")
+        write_jsonl_trips(path)
+        with scratch_directory():
+            report = main.import_trips(path, chunk_size=7)
+            check("JSONL rows processed, imported and rejected", (report.processed, report.imported, report.rejected),
+                  (39, 36, 3))
+            check("Rejected rows carry their line numbers", [line_no for line_no, _ in report.rejected_rows], [4, 8, 12])
+            check("Malformed JSON is reported", report.rejected_rows[0][1].startswith("Malformed JSON"), True)
+            serial = dict(report.totals)
+            stored = {key: stored_emission(*key) for key in serial}
+            check("Stored totals match the report", stored, {key: round(value, 6) for key, value in serial.items()})
+            check("Totals are in order of each user-month's first line",
+                  [report.first_seen[key] for key in report.totals] == sorted(report.first_seen.values()), True)
+        for chunk_size in (1, 1000):
+            with scratch_directory():
+                check(f"Chunk size {chunk_size} gives the same totals",
+                      main.import_trips(path, chunk_size=chunk_size).totals, serial)
+        with scratch_directory():
+            try:
+                main.import_trips(path, chunk_size=0)
+                check("Chunk size must be positive", "accepted", "rejected")
+            except ValueError:
+                check("Chunk size must be positive", "rejected", "rejected")
+
+        report = main.ImportReport()
+        trips = [(line_no, main.UserInput.from_validated("alice1", main.VehicleType.CAR, None, None, distance, "Jan",
+                                                         2024), False)
+                 for line_no, distance in enumerate((10.0, float("nan"), float("inf"), 20.0), 2)]
+        scored = list(main.score_trips(iter(trips), report))
+        check("Unscorable trips are rejected, not merged", ([line_no for line_no, _, _, _ in scored],
+                                                           [line_no for line_no, _ in report.rejected_rows]),
+              ([2, 5], [3, 4]))
+        check("Rejected trips carry a reason", report.rejected_rows[0][1],
+              "Emission could not be calculated from this trip's values")
+
+def run_parallel_import_tests():
+    print("\n=== Parallel Import Tests ===")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trips.jsonl")
+        write_jsonl_trips(path)
+        reports = {}
+        for workers in (1, 4):
+            with scratch_directory():
+                report = main.import_trips(path, chunk_size=5, workers=workers)
+                stored = {key: stored_emission(*key) for key in report.totals}
+                reports[workers] = (list(report.totals.items()), report.rejected_rows,
+                                    (report.processed, report.imported, report.rejected), report.breakdown, stored)
+        check("Parallel totals equal serial ones, in the same order", reports[4][0], reports[1][0])
+        check("Parallel rejected rows equal serial ones", reports[4][1], reports[1][1])
+        check("Parallel counts equal serial ones", reports[4][2], reports[1][2])
+        check("Parallel fleet breakdown equals serial one",
+              {key: round(value, 6) for key, value in reports[4][3].items()},
+              {key: round(value, 6) for key, value in reports[1][3].items()})
+        check("Parallel stored history equals serial one", reports[4][4], reports[1][4])
+        with scratch_directory():
+            try:
+                main.import_trips(path, workers=0)
+                check("Worker count must be positive", "accepted", "rejected")
+            except ValueError:
+                check("Worker count must be positive", "rejected", "rejected")
+
+def run_import_tests():
+    print("\n=== Trip Import Tests ===")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trips.csv")
+        write_trip_file(path, 2000)
+        serial = import_snapshot(path, 1, 128)
+        parallel = import_snapshot(path, 3, 128)
+        check("Serial import counts", serial[:2], (2000, 1))
+        check("Parallel import counts match serial", parallel[:2], serial[:2])
+        check("Parallel import totals match serial", parallel[2], serial[2])
+        check("Every imported trip is in the trip log", serial[3][0], 2000)
+        check("Trip log sums to the stored totals", math.isclose(serial[3][1], math.fsum(serial[2].values()),
+                                                                 abs_tol=1e-3), True)
+        check("Parallel workers log the same trips", parallel[3], serial[3])
+
+        for workers in (1, 3):
+            with scratch_directory():
+                storage = main.set_storage(main.CSVStorage())
+                def failing_merge(totals):
+                    raise IOError("disk full")
+                storage.merge_emissions = failing_merge
+                try:
+                    main.import_trips(path, chunk_size=128, workers=workers)
+                    check(f"A failed merge fails the import ({workers} workers)", "imported", "IOError")
+                except IOError:
+                    check(f"A failed merge fails the import ({workers} workers)", "IOError", "IOError")
+                check(f"A failed merge logs no trips ({workers} workers)", len(main.get_trip_log()), 0)
+
+def write_table(path, values):
+    # values: {username: {month: kg}}
+    rows = []
+    for username, months in values.items():
+        row = main.new_emission_row(username)
+        row.update({month: repr(value) for month, value in months.items()})
+        rows.append(row)
+    main.write_emission_table(rows, path)
+
+def write_matrix(path, values):
+    matrix = main.EmissionMatrix(path)
+    matrix.add_many((username, month, value) for username, months in values.items() for month, value in months.items())
+    matrix.close()
+
+def data_files():
+    return sorted(name for name in os.listdir(".") if not name.endswith(".lock"))
+
+def adopted_values(storage):
+    values = [storage.get_emission_row(username, 2024) for username in ("alice1", "bobby")]
+    storage.close()
+    return [(float(row["Jan"]), float(row["Feb"])) if row else None for row in values]
+
+def run_legacy_adoption_tests():
+    print("\n=== Legacy History Adoption Tests ===")
+    legacy_time = datetime(2024, 6, 1).timestamp()
+    expected = [(3.5, 0.0), (0.0, 3.0)]
+    with scratch_directory():
+        write_table("emission_history_2024.csv", {"alice1": {"Jan": 1.5}})
+        write_table("emission_history.csv", {"alice1": {"Jan": 2.0}, "bobby": {"Feb": 3.0}})
+        os.utime("emission_history.csv", (legacy_time, legacy_time))
+        check("CSV legacy table is added to its year", adopted_values(main.CSVStorage()), expected)
+        check("CSV adoption is not repeated on the next start", adopted_values(main.CSVStorage()), expected)
+        check("CSV legacy table is gone", data_files(), ["emission_history_2024.csv"])
+    with scratch_directory():
+        # Crash right after the legacy table was handed to the partition
+        write_table("emission_history_2024.csv", {"alice1": {"Jan": 1.5}})
+        write_table("emission_history_2024.csv.adopting", {"alice1": {"Jan": 2.0}, "bobby": {"Feb": 3.0}})
+        check("CSV recovery adds a handed-over table once", adopted_values(main.CSVStorage()), expected)
+    with scratch_directory():
+        # Crash after the merged table was committed but before the adopted file was removed
+        write_table("emission_history_2024.csv", {"alice1": {"Jan": 1.5}})
+        write_table("emission_history_2024.csv.tmp", {"alice1": {"Jan": 3.5}, "bobby": {"Feb": 3.0}})
+        write_table("emission_history_2024.csv.adopting", {"alice1": {"Jan": 2.0}, "bobby": {"Feb": 3.0}})
+        open("emission_ledger_2024.csv.commit", "w").close()
+        check("CSV recovery does not add a committed table twice", adopted_values(main.CSVStorage()), expected)
+        check("CSV recovery cleans up", data_files(), ["emission_history_2024.csv"])
+
+    with scratch_directory():
+        write_matrix("emission_matrix_2024.bin", {"alice1": {"Jan": 1.5}})
+        write_matrix("emission_matrix.bin", {"alice1": {"Jan": 2.0}, "bobby": {"Feb": 3.0}})
+        os.utime("emission_matrix.bin", (legacy_time, legacy_time))
+        check("Binary legacy matrix is added to its year", adopted_values(main.BinaryStorage()), expected)
+        check("Binary adoption is not repeated on the next start", adopted_values(main.BinaryStorage()), expected)
+    with scratch_directory():
+        write_matrix("emission_matrix_2024.bin", {"alice1": {"Jan": 1.5}})
+        write_matrix("emission_matrix_2024.bin.adopting", {"alice1": {"Jan": 2.0}, "bobby": {"Feb": 3.0}})
+        check("Binary recovery adds a handed-over matrix once", adopted_values(main.BinaryStorage()), expected)
+    with scratch_directory():
+        write_matrix("emission_matrix_2024.bin", {"alice1": {"Jan": 1.5}})
+        write_matrix("emission_matrix_2024.bin.adopting", {"alice1": {"Jan": 2.0}, "bobby": {"Feb": 3.0}})
+        write_matrix("emission_matrix_2024.bin.merged", {"alice1": {"Jan": 3.5}, "bobby": {"Feb": 3.0}})
+        open("emission_matrix_2024.bin.adopting.commit", "w").close()
+        check("Binary recovery does not add a committed matrix twice", adopted_values(main.BinaryStorage()), expected)
+        check("Binary recovery cleans up", data_files(), ["emission_matrix_2024.bin"])
+
+def run_recurring_trip_tests():
+    print("\n=== Recurring Trip Tests ===")
+    with scratch_directory():
+        storage = main.set_storage(main.CSVStorage())
+        profile = main.get_profile_store().add("alice1", "Work car", "car")
+        store = main.get_recurring_store()
+        monthly = round(main.DistanceBasedCalculator.AVERAGE_EMISSION_FACTOR * 25 * 20, 6)
+        periods = [(2023, "Nov"), (2023, "Dec"), (2024, "Jan"), (2024, "Feb")]
+
+        # Crash with the 2023 months merged and the 2024 ones not yet
+        merge = storage.merge_emissions
+        calls = []
+        def crashing_merge(totals):
+            calls.append(totals)
+            if len(calls) == 2:
+                raise KeyboardInterrupt("crash")
+            merge(totals)
+        storage.merge_emissions = crashing_merge
+        try:
+            store.add("alice1", profile.profile_id, 25, 20, "2023-11", "2024-02")
+        except KeyboardInterrupt:
+            pass
+        storage.merge_emissions = merge
+        check("Crash mid-merge is recovered", store.recover(storage), [f"finished an interrupted update of {store.path}"])
+        check("Each recurring month is stored once", [stored_emission("alice1", *period) for period in periods],
+              [monthly] * 4)
+        check("Nothing left to sync after recovery", store.sync(storage=storage), 0)
+        check("Recovery runs once", store.recover(storage), [])
+
+        template = store.list("alice1")[0]
+        store.edit("alice1", template["id"], trips=10, storage=storage)
+        check("Editing stores only the difference", [stored_emission("alice1", *period) for period in periods],
+              [round(monthly / 2, 6)] * 4)
+        store.remove("alice1", template["id"], storage=storage)
+        check("Removing takes everything back", [stored_emission("alice1", *period) for period in periods],
+              [0.0] * 4)
+
+def run_matrix_conversion_tests():
+    print("\n=== Binary Matrix Conversion Tests ===")
+    with scratch_directory():
+        expected = storage_snapshot("csv")
+    with scratch_directory():
+        check("Binary storage reads back what CSV storage does", storage_snapshot("binary"), expected)
+        matrix = main.EmissionMatrix("matrix.bin")
+        matrix.add_many((f"user{i:04d}", "Jan", 1.0) for i in range(3000))  # Grows past the first capacity
+        matrix.add_many([("user0007", "Jan", 0.5), ("user0007", "Dec", 2.0)])
+        matrix.close()
+        matrix = main.EmissionMatrix("matrix.bin")
+        check("Increments persist in place across a reopen", (matrix.get("user0007")[0], matrix.get("user0007")[11],
+                                                              matrix.get("user2999")[0], matrix.get("nobody")),
+              (1.5, 2.0, 1.0, None))
+        matrix.close()
+    with scratch_directory():
+        csv_storage = main.CSVStorage()
+        csv_storage.record_emission("alice1", "Jan", 1.0, 2024)
+        main.import_emission_matrix()
+        check("Import folds the ledger into the table", os.path.exists("emission_ledger_2024.csv"), False)
+        binary = main.BinaryStorage()
+        check("Imported matrix values", adopted_values(binary), [(1.0, 0.0), None])
+
+        # One write through each backend after the import
+        csv_storage.record_emission("alice1", "Jan", 2.0, 2024)
+        binary = main.BinaryStorage()
+        binary.record_emission("bobby", "Feb", 3.0, 2024)
+        binary.close()
+        main.export_emission_matrix()
+        check("Export keeps deltas recorded through CSV after the import", adopted_values(main.CSVStorage()),
+              [(3.0, 0.0), (0.0, 3.0)])
+        check("Export leaves no ledger behind", os.path.exists("emission_ledger_2024.csv"), False)
+        csv_storage.close()
+
+    with scratch_directory():
+        matrix = main.EmissionMatrix("matrix.bin")
+        matrix.add_many((f"user{i:05d}", main.VALID_MONTHS[i % 12], i + 0.5) for i in range(2500))
+        window = main.EmissionMatrix.ROWS_WINDOW
+        main.EmissionMatrix.ROWS_WINDOW = 1000
+        try:
+            rows = matrix.rows()
+            streamed = [next(rows) for _ in range(1000)]
+            matrix.add_many([("late1", "Dec", 7.0)])  # Written after the first window was read
+            streamed += list(rows)
+        finally:
+            main.EmissionMatrix.ROWS_WINDOW = window
+        check("Windowed rows cover every row in order",
+              [name for name, _ in streamed] == [f"user{i:05d}" for i in range(2500)] + ["late1"], True)
+        check("Windowed rows carry each row's values",
+              all(values == matrix.get(name) for name, values in streamed), True)
+        matrix.close()
+
+def run_vehicle_factor_tests():
+    print("\n=== Vehicle Type Factor Tests ===")
+    with scratch_directory():
+        emissions, invalid = main.calculate_emissions_batch(
+            [100.0, 100.0, 100.0, 100.0, 100.0], [None, None, 10.0, None, None], ["", "", "diesel", "", ""],
+            vehicle_types=["car", "spaceship", main.VehicleType.VAN, 99, None])
+        check("Unknown vehicle types are invalid rows", list(invalid), [1, 3, 4])
+        check("Unknown vehicle types score NaN", [value != value for value in emissions],
+              [False, True, False, True, True])
+        check("Known rows in the same batch are scored",
+              [emissions[0], emissions[2]],
+              [main.calculate_emission(main.UserInput("alice1", "car", "", None, 100.0, "Jan")),
+               main.calculate_emission(main.UserInput("alice1", "van", "diesel", 10.0, 100.0, "Jan"))])
+
+        path = os.path.join(os.path.dirname(os.path.abspath(main.__file__)), "vehicle_emission_factors.csv")
+        version = main.get_factor_table().load_csv(path)
+        lookup = main.get_factor_table().lookup(version)
+        check("Shipped per-vehicle distance factors",
+              [round(lookup.factor(vehicle_type), 4) for vehicle_type in main.VehicleType], [0.21, 0.113, 0.24])
+        check("Version 1 keeps one distance factor for every vehicle type",
+              {main.get_factor_table().lookup(1).factor(vehicle_type) for vehicle_type in main.VehicleType},
+              {main.DistanceBasedCalculator.AVERAGE_EMISSION_FACTOR})
+
+@contextmanager
+def running_service():
+    # Serves on a free localhost port in a background thread; yields the port
+    service = main.VehiCalcService()
+    started = threading.Event()
+    running = {}
+
+    def ready(server):
+        running["server"], running["loop"] = server, asyncio.get_running_loop()
+        started.set()
+
+    def serve():
+        try:
+            asyncio.run(service.serve("127.0.0.1", 0, ready))
+        except asyncio.CancelledError:
+            pass
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    started.wait(10)
+    try:
+        yield running["server"].sockets[0].getsockname()[1]
+    finally:
+        running["loop"].call_soon_threadsafe(running["server"].close)
+        thread.join(10)
+        service.close()
+
+def http_request(port, raw):
+    # Sends raw request bytes on a fresh connection; returns (status, decoded JSON body)
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as connection:
+        connection.sendall(raw)
+        response = b""
+        while b"\r\n\r\n" not in response:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+        head, _, body = response.partition(b"\r\n\r\n")
+        length = int(dict(line.split(": ", 1) for line in head.decode("latin-1").split("\r\n")[1:])["Content-Length"])
+        while len(body) < length:
+            body += connection.recv(65536)
+    return int(head.split()[1]), json.loads(body)
+
+def json_request(port, method, path, body=None, token=None):
+    payload = json.dumps(body).encode("utf-8") if body is not None else b""
+    auth = f"Authorization: Bearer {token}\r\n" if token else ""
+    return http_request(port, f"{method} {path} HTTP/1.1\r\nConnection: close\r\n{auth}"
+                              f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+
+def run_service_tests():
+    print("\n=== HTTP Service Tests ===")
+    with scratch_directory(), running_service() as port:
+        year = datetime.now().year
+        check("Signup", json_request(port, "POST", "/signup", {"username": "alice1", "password": "secret123"}),
+              (200, {"username": "alice1"}))
+        status, body = json_request(port, "POST", "/login", {"username": "alice1", "password": "secret123"})
+        check("Login returns a token", (status, sorted(body)), (200, ["token"]))
+        token = body["token"]
+        check("Wrong password is refused",
+              json_request(port, "POST", "/login", {"username": "alice1", "password": "wrong1234"})[0], 401)
+        trip = {"vehicle_type": "car", "fuel_type": "gasoline", "fuel_efficiency": 10, "distance": 100, "month": "Jan"}
+        check("Record needs a token", json_request(port, "POST", "/record", trip)[0], 401)
+        check("Record", json_request(port, "POST", "/record", trip, token), (200, {"emission": 23.1, "month": "Jan",
+                                                                                  "year": year}))
+        status, body = json_request(port, "POST", "/batch", {"requests": [
+            {"method": "POST", "path": "/record", "body": dict(trip, month="Feb")},
+            {"method": "POST", "path": "/record", "body": dict(trip, distance=-1)},
+            {"method": "GET", "path": "/history", "query": {"from": f"{year}-01", "to": f"{year}-02"}}]}, token)
+        check("Batch statuses", [response["status"] for response in body["responses"]], [200, 400, 200])
+        check("History after the batch", body["responses"][2]["body"]["history"],
+              [{"year": year, "month": "Jan", "emission": 23.1}, {"year": year, "month": "Feb", "emission": 23.1}])
+        check("Unknown path", json_request(port, "GET", "/nowhere")[0], 404)
+
+        check("Non-numeric Content-Length", http_request(
+            port, b"POST /login HTTP/1.1\r\nContent-Length: ten\r\n\r\n"), (400, {"error": "Invalid Content-Length"}))
+        check("Negative Content-Length", http_request(port, b"POST /login HTTP/1.1\r\nContent-Length: -5\r\n\r\n")[0],
+              400)
+        check("Over-long header line", http_request(
+            port, b"GET /metrics HTTP/1.1\r\nX-Padding: " + b"a" * 100000 + b"\r\n\r\n"),
+              (431, {"error": "Request header line too long"}))
+        check("Body over the size limit", http_request(
+            port, f"POST /login HTTP/1.1\r\nContent-Length: {main.SERVICE_MAX_BODY + 1}\r\n\r\n".encode())[0], 413)
+        check("Service still answers after bad requests", json_request(port, "GET", "/metrics")[0], 200)
+
+def run_script(directory, commands):
+    # Runs `main.py script` on the commands; returns (stdout lines, stderr)
+    script = "".join(json.dumps(command) + "\n" for command in commands)
+    result = subprocess.run([sys.executable, os.path.abspath(main.__file__), "script"], input=script, cwd=directory,
+                            capture_output=True, text=True, timeout=120)
+    return result.stdout.splitlines(), result.stderr
+
+def run_headless_script_tests():
+    print("\n=== Headless Script Tests ===")
+    with scratch_directory() as directory:
+        open(os.path.join(directory, main.TRIP_LOG_DIR), "w").close()  # A file, so trip-log appends fail
+        lines, errors = run_script(directory, [
+            {"op": "signup", "session": "a", "username": "alice1", "password": "secret123"},
+            {"op": "login", "session": "a", "username": "alice1", "password": "secret123"},
+            {"op": "record", "session": "a", "vehicle_type": "car", "distance": 100, "month": "Jan", "year": 2024},
+            {"op": "record", "session": "b", "vehicle_type": "car", "distance": 100, "month": "Jan", "year": 2024},
+            {"op": "history", "session": "a", "from": "2024-01", "to": "2024-01"},
+        ])
+        results = [json.loads(line) for line in lines]
+        check("Every stdout line is a JSON result", [result["line"] for result in results], [1, 2, 3, 4, 5])
+        check("Script results", [result["ok"] for result in results], [True, True, True, False, True])
+        check("Warnings go to stderr", "Warning: trip not added to the trip log" in errors, True)
+        check("History in the script", results[4]["result"], [{"year": 2024, "month": "Jan", "emission": 21.0}])
+
+def ingest_event(**fields):
+    event = {"username": "alice1", "vehicle_type": "car", "distance": 10, "month": "Jan", "year": 2024}
+    event.update(fields)
+    return json.dumps(event)
+
+def run_ingest_tests():
+    print("\n=== Ingest Daemon Tests ===")
+    with scratch_directory():
+        main.set_storage(main.CSVStorage())
+        daemon = main.IngestDaemon(batch_size=10, batch_wait=0.0)
+        lags = []
+        for fields in ({"ts": True}, {"ts": float("nan")}, {"ts": time.time() + 3600}, {}, {"ts": time.time() - 30}):
+            daemon.process([(ingest_event(**fields), time.time() - 100, None, 0)])
+            lags.append(round(daemon.last_lag, -1))
+        check("Only numeric past timestamps set the lag; others use the receive time", lags,
+              [100.0, 100.0, 100.0, 100.0, 30.0])
+        check("Every event is stored", (daemon.stored, stored_emission("alice1", 2024, "Jan")), (5, 10.5))
+
+    with scratch_directory():
+        main.set_storage(main.CSVStorage())
+        os.makedirs("spool")
+        with open("spool/a.jsonl", "w") as file:
+            file.writelines(ingest_event(distance=10) + "\n" for _ in range(30))
+            file.write(ingest_event(distance=-1) + "\n")
+        with open("spool/b.jsonl", "w") as file:
+            file.writelines(ingest_event(username="bobby", distance=i) + "\n" for i in range(1, 21))
+        with open("spool/b.jsonl.offset", "w") as file:
+            file.write("15")  # A previous run stored the first 15 lines
+        with open("spool/c.jsonl.partial", "w") as file:
+            file.write(ingest_event())  # Still being written by a producer
+        daemon = main.run_ingest(spool="spool", batch_size=8, batch_wait=0.0, exit_when_idle=True)
+        check("Spooled events are stored in micro-batches", (daemon.stored, daemon.rejected, daemon.batches >= 5),
+              (35, 1, True))
+        check("A spool file resumes after its stored offset",
+              (stored_emission("alice1", 2024, "Jan"), stored_emission("bobby", 2024, "Jan")),
+              (63.0, round(0.21 * sum(range(16, 21)), 6)))
+        check("Fully stored spool files and offsets are removed", sorted(os.listdir("spool")), ["c.jsonl.partial"])
+
+    with scratch_directory():
+        main.set_storage(main.CSVStorage())
+        daemon = main.IngestDaemon(batch_size=10, batch_wait=0.0, queue_limit=2)
+        accepted = []
+        producer = threading.Thread(target=lambda: accepted.extend(daemon.submit(ingest_event(), time.time())
+                                                                   for _ in range(3)))
+        producer.start()
+        producer.join(0.5)
+        check("A full queue blocks the producer", (producer.is_alive(), daemon.queue.qsize(), accepted),
+              (True, 2, [True, True]))
+        daemon.process(daemon.next_batch(0))
+        producer.join(5)
+        check("Draining the queue lets the producer go on", (producer.is_alive(), accepted), (False, [True] * 3))
+        daemon.stopping.set()
+        check("Submitting to a stopping daemon is refused", daemon.submit(ingest_event(), time.time()), False)
+
+    if hasattr(socket, "AF_UNIX"):
+        with scratch_directory():
+            main.set_storage(main.CSVStorage())
+            daemon = main.IngestDaemon(batch_size=4, batch_wait=0.0)
+            source = main.SocketSource("ingest.sock")
+            daemon.start_source(source)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect("ingest.sock")
+            deadline = time.monotonic() + 5
+            while source.idle and time.monotonic() < deadline:
+                time.sleep(0.01)
+            client.sendall("".join(ingest_event(username="carol", distance=20) + "\n" for _ in range(9)).encode())
+            client.sendall(b"not json\n")
+            client.close()
+            daemon.run(exit_when_idle=True)
+            check("Socket events are stored until the sender disconnects",
+                  (daemon.stored, daemon.rejected, stored_emission("carol", 2024, "Jan")), (9, 1, 37.8))
+            check("The socket file is removed on stop", os.path.exists("ingest.sock"), False)
+
+def scalar_emission(distance, efficiency, fuel, urban, vehicle="car"):
+    user_input = main.UserInput("alice1", vehicle, fuel, efficiency, distance, "Jan")
+    return main.get_calculator(user_input, urban).calculate_carbon_emission(user_input)
+
+def run_batch_calculator_tests():
+    print("\n=== Batch Emission Calculator Tests ===")
+    with scratch_directory():
+        rng = random.Random(7)
+        distances, efficiencies, fuels, urban = [], [], [], []
+        for _ in range(3000):
+            fuel = rng.choice(["gasoline", "diesel", ""])
+            distances.append(round(rng.uniform(0.1, 900), 3))
+            efficiencies.append(round(rng.uniform(3, 30), 2) if fuel else None)
+            fuels.append(fuel)
+            urban.append(rng.random() < 0.3)
+        emissions, invalid = main.calculate_emissions_batch(distances, efficiencies, fuels, urban)
+        expected = [scalar_emission(*row) for row in zip(distances, efficiencies, fuels, urban)]
+        check("Batch results equal the scalar calculators bit for bit", list(emissions) == expected, True)
+        check("No invalid rows in a clean batch", list(invalid), [])
+        # The original urban calculator adjusted the distance first, then applied the per-km factor
+        urban_distances = [d for d, u in zip(distances, urban) if u][:200]
+        adjustment = main.UrbanAdjustmentCalculator.ADJUSTMENT_FACTOR
+        baseline = [d * adjustment * main.UrbanAdjustmentCalculator.EMISSION_FACTOR for d in urban_distances]
+        size = len(urban_distances)
+        check("Urban results keep the original multiplication order",
+              ([scalar_emission(d, None, "", True) for d in urban_distances] == baseline,
+               [main.calculate_emission(main.UserInput("alice1", "car", "", None, d, "Jan"), True)
+                for d in urban_distances] == baseline,
+               list(main.calculate_emissions_batch(urban_distances, [None] * size, [""] * size, [True] * size)[0])
+               == baseline), (True, True, True))
+
+        car, other_car, van = (main.UserInput(name, vehicle, "", None, 10.0, "Jan")
+                               for name, vehicle in (("alice1", "car"), ("bobby", "car"), ("alice1", "van")))
+        check("One calculator is shared per vehicle type and mode",
+              (main.get_calculator(car) is main.get_calculator(other_car),
+               main.get_calculator(car) is main.get_calculator(car, True),
+               main.get_calculator(car) is main.get_calculator(van)), (True, False, False))
+
+        emissions, invalid = main.calculate_emissions_batch(
+            [10, -1, "abc", 10, 10, 10, 0], [8, None, None, 0, "x", None, None],
+            ["diesel", "", "", "gasoline", "gasoline", "petrol", ""])
+        check("Bad rows are reported, not raised", list(invalid), [1, 2, 3, 4, 5, 6])
+        check("Bad rows score NaN", [value != value for value in emissions], [False] + [True] * 6)
+        check("The good row in a bad batch", emissions[0], scalar_emission(10, 8, "diesel", False))
+        try:
+            main.calculate_emissions_batch([1, 2], [None], ["", ""])
+            check("Columns of different lengths are rejected", "accepted", "rejected")
+        except ValueError:
+            check("Columns of different lengths are rejected", "rejected", "rejected")
+
+def run_ledger_tests():
+    print("\n=== Emission Ledger Tests ===")
+    with scratch_directory():
+        storage = main.CSVStorage()
+        for emission in (1.25, 2.5, 4.0):
+            storage.record_emission("alice1", "Mar", emission, 2024)
+        storage.record_emission("bobby", "Apr", 3.0, 2024)
+        ledger = storage.partition(2024)
+        check("Writes go to the ledger, not the table", (os.path.exists(ledger.ledger_file),
+                                                         os.path.exists(ledger.table_file)), (True, False))
+        check("Reads include pending ledger deltas", stored_emission("alice1", 2024, "Mar"), 7.75)
+        ledger.compact()
+        check("Compaction empties the ledger", os.path.exists(ledger.ledger_file), False)
+        check("Reads after compaction", (stored_emission("alice1", 2024, "Mar"), stored_emission("bobby", 2024, "Apr")),
+              (7.75, 3.0))
+
+        # Crash after the ledger was renamed to the segment, before the table was written
+        storage.record_emission("alice1", "Mar", 0.25, 2024)
+        os.replace(ledger.ledger_file, ledger.segment_file())
+        storage.record_emission("alice1", "Mar", 1.0, 2024)
+        check("Reads include an interrupted segment and the new ledger", stored_emission("alice1", 2024, "Mar"), 9.0)
+        main.FILE_CACHE.clear()
+        check("Recovery keeps the segment for the next compaction", main.CSVStorage().recovery_actions, [])
+        ledger.compact()
+        check("The segment is folded in once", (stored_emission("alice1", 2024, "Mar"),
+                                                os.path.exists(ledger.segment_file())), (9.0, False))
+
+        # Crash after the new table was complete and the commit marker written
+        storage.record_emission("alice1", "Mar", 1.0, 2024)
+        os.replace(ledger.ledger_file, ledger.segment_file())
+        write_table(ledger.table_file + ".tmp", {"alice1": {"Mar": 10.0}, "bobby": {"Apr": 3.0}})
+        open(ledger.commit_marker(), "w").close()
+        check("Recovery finishes the compaction", main.CSVStorage().recovery_actions,
+              ["finished an interrupted ledger compaction"])
+        check("Deltas of a finished compaction are not applied again", stored_emission("alice1", 2024, "Mar"), 10.0)
+
+        # Crash mid-append
+        storage.record_emission("bobby", "Apr", 1.0, 2024)
+        with open(ledger.ledger_file, "a") as file:
+            file.write("bobby,Apr,12")
+        actions = main.CSVStorage().recovery_actions
+        check("Recovery drops a torn ledger entry", [action.split(" of ")[0] for action in actions],
+              ["dropped 12 bytes"])
+        check("Entries before the torn one survive", stored_emission("bobby", 2024, "Apr"), 4.0)
+        storage.close()
+
+def run_atomic_write_tests():
+    print("\n=== Atomic Write Tests ===")
+    with scratch_directory():
+        main.atomic_write("table.csv", lambda file: file.write("old\n"))
+
+        def failing_write(file):
+            file.write("new, but only half")
+            raise IOError("disk full")
+
+        try:
+            main.atomic_write("table.csv", failing_write)
+        except IOError:
+            pass
+        with open("table.csv") as file:
+            check("A failed rewrite leaves the old file in place", file.read(), "old\n")
+
+        storage = main.CSVStorage()
+        storage.add_user("alice1", "hash")
+        storage.close()
+        with open(main.USER_FILE, "a") as file:
+            file.write("bobby,ha")
+        open(storage.user_index.index_file() + ".tmp", "w").close()
+        main.UserIndex._instances.clear()
+        storage = main.set_storage(main.CSVStorage())
+        check("Recovery drops a torn user row and a partial index",
+              [action.split(" of ")[0].split(" bytes")[0] for action in storage.recovery_actions],
+              ["discarded a partial write", "dropped 8"])
+        check("Users before the torn row survive", (storage.get_password_hash("alice1"),
+                                                    storage.get_password_hash("bobby")), ("hash", None))
+        storage.add_user("bobby", "hash")
+        check("A new row after recovery starts on its own line", storage.get_password_hash("bobby"), "hash")
+
+    policy = main.FsyncPolicy("every:3")
+    check("every:N syncs on every Nth append to a file", [policy.should_sync("a.log") for _ in range(6)],
+          [False, False, True, False, False, True])
+    check("every:N counts each file separately", (policy.should_sync("a.log"), policy.should_sync("b.log")),
+          (False, False))
+    check("never does not sync", main.FsyncPolicy("never").should_sync("a.log"), False)
+    check("always syncs every append", [main.FsyncPolicy("always").should_sync("a.log") for _ in range(2)],
+          [True, True])
+    with scratch_directory():
+        policy = main.FsyncPolicy("interval:60000")
+        policy._last_sync = time.monotonic()
+        with open("a.log", "w") as file:
+            file.write("entry\n")
+        check("interval:MS defers appends until the interval passes",
+              (policy.should_sync("a.log"), policy.should_sync("gone.log")), (False, False))
+        policy.sync_pending()
+        check("Pending appends are synced on demand", (policy._unsynced, policy.syncs), ({}, 1))
+        check("Syncing does not recreate a file removed since its append", os.path.exists("gone.log"), False)
+
+        policy = main.FsyncPolicy("interval:60000")
+        policy._last_sync = time.monotonic() - 61
+        check("interval:MS syncs once the interval has passed, then defers again",
+              ([policy.should_sync("a.log") for _ in range(5)], policy.syncs), ([True] + [False] * 4, 1))
+    for spec in ("every:0", "interval:x", "sometimes"):
+        try:
+            main.FsyncPolicy(spec)
+            check(f"Invalid fsync policy {spec}", "accepted", "ValueError")
+        except ValueError:
+            check(f"Invalid fsync policy {spec}", "ValueError", "ValueError")
+
+def analytics_snapshot(analytics):
+    rounded = lambda totals: {key: round(value, 6) for key, value in totals.items() if value}
+    return (round(analytics.fleet_total(), 6), rounded(analytics.monthly_totals(2024)),
+            [(year, month, round(total, 6)) for year, month, total in analytics.period_totals()],
+            rounded(analytics.breakdown("vehicle")), rounded(analytics.breakdown("fuel")),
+            round(analytics.percentile(50), 6), [(name, round(total, 6)) for name, total in analytics.top_emitters(2)])
+
+def run_analytics_tests():
+    print("\n=== Fleet Analytics Tests ===")
+    threshold = main.ANALYTICS_SNAPSHOT_THRESHOLD
+    main.ANALYTICS_SNAPSHOT_THRESHOLD = 512  # Snapshots are rewritten while trips are recorded
+    try:
+        with scratch_directory():
+            main.set_storage(main.CSVStorage())
+            trips = [("alice1", 2024, "Jan", "car", "gasoline", 12.0, 100.0),
+                     ("bobby", 2024, "Jan", "van", "diesel", 8.0, 40.0),
+                     ("carol", 2024, "Mar", "motorcycle", "gasoline", 30.0, 25.0),
+                     ("alice1", 2025, "Feb", "car", "", None, 60.0)] * 5
+            emissions = {}
+            for trip in trips:
+                emissions[trip[0]] = emissions.get(trip[0], 0.0) + record_trip(*trip)
+            analytics = main.get_analytics()
+            check("Incremental user totals", sorted((name, round(total, 6)) for name, total in
+                                                    analytics.top_emitters(3)),
+                  sorted((name, round(total, 6)) for name, total in emissions.items()))
+            check("The journal was folded into a snapshot", os.path.exists(analytics.path), True)
+            incremental = analytics_snapshot(analytics)
+            check("Another process sees the same aggregates",
+                  analytics_snapshot(main.FleetAnalytics()), incremental)
+            analytics.rebuild()
+            check("A rebuild from the emission table matches the incremental aggregates",
+                  analytics_snapshot(analytics), incremental)
+            check("Percentiles follow the nearest rank", [round(analytics.percentile(p), 6) for p in (0, 34, 100)],
+                  [round(total, 6) for total in sorted(emissions.values())])
+            try:
+                analytics.percentile(101)
+                check("Percentile out of range", "accepted", "Percentile must be between 0 and 100")
+            except ValueError as e:
+                check("Percentile out of range", str(e), "Percentile must be between 0 and 100")
+    finally:
+        main.ANALYTICS_SNAPSHOT_THRESHOLD = threshold
+
+def run_vehicle_profile_tests():
+    print("\n=== Vehicle Profile Tests ===")
+    with scratch_directory():
+        main.set_storage(main.CSVStorage())
+        store = main.get_profile_store()
+        work = store.add("alice1", "Work car", "car", "gasoline", 12.5)
+        store.add("alice1", "Scooter", "motorcycle", urban_mode=True)
+        store.add("bobby", "Delivery van", "van", "diesel", 9.0)
+        check("Profile ids count per user", [(p.username, p.profile_id) for p in
+                                             store.list("alice1") + store.list("bobby")],
+              [("alice1", 1), ("alice1", 2), ("bobby", 1)])
+        expected = (scalar_emission(80.0, 12.5, "gasoline", False), scalar_emission(15.0, None, "", True, "motorcycle"))
+        check("Profile trips score like the full prompt path",
+              [math.isclose(actual, wanted) for actual, wanted in
+               zip((store.record_trip("alice1", work.profile_id, 80.0, "Mar", 2024),
+                    store.record_trip("alice1", 2, 15.0, "Mar", 2024)), expected)], [True, True])
+        check("Profile trips are stored",
+              math.isclose(stored_emission("alice1", 2024, "Mar"), sum(expected), abs_tol=1e-5), True)
+        main.FILE_CACHE.clear()
+        check("Profiles are read back from the file",
+              [profile.describe() for profile in main.VehicleProfileStore().list("alice1")],
+              ["[1] Work car (CAR, GASOLINE, 12.5 km/L)", "[2] Scooter (MOTORCYCLE, distance-based, urban)"])
+
+        for label, call, message in (
+                ("Empty vehicle name", lambda: store.add("alice1", " ", "car"),
+                 "Vehicle name must be between 1 and 30 characters"),
+                ("Fuel type without efficiency", lambda: store.add("alice1", "Car", "car", "diesel"),
+                 "Fuel efficiency required when fuel type is specified"),
+                ("Unknown profile id", lambda: store.record_trip("alice1", 9, 10.0),
+                 "No vehicle profile 9 for user alice1"),
+                ("Another user's profile", lambda: store.record_trip("carol", 1, 10.0),
+                 "No vehicle profile 1 for user carol"),
+                ("Invalid trip distance", lambda: store.record_trip("alice1", 1, -5.0),
+                 "Distance must be a positive number")):
+            try:
+                call()
+                check(label, "accepted", message)
+            except ValueError as e:
+                check(label, str(e), message)
+
+def run_metrics_tests():
+    print("\n=== Metrics Tests ===")
+    metrics = main.Metrics()
+    check("Disabled spans are the shared no-op", metrics.span("store") is main.NULL_SPAN, True)
+    metrics.count("rows_scanned", 5)
+    metrics.gauge("queue_depth", 3)
+    check("Disabled counters and gauges record nothing", (metrics.counters, metrics.gauges), ({}, {}))
+
+    metrics.enabled = True
+    metrics.observe("store", 0.0003)
+    metrics.observe("store", 0.02)
+    metrics.count("rows_scanned", 5, file="users.csv")
+    metrics.count("rows_scanned", 7, file="users.csv")
+    metrics.gauge("queue_depth", 3)
+    metrics.gauge("queue_depth", 1)
+    lines = metrics.render().splitlines()
+    check("Spans render as cumulative histogram buckets",
+          [line for line in lines if line.startswith("vehicalc_span_seconds") and
+           any(f'le="{bound}"' in line for bound in ("0.0001", "0.0005", "0.05", "+Inf"))],
+          ['vehicalc_span_seconds_bucket{span="store",le="0.0001"} 0',
+           'vehicalc_span_seconds_bucket{span="store",le="0.0005"} 1',
+           'vehicalc_span_seconds_bucket{span="store",le="0.05"} 2',
+           'vehicalc_span_seconds_bucket{span="store",le="+Inf"} 2'])
+    check("Counters add up per label set", 'vehicalc_rows_scanned_total{file="users.csv"} 12' in lines, True)
+    check("Gauges keep the last value", "vehicalc_queue_depth 1" in lines, True)
+
+    with scratch_directory():
+        main.set_storage(main.CSVStorage())
+        main.METRICS.enable("metrics.prom")
+        try:
+            record_trip("alice1", 2024, "Jan", "car", "gasoline", 12.0, 100.0)
+            main.METRICS.dump()
+            with open("metrics.prom") as file:
+                text = file.read()
+        finally:
+            main.METRICS.enabled, main.METRICS.path = False, None
+            main.METRICS.spans.clear()
+            main.METRICS.counters.clear()
+            main.METRICS.gauges.clear()
+        check("Recording a trip times each storage stage",
+              [f'vehicalc_span_seconds_count{{span="{name}"}} 1' in text
+               for name in ("store.history", "store.trip_log", "store.analytics")], [True, True, True])
+        check("Writes count the bytes they put on disk", "vehicalc_bytes_written_total{" in text, True)
+
+def run_authentication_tests():
+    print("\n=== Authentication Tests ===")
+    stored = main.hash_password("secret123")
+    check("A PBKDF2 hash verifies only its own password",
+          (main.verify_password("secret123", stored), main.verify_password("secret124", stored)),
+          ((True, False), (False, False)))
+    check("Salts make equal passwords hash differently", main.hash_password("secret123") != stored, True)
+    check("A hash with fewer iterations asks for a rehash",
+          main.verify_password("secret123", main.hash_password("secret123", iterations=1000)), (True, True))
+
+    with scratch_directory():
+        storage = main.set_storage(main.CSVStorage())
+        storage.add_user("alice1", main.legacy_hash_password("secret123"))
+        storage.add_user("bobby", main.hash_password("secret123"))
+        authenticator = main.Authenticator(ttl=60, workers=2)
+        kdf_runs = []
+        check_password = authenticator.check
+        authenticator.check = lambda password, stored_hash: kdf_runs.append(1) or check_password(password, stored_hash)
+
+        check("A legacy SHA-256 login succeeds", authenticator.verify("alice1", "secret123"), True)
+        upgraded = storage.get_password_hash("alice1")
+        check("The legacy hash is upgraded to PBKDF2", upgraded.split("$")[0], main.PASSWORD_HASH_SCHEME)
+        check("The upgraded hash still verifies", main.verify_password("secret123", upgraded), (True, False))
+
+        del kdf_runs[:]
+        results = [authenticator.verify("bobby", "secret123") for _ in range(3)]
+        check("Repeat logins within the TTL run the KDF once", (results, len(kdf_runs)), ([True] * 3, 1))
+        check("A wrong password is rejected and not cached",
+              [authenticator.verify("bobby", "wrong1234") for _ in range(2)] + [len(kdf_runs)], [False, False, 3])
+        storage.update_password_hash("bobby", main.hash_password("changed123"))
+        check("A changed hash invalidates the cached login",
+              (authenticator.verify("bobby", "secret123"), authenticator.verify("bobby", "changed123")), (False, True))
+        check("Unknown users are rejected without running the KDF",
+              (authenticator.verify("nobody", "secret123"), len(kdf_runs)), (False, 5))
+
+        async def run_storage(function, *args):
+            return function(*args)
+
+        authenticator.forget()
+        check("verify_async agrees with verify",
+              [asyncio.run(authenticator.verify_async("bobby", password, run_storage))
+               for password in ("changed123", "wrong1234")], [True, False])
+        authenticator.pool.shutdown()
+
+        hashed_on = []
+        hash_password = main.hash_password
+        def recording_hash(password):
+            hashed_on.append(threading.current_thread().name)
+            return hash_password(password)
+        main.hash_password = recording_hash
+        try:
+            user = main.User("carol1", "secret123")
+            asyncio.run(main.get_authenticator().hash_async("secret123"))
+        finally:
+            main.hash_password = hash_password
+        check("Signup hashes on the authenticator's pool, not the caller's thread",
+              [name.startswith("vehicalc-auth") for name in hashed_on], [True, True])
+        check("The pooled hash verifies", main.verify_password("secret123", user.password), (True, False))
+
+def run_column_validation_tests():
+    print("\n=== Column Validation Tests ===")
+    rng = random.Random(21)
+    # The first three values of each field are valid; rows mostly draw from those
+    samples = (["alice1", "bobby", "carol1", "", "abc", "bad name!", "x" * 21, None, 1234],
+               ["car", "VAN", "Motorcycle", "truck", ""],
+               ["gasoline", "Diesel", "", None, "kerosene"],
+               [12.5, "8", None, 0, -3.0, "abc", "", True, "nan", float("inf")],
+               [100.0, "42.5", 7, 0, -1.0, "far", None, "1e3", float("nan"), "inf", "-inf"],
+               ["Jan", "Dec", "Mar", "jan", "Month", "", None],
+               [2024, "2020", " 2023 ", "", 1899, 9999, "20x4", "+2021"])
+    rows = [[rng.choice(values[:3] if rng.random() < 0.9 else values) for values in samples] for _ in range(400)]
+    validation = main.validate_columns(*map(list, zip(*rows)))
+    agreed = []
+    for row, raw in enumerate(rows):
+        try:
+            user_input = main.UserInput(*raw)
+            expected = (None, user_input.username, user_input.vehicle_type, user_input.fuel_type,
+                        user_input.fuel_efficiency, user_input.distance_travelled, user_input.emission_month,
+                        user_input.emission_year)
+        except (ValueError, TypeError) as e:
+            expected = str(e)
+        if validation.errors[row]:
+            actual = validation.message(row)
+        else:
+            actual = (None,) + tuple(getattr(validation, field)[row] for field in main.BatchValidation.FIELDS)
+        agreed.append(actual == expected)
+    check("Column validation matches UserInput row by row", all(agreed), True)
+    check("Both valid and invalid rows were covered",
+          0 < sum(validation.mask) < len(rows), True)
+    check("Valid rows become the same UserInput values",
+          all(vars(user_input) == vars(main.UserInput(*rows[row])) for row, user_input in validation.user_inputs()),
+          True)
+
+    special = [float("nan"), float("inf"), float("-inf"), "nan", "inf", "-inf"]
+    for name, validator, message in (("distance", main.validate_distance, "Distance must be a positive number"),
+                                     ("efficiency", main.validate_fuel_efficiency,
+                                      "Fuel efficiency must be a positive number")):
+        messages = []
+        for value in special:
+            try:
+                messages.append(validator(value))
+            except ValueError as e:
+                messages.append(str(e))
+        check(f"NaN and infinite {name} values are rejected", messages, [message] * len(special))
+    validation = main.validate_columns(["alice1"] * 6, ["car"] * 6, ["gasoline"] * 6, special, [10.0] * 6,
+                                       ["Jan"] * 6, [2024] * 6)
+    check("NaN and infinite efficiency columns are rejected",
+          [validation.message(row) for row in range(6)], ["Fuel efficiency must be a positive number"] * 6)
+    validation = main.validate_columns(["alice1"] * 6, ["car"] * 6, [""] * 6, [None] * 6, special,
+                                       ["Jan"] * 6, [2024] * 6)
+    check("NaN and infinite distance columns are rejected",
+          [validation.message(row) for row in range(6)], ["Distance must be a positive number"] * 6)
+
+def sharded_contents(storage):
+    rows = {year: sorted((row["username"], tuple(float(row[month]) for month in main.VALID_MONTHS))
+                         for row in storage.iter_emission_rows(year)) for year in storage.list_years()}
+    return sorted(storage.iter_users()), rows
+
+def run_sharded_storage_tests():
+    print("\n=== Sharded Storage Tests ===")
+    with scratch_directory():
+        expected = storage_snapshot("csv")
+    with scratch_directory():
+        check("Sharded storage reads back what CSV storage does", storage_snapshot("sharded:4"), expected)
+        storage = main.ShardedStorage()
+        check("An existing layout keeps its bucket count", storage.manifest(), {"buckets": 4})
+        storage.add_user("dave1", "hash4")
+        bucket = main.shard_for_username("dave1", 4)
+        check("A signup lands in its own bucket only", [storage.shard(4, i).get_password_hash("dave1") for i in range(4)],
+              ["hash4" if i == bucket else None for i in range(4)])
+
+    with scratch_directory():
+        storage = main.ShardedStorage(4)
+        storage.add_users((f"user{i:03d}", f"hash{i}") for i in range(60))
+        storage.merge_emissions({(f"user{i:03d}", 2024 + i % 2, main.VALID_MONTHS[i % 12]): i + 0.5 for i in range(60)})
+        before = sharded_contents(storage)
+
+        copy_bucket = storage.copy_bucket
+        copies = []
+
+        def crashing_copy(source, buckets, resume):
+            # The third bucket is copied in full, then the process dies before it is marked moved
+            copies.append(resume)
+            users = copy_bucket(source, buckets, resume)
+            if len(copies) == 3:
+                raise IOError("simulated crash")
+            return users
+
+        storage.copy_bucket = crashing_copy
+        try:
+            storage.reshard(8)
+        except IOError:
+            pass
+        main.FILE_CACHE.clear()
+        storage = main.ShardedStorage()
+        check("An interrupted reshard records its progress",
+              {key: storage.manifest()[key] for key in ("buckets", "next", "moved", "copying")},
+              {"buckets": 4, "next": 8, "moved": [0, 1], "copying": 2})
+        check("Reads mid-reshard see every user and emission once", sharded_contents(storage) == before, True)
+        storage.record_emission("user002", "Mar", 1.0, 2024)
+        storage.record_emission("user003", "Apr", 1.0, 2025)
+        try:
+            storage.reshard(16)
+            check("A different reshard waits for the unfinished one", "accepted", "ValueError")
+        except ValueError as e:
+            check("A different reshard waits for the unfinished one", str(e),
+                  "A reshard to 8 buckets is unfinished; run that one first")
+        storage.reshard(8)
+        main.FILE_CACHE.clear()
+        storage = main.ShardedStorage()
+        users, rows = sharded_contents(storage)
+        check("The resumed reshard lands every user once", users == before[0], True)
+        check("The resumed reshard neither drops nor doubles emissions",
+              (rows[2024][1][1][2], rows[2025][1][1][3], sum(sum(values) for year in rows.values()
+                                                              for _, values in year)),
+              (3.5, 4.5, sum(i + 0.5 for i in range(60)) + 2.0))
+        check("The old layout is removed", (storage.manifest(), os.path.exists(storage.layout_dir(4))),
+              ({"buckets": 8}, False))
+
+def exported_rows(path, report_format):
+    # (username, year, 12 months, total) per row, read back from an export file
+    if report_format == "columnar":
+        rows = []
+        for group in main.ColumnarReportWriter.read(path):
+            rows += zip(group["username"], group["year"], *(group[month] for month in main.VALID_MONTHS),
+                        group["total"])
+        return [(row[0], row[1], tuple(row[2:14]), row[14]) for row in rows]
+    with open(path, newline="") as file:
+        if report_format == "csv":
+            records = list(csv.DictReader(file))
+        else:
+            records = [json.loads(line) for line in file]
+    return [(record["username"], int(record["year"]), tuple(float(record[month]) for month in main.VALID_MONTHS),
+             float(record["total"])) for record in records]
+
+def run_export_tests():
+    print("\n=== Report Export Tests ===")
+    with scratch_directory():
+        storage = main.set_storage(main.CSVStorage())
+        rng = random.Random(24)
+        totals = {}
+        for i in range(main.EXPORT_CHUNK_ROWS + 500):  # More than one chunk
+            for month in rng.sample(main.VALID_MONTHS, 3):
+                totals[(f"user{i:05d}", 2024, month)] = round(rng.uniform(0.1, 90.0), 3)
+        for i in range(0, 60, 3):
+            totals[(f"user{i:05d}", 2025, "Jan")] = i + 0.25
+        storage.merge_emissions(totals)
+        expected = [(username, year, values, math.fsum(values))
+                    for username, year, values in main.iter_report_rows(storage)]
+        check("Every stored row is reported", len(expected), main.EXPORT_CHUNK_ROWS + 520)
+
+        for report_format in ("csv", "jsonl", "columnar"):
+            path = f"report.{report_format}"
+            rows = main.export_reports(path, report_format)
+            check(f"{report_format} export round-trips every row",
+                  (rows, exported_rows(path, report_format) == expected), (len(expected), True))
+            check(f"{report_format} export leaves no temporary file", os.path.exists(path + ".tmp"), False)
+
+        check("Columnar exports are split into row groups",
+              [len(group["total"]) for group in main.ColumnarReportWriter.read("report.columnar", ["total"])],
+              [main.EXPORT_CHUNK_ROWS, 520])
+        check("Columnar reads decode only the requested columns",
+              sorted(next(main.ColumnarReportWriter.read("report.columnar", ["username", "total"]))),
+              ["total", "username"])
+
+        main.export_reports("filtered.jsonl", "jsonl", usernames=["user00003", "user00004"], years=[2025])
+        check("Filters limit the export to the given users and years",
+              [(row[0], row[1], row[3]) for row in exported_rows("filtered.jsonl", "jsonl")],
+              [("user00003", 2025, 3.25)])
+
+        with open("report.columnar", "rb") as file:
+            data = file.read()
+        with open("torn.columnar", "wb") as file:
+            file.write(data[:-10])
+        for label, call, message in (
+                ("An unknown export format", lambda: main.export_reports("report.xml", "xml"),
+                 "Invalid export format 'xml'. Use one of: csv, jsonl, columnar"),
+                ("Columnar output to stdout", lambda: main.export_reports("-", "columnar"),
+                 "The columnar format needs an output file"),
+                ("A truncated columnar file", lambda: list(main.ColumnarReportWriter.read("torn.columnar")),
+                 "torn.columnar is incomplete")):
+            try:
+                call()
+                check(label, "accepted", message)
+            except ValueError as e:
+                check(label, str(e), message)
+
+def run_benchmark_tests():
+    print("\n=== Benchmark Smoke Tests ===")
+    with scratch_directory() as directory:
+        result = subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark.py"),
+                                 "--sizes", "100", "--samples", "5", "--sessions", "2", "--session-ops", "2",
+                                 "--fsync", "never", "--workdir", directory],
+                                capture_output=True, text=True, timeout=300)
+        check("The benchmark exits cleanly", (result.returncode, result.stderr.count("== 100 trips")), (0, 1))
+        runs = json.loads(result.stdout)["runs"]
+        paths = runs[0]["results"]
+        check("Every path is measured", sorted(paths),
+              sorted(["preload_users", "import", "calculate_calculator", "calculate_lookup", "signup", "login",
+                      "store_emission", "history", "history_range", "sessions"]))
+        check("The synthetic trips are all imported", (paths["import"]["trips"], paths["import"]["rejected"]), (100, 0))
+        check("Timed paths report latency percentiles",
+              all(paths[name]["ops"] == 5 and paths[name]["p50_ms"] <= paths[name]["p99_ms"]
+                  for name in ("calculate_lookup", "signup", "login", "store_emission", "history")), True)
+        check("Concurrent sessions each run their steps",
+              (paths["sessions"]["sessions"], paths["sessions"]["store_emission"]["ops"]), (2, 4))
+
+def run_partition_tests():
+    print("\n=== Yearly Partition Tests ===")
+    with scratch_directory():
+        storage = main.set_storage(main.CSVStorage())
+        for year, month, emission in ((2022, "Dec", 1.0), (2023, "Jan", 2.0), (2023, "Jun", 3.0), (2024, "Feb", 4.0)):
+            storage.record_emission("alice1", month, emission, year)
+        storage.record_emission("bobby", "Mar", 5.0, 2023)
+        for year in storage.list_years():
+            storage.partition(year).compact()
+        check("Each year gets its own table",
+              (storage.list_years(), [name for name in data_files() if name.startswith("emission")]),
+              ([2022, 2023, 2024], ["emission_history_2022.csv", "emission_history_2023.csv",
+                                    "emission_history_2024.csv"]))
+        check("A range crosses year boundaries",
+              [entry for entry in storage.get_emission_range("alice1", (2022, "Nov"), (2023, "Feb"))],
+              [(2022, "Nov", 0.0), (2022, "Dec", 1.0), (2023, "Jan", 2.0), (2023, "Feb", 0.0)])
+        check("Periods parse in both notations", (main.parse_period("Mar 2023"), main.parse_period("2023-03")),
+              ((2023, "Mar"), (2023, "Mar")))
+
+        check("Archiving a past year", storage.archive_year(2023), True)
+        check("The archived table is compressed", (os.path.exists("emission_history_2023.csv"),
+                                                   os.path.exists("emission_history_2023.csv.gz")), (False, True))
+        check("Archived years are still read", (storage.list_years(), stored_emission("alice1", 2023, "Jun"),
+                                                stored_emission("bobby", 2023, "Mar")), ([2022, 2023, 2024], 3.0, 5.0))
+        storage.record_emission("bobby", "Mar", 1.0, 2023)
+        check("A write brings an archived year back", (stored_emission("bobby", 2023, "Mar"),
+                                                      os.path.exists("emission_history_2023.csv.gz")), (6.0, False))
+        for label, call, message in (
+                ("Archiving the current year", lambda: storage.archive_year(datetime.now().year),
+                 "Only past years can be archived"),
+                ("A reversed range", lambda: storage.get_emission_range("alice1", (2024, "Jan"), (2023, "Jan")),
+                 "The start of the range must not be after its end")):
+            try:
+                call()
+                check(label, "accepted", message)
+            except ValueError as e:
+                check(label, str(e), message)
+
+
 run_all_validation_tests()
+run_column_validation_tests()
+run_batch_calculator_tests()
+run_ledger_tests()
+run_user_index_tests()
+run_user_storage_tests()
+run_authentication_tests()
+run_read_cache_tests()
+run_concurrent_write_tests()
+run_atomic_write_tests()
+run_sqlite_storage_tests()
+run_sharded_storage_tests()
+run_partition_tests()
+run_rescore_tests()
+run_bulk_import_tests()
+run_parallel_import_tests()
+run_import_tests()
+run_legacy_adoption_tests()
+run_vehicle_profile_tests()
+run_recurring_trip_tests()
+run_analytics_tests()
+run_matrix_conversion_tests()
+run_vehicle_factor_tests()
+run_metrics_tests()
+run_benchmark_tests()
+run_service_tests()
+run_headless_script_tests()
+run_export_tests()
+run_ingest_tests()